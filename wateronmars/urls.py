@@ -24,12 +24,14 @@ from django.urls import include, re_path
 
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
+from wom_river.settings import METRICS_ENDPOINT
 admin.autodiscover()
 
 
 from wom_user.views import (
     get_robots_txt,
     get_humans_txt,
+    get_feed_collection_metrics,
     home,
     user_logout,
     user_profile,
@@ -93,6 +95,11 @@ if not settings.USE_CELERY:
     re_path(r'^houston/we_ve_got_a_cleanup_request/$', request_for_cleanup),
     ]
 
+if METRICS_ENDPOINT:
+  urlpatterns += [
+    re_path(r'^metrics$', get_feed_collection_metrics),
+    ]
+
 if not settings.READ_ONLY:
   urlpatterns += [
     re_path(r'^accounts/new/$', user_creation),
@@ -0,0 +1,68 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Indexes tuned for the hot queries, that are partial indexes on the
+backends supporting them (PostgreSQL and SQLite) and plain composite
+ones elsewhere.
+
+As the kind of index depends on the backend, they can't be declared
+in the models' Meta and are created and dropped by migrations with the
+helpers below.
+"""
+
+from collections import namedtuple
+
+
+# An index on table's columns, or if the backend supports it, on
+# partial_columns for the rows matching condition only.
+# NOTE: the condition must be written the way django writes the
+# queries' filters (eg "NOT flag" rather than "flag = false") for the
+# planners to notice that the index can be used.
+TunedIndex = namedtuple("TunedIndex",
+                        "name, table, columns, partial_columns, condition")
+
+
+# Indexes for the deletion of the obsolete references.
+# WARNING: READ ONLY ! (changing them requires a new migration)
+REFERENCE_TUNED_INDEXES = (
+  TunedIndex("wom_pebbles_ref_unpinned_idx", "wom_pebbles_reference",
+             ("pin_count", "pub_date"), ("pub_date",), "pin_count = 0"),
+  )
+
+
+def create_tuned_indexes(schema_editor, indexes):
+  qn = schema_editor.quote_name
+  use_partial = schema_editor.connection.features.supports_partial_indexes
+  for index in indexes:
+    columns = index.partial_columns if use_partial else index.columns
+    sql = "CREATE INDEX %s ON %s (%s)" % (
+      qn(index.name), qn(index.table), ", ".join(qn(c) for c in columns))
+    if use_partial:
+      sql += " WHERE %s" % index.condition
+    schema_editor.execute(sql)
+
+
+def drop_tuned_indexes(schema_editor, indexes):
+  qn = schema_editor.quote_name
+  for index in indexes:
+    schema_editor.execute(schema_editor.sql_delete_index
+                          % {"table": qn(index.table), "name": qn(index.name)})
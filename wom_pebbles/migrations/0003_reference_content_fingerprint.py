@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_pebbles', '0002_auto_20190531_2338'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reference',
+            name='content_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
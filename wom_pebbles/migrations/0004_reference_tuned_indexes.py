@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from wom_pebbles.db_indexes import REFERENCE_TUNED_INDEXES
+from wom_pebbles.db_indexes import create_tuned_indexes, drop_tuned_indexes
+
+
+def add_indexes(apps, schema_editor):
+    create_tuned_indexes(schema_editor, REFERENCE_TUNED_INDEXES)
+
+
+def remove_indexes(apps, schema_editor):
+    drop_tuned_indexes(schema_editor, REFERENCE_TUNED_INDEXES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_pebbles', '0003_reference_content_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_indexes, remove_indexes),
+    ]
@@ -34,6 +34,10 @@ URL_MAX_LENGTH = 255
 # WARNING: READ ONLY !
 REFERENCE_TITLE_MAX_LENGTH = 150
 
+# Number of characters of a reference's content fingerprint (an
+# hexadecimal SHA-1 digest).
+CONTENT_FINGERPRINT_LENGTH = 40
+
 
 def build_safe_code_from_url(ref_url):
   url_bytes = ref_url.encode("utf-8")
@@ -69,6 +73,10 @@ class Reference(models.Model): # A pebble !
   # Count the number of users that saved this reference
   # IMPORTANT: use add_pin instead !
   pin_count = models.IntegerField(default=0)
+  # Hash of the content the reference was last built from (empty if
+  # unknown), used to skip feed items that didn't change.
+  content_fingerprint = models.CharField(max_length=CONTENT_FINGERPRINT_LENGTH,
+                                         default="", blank=True)
   # Sources of this reference
   sources = models.ManyToManyField("self",symmetrical=False,related_name="productions")
 
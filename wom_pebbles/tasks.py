@@ -21,6 +21,7 @@
 from django.utils.encoding import iri_to_uri
 
 from wom_river.utils.netscape_bookmarks import parse_netscape_bookmarks
+from wom_river.utils.http_client import http_get
 
 from wom_pebbles.models import REFERENCE_TITLE_MAX_LENGTH
 from wom_pebbles.models import URL_MAX_LENGTH
@@ -31,7 +32,6 @@ from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
 
 from datetime import datetime, timezone
-from urllib import request
 from urllib.parse import urlparse
 from collections import namedtuple
 
@@ -53,7 +53,9 @@ def try_get_title_from_page(url):
   """Try to get the title from a web page, returns None if anything fails.
   """
   try:
-      soup = BeautifulSoup(request.urlopen(url), "html.parser")
+      with http_get(url) as r:
+        r.raise_for_status()
+        soup = BeautifulSoup(r.content, "html.parser")
       return soup.title.string
   except Exception as e:
       logger.warning(f"Failed to find title for {url} because of '{e}'")
@@ -21,6 +21,8 @@
 
 from datetime import datetime, timezone
 
+import mock
+
 from django.test import TestCase
 from django.db import IntegrityError
 
@@ -37,6 +39,7 @@ from wom_pebbles.tasks import (
     truncate_reference_title,
     sanitize_url,
     import_references_from_ns_bookmark_list,
+    try_get_title_from_page,
     )
 
 from wom_pebbles.templatetags.html_sanitizers  import defang_html
@@ -209,6 +212,21 @@ class UtilityFunctionsTests(TestCase):
     self.assertGreaterEqual(URL_MAX_LENGTH,len(truncated_url))
 
 
+class TryGetTitleFromPageTest(TestCase):
+
+  def test_title_found(self):
+    response = mock.MagicMock(content=b"<html><head><title>Mouf</title></head></html>")
+    response.__enter__.return_value = response
+    with mock.patch("wom_pebbles.tasks.http_get", return_value=response) as get:
+      self.assertEqual("Mouf", try_get_title_from_page("http://mouf"))
+    get.assert_called_once_with("http://mouf")
+
+  def test_network_error_gives_none(self):
+    with mock.patch("wom_pebbles.tasks.http_get",
+                    side_effect=IOError("Network unreachable")):
+      self.assertEqual(None, try_get_title_from_page("http://mouf"))
+
+
 class ImportReferencesFromNSBookmarkListTaskTest(TestCase):
 
   def setUp(self):
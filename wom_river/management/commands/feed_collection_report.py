@@ -0,0 +1,70 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Print a report about the recent collections of news from the feeds:
+totals per lane and the slowest feeds.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+
+from wom_river.metrics import summarize_runs, summarize_feeds
+
+
+def format_duration(value):
+  return "-" if value is None else f"{value:.2f}s"
+
+
+class Command(BaseCommand):
+
+  help = "Report about the recent collections of news from the feeds."
+
+  def add_arguments(self, parser):
+    parser.add_argument("--days", type=float, default=1.0,
+                        help="Number of past days to report about.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="Number of slowest feeds to list.")
+
+  def handle(self, *args, **options):
+    since = datetime.now(timezone.utc) - timedelta(days=options["days"])
+    self.stdout.write(f"Collection runs since {since.isoformat()}:")
+    for run in summarize_runs(since):
+      self.stdout.write(
+          f"  lane '{run['lane']}': {run['num_runs']} runs, "
+          f"avg {format_duration(run['avg_duration'])}, "
+          f"max {format_duration(run['max_duration'])}, "
+          f"{run['avg_num_feeds']:.1f} feeds/run, "
+          f"{run['num_failed_feeds']} failures, "
+          f"{run['num_entries']} entries, "
+          f"{run['num_new_references']} new references, "
+          f"max queue depth {run['max_queue_depth']}")
+    self.stdout.write(f"Slowest feeds (top {options['top']}):")
+    for feed in summarize_feeds(since, limit=options["top"]):
+      self.stdout.write(
+          f"  {feed['feed__xmlURL']}: {feed['num_fetches']} fetches, "
+          f"{feed['num_failures']} failures, "
+          f"fetch {format_duration(feed['avg_fetch_duration'])} "
+          f"(max {format_duration(feed['max_fetch_duration'])}), "
+          f"parse {format_duration(feed['avg_parse_duration'])}, "
+          f"db {format_duration(feed['avg_db_duration'])}, "
+          f"{feed['num_new_references']} new references")
@@ -0,0 +1,171 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Record and summarize metrics about the collection of news from the
+feeds: per feed samples (timings, entry counts, status) and per run
+totals.
+"""
+
+from datetime import datetime, timezone
+
+from django.db.models import Avg, Count, Max, Q, Sum
+
+from wom_river.models import FeedCollectionRun, FeedFetchSample
+from wom_river.settings import COLLECT_METRICS, METRICS_RETENTION
+
+
+def start_collection_run(lane=""):
+  """Return a new (unsaved) FeedCollectionRun or None if metrics are
+  disabled."""
+  if not COLLECT_METRICS:
+    return None
+  return FeedCollectionRun(start_date=datetime.now(timezone.utc), lane=lane)
+
+
+def record_fetch_sample(run, feed, fetch_result, is_broken, db_duration,
+                        num_new_references):
+  """Save a sample about the collection of news from a feed (if metrics
+  are enabled) and account for it in the run's totals."""
+  if not COLLECT_METRICS:
+    return
+  parsed_feed = fetch_result.parsed_feed
+  num_entries = len(parsed_feed.entries) if parsed_feed is not None else 0
+  if run is not None:
+    if run.pk is None:
+      run.save()
+    run.num_feeds += 1
+    run.num_failed_feeds += int(is_broken)
+    run.num_entries += num_entries
+    run.num_new_references += num_new_references
+  FeedFetchSample.objects.create(
+      run=run,
+      feed=feed,
+      fetch_date=fetch_result.fetch_date,
+      status=fetch_result.status,
+      is_broken=is_broken,
+      fetch_duration=fetch_result.duration,
+      parse_duration=fetch_result.parse_duration,
+      db_duration=db_duration,
+      num_entries=num_entries,
+      num_new_references=num_new_references)
+
+
+def finish_collection_run(run, duration, max_queue_depth):
+  """Save the run's totals and forget the metrics that are too old."""
+  if run is None:
+    return
+  run.duration = duration
+  run.max_queue_depth = max_queue_depth
+  run.save()
+  delete_old_metrics(run.start_date - METRICS_RETENTION)
+
+
+def delete_old_metrics(limit_date):
+  FeedCollectionRun.objects.filter(start_date__lt=limit_date).delete()
+  FeedFetchSample.objects.filter(fetch_date__lt=limit_date).delete()
+
+
+def summarize_runs(since):
+  """Aggregate the runs started since the given date, lane by lane."""
+  return list(FeedCollectionRun.objects
+              .filter(start_date__gte=since)
+              .values("lane")
+              .annotate(num_runs=Count("id"),
+                        avg_duration=Avg("duration"),
+                        max_duration=Max("duration"),
+                        avg_num_feeds=Avg("num_feeds"),
+                        num_failed_feeds=Sum("num_failed_feeds"),
+                        num_entries=Sum("num_entries"),
+                        num_new_references=Sum("num_new_references"),
+                        max_queue_depth=Max("max_queue_depth"))
+              .order_by("lane"))
+
+
+def summarize_feeds(since, order_by="-avg_fetch_duration", limit=None):
+  """Aggregate the samples taken since the given date, feed by feed."""
+  summaries = (FeedFetchSample.objects
+               .filter(fetch_date__gte=since)
+               .values("feed__xmlURL")
+               .annotate(num_fetches=Count("id"),
+                         num_failures=Count("id", filter=Q(is_broken=True)),
+                         avg_fetch_duration=Avg("fetch_duration"),
+                         max_fetch_duration=Max("fetch_duration"),
+                         avg_parse_duration=Avg("parse_duration"),
+                         avg_db_duration=Avg("db_duration"),
+                         num_entries=Sum("num_entries"),
+                         num_new_references=Sum("num_new_references"))
+               .order_by(order_by, "feed__xmlURL"))
+  if limit is not None:
+    summaries = summaries[:limit]
+  return list(summaries)
+
+
+def summarize_samples(since):
+  """Aggregate all the samples taken since the given date."""
+  return FeedFetchSample.objects\
+                        .filter(fetch_date__gte=since)\
+                        .aggregate(num_fetches=Count("id"),
+                                   num_failures=Count("id", filter=Q(is_broken=True)),
+                                   sum_fetch_duration=Sum("fetch_duration"),
+                                   sum_parse_duration=Sum("parse_duration"),
+                                   sum_db_duration=Sum("db_duration"),
+                                   num_entries=Sum("num_entries"),
+                                   num_new_references=Sum("num_new_references"))
+
+
+def format_prometheus_metrics(since):
+  """Render the metrics recorded since the given date in Prometheus'
+  text exposition format."""
+  lines = []
+  def add_metric(name, kind, help_text, values):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in values:
+      label_txt = ",".join(f'{k}="{v}"' for k, v in labels.items())
+      label_txt = f"{{{label_txt}}}" if label_txt else ""
+      lines.append(f"{name}{label_txt} {value or 0}")
+  last_runs = {}
+  for run in FeedCollectionRun.objects.filter(start_date__gte=since)\
+                                      .order_by("start_date"):
+    last_runs[run.lane] = run
+  for field, help_text in (
+      ("duration", "Duration of the last collection run in seconds."),
+      ("num_feeds", "Number of feeds collected by the last run."),
+      ("num_failed_feeds", "Number of feeds that failed in the last run."),
+      ("num_entries", "Number of entries read by the last run."),
+      ("num_new_references", "Number of new references saved by the last run."),
+      ("max_queue_depth", "Max number of feeds waiting during the last run.")):
+    add_metric(f"wom_river_last_run_{field}", "gauge", help_text,
+               [({"lane": lane}, getattr(run, field))
+                for lane, run in sorted(last_runs.items())])
+  totals = summarize_samples(since)
+  for field, help_text in (
+      ("num_fetches", "Number of feed fetches."),
+      ("num_failures", "Number of failed feed fetches."),
+      ("sum_fetch_duration", "Time spent downloading feeds in seconds."),
+      ("sum_parse_duration", "Time spent parsing feeds in seconds."),
+      ("sum_db_duration", "Time spent saving feed items in seconds."),
+      ("num_entries", "Number of entries read from feeds."),
+      ("num_new_references", "Number of new references saved from feeds.")):
+    add_metric(f"wom_river_feed_{field}", "gauge",
+               f"{help_text} (over the retention period)",
+               [({}, totals[field])])
+  return "\n".join(lines) + "\n"
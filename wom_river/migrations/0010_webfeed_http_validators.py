@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_river', '0009_webfeed_latest_update_failure_start_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webfeed',
+            name='http_etag',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='webfeed',
+            name='http_last_modified',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
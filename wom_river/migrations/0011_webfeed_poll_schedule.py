@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:10
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_river', '0010_webfeed_http_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webfeed',
+            name='next_poll_at',
+            field=models.DateTimeField(db_index=True, default=datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddField(
+            model_name='webfeed',
+            name='poll_interval',
+            field=models.DurationField(default=datetime.timedelta(seconds=1200)),
+        ),
+    ]
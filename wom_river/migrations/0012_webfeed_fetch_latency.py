@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_river', '0011_webfeed_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webfeed',
+            name='fetch_latency',
+            field=models.FloatField(db_index=True, default=0.0),
+        ),
+    ]
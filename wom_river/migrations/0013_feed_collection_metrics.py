@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_river', '0012_webfeed_fetch_latency'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedCollectionRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_date', models.DateTimeField(db_index=True)),
+                ('lane', models.CharField(blank=True, default='', max_length=16)),
+                ('duration', models.FloatField(default=0.0)),
+                ('num_feeds', models.IntegerField(default=0)),
+                ('num_failed_feeds', models.IntegerField(default=0)),
+                ('num_entries', models.IntegerField(default=0)),
+                ('num_new_references', models.IntegerField(default=0)),
+                ('max_queue_depth', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FeedFetchSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetch_date', models.DateTimeField(db_index=True)),
+                ('status', models.IntegerField()),
+                ('is_broken', models.BooleanField(default=False)),
+                ('fetch_duration', models.FloatField(null=True)),
+                ('parse_duration', models.FloatField(null=True)),
+                ('db_duration', models.FloatField(default=0.0)),
+                ('num_entries', models.IntegerField(default=0)),
+                ('num_new_references', models.IntegerField(default=0)),
+                ('feed', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='wom_river.webfeed')),
+                ('run', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='wom_river.feedcollectionrun')),
+            ],
+        ),
+    ]
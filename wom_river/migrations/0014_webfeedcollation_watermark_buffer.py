@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:33
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def set_latest_reference_taken(apps, schema_editor):
+    WebFeedCollation = apps.get_model('wom_river', 'WebFeedCollation')
+    for collation in WebFeedCollation.objects.annotate(
+            latest_pub_date=Max('references__pub_date'))\
+                                             .filter(latest_pub_date__isnull=False):
+        collation.latest_reference_taken = collation.latest_pub_date
+        collation.save(update_fields=['latest_reference_taken'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_river', '0013_feed_collection_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='webfeedcollation',
+            name='latest_reference_taken',
+            field=models.DateTimeField(default=datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc), verbose_name='latest reference taken'),
+        ),
+        migrations.RunPython(set_latest_reference_taken, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='webfeedcollation',
+            name='references',
+        ),
+    ]
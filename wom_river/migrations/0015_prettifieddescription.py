@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_pebbles', '0004_reference_tuned_indexes'),
+        ('wom_river', '0014_webfeedcollation_watermark_buffer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrettifiedDescription',
+            fields=[
+                ('reference', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='wom_pebbles.reference')),
+                ('description_hash', models.CharField(max_length=40)),
+                ('html', models.TextField()),
+            ],
+        ),
+    ]
@@ -23,8 +23,11 @@ from django.db import models
 
 from wom_pebbles.models import Reference
 from wom_pebbles.models import URL_MAX_LENGTH
+from wom_pebbles.models import CONTENT_FINGERPRINT_LENGTH
+from wom_pebbles.models import build_safe_code_from_url
 
 DEFAULT_RELEVANCE_DURATION = timedelta(weeks=4)
+DEFAULT_POLL_INTERVAL = timedelta(minutes=20)
 
 class WebFeed(models.Model):
   """Represent a web feed (typically RSS or Atom) associated to a
@@ -36,6 +39,20 @@ class WebFeed(models.Model):
   xmlURL = models.CharField(max_length=URL_MAX_LENGTH)
   # Date marking the last time the source was checked for an update
   last_update_check = models.DateTimeField('last update')
+  # Validators (ETag and Last-Modified headers) sent back by the server
+  # at the last update, used to avoid downloading an unchanged feed.
+  http_etag = models.CharField(max_length=URL_MAX_LENGTH, default="", blank=True)
+  http_last_modified = models.CharField(max_length=URL_MAX_LENGTH, default="", blank=True)
+  # Delay between the last poll and the next one, adapted to the
+  # feed's activity, hints and failures.
+  poll_interval = models.DurationField(default=DEFAULT_POLL_INTERVAL)
+  # Date from which the feed is due for a new poll
+  next_poll_at = models.DateTimeField(
+      default=datetime.fromtimestamp(0, timezone.utc),
+      db_index=True)
+  # Rolling average of the time (in seconds) taken to download the
+  # feed, used to collect the slow feeds apart from the others.
+  fetch_latency = models.FloatField(default=0.0, db_index=True)
   # Time before considering an item obsolete
   item_relevance_duration = models.DurationField(
       default=DEFAULT_RELEVANCE_DURATION)
@@ -66,31 +83,81 @@ class WebFeed(models.Model):
 
 DEFAULT_FLUSHED_PUB_DATE = datetime.fromtimestamp(0, tz=timezone.utc)
 
+
+def build_collated_reference_url_marker(feed):
+  """Return a string found in the url of all the references generated
+  by collating the feed (and in no url of the feed's own items)."""
+  return "/{}/".format(build_safe_code_from_url(feed.xmlURL))
+
+
 class WebFeedCollation(models.Model):
   """Collect references from a feed that
   needs to be collated (ie grouped together).
 
   Note: designed to be used as a buffer where to store the references
-  waiting to be collated, qssuming thqt once the references are
-  collated the list is cleared.
+  waiting to be collated, assuming that once the references are
+  collated the buffer is cleared.
+
+  The buffer isn't stored as such: it is made of the feed's items that
+  were published after the latest flushed reference and up to the
+  latest taken one, so that taking and flushing references just moves
+  these two watermarks. It may then hold items that weren't taken (eg
+  items already known to the user), which are left out when collating
+  (see generate_collations).
   """
   # Target feed
   feed = models.ForeignKey(WebFeed, on_delete=models.CASCADE)
-  # References to be collated
-  references = models.ManyToManyField(Reference)
   # Last time the references were collated
   last_completed_collation_date = models.DateTimeField('latest collation date')
   # Pub date of the latest reference that was part of a flush
   latest_reference_flushed = models.DateTimeField(
       'latest reference flushed',
       default=DEFAULT_FLUSHED_PUB_DATE)
+  # Pub date of the latest reference waiting to be collated
+  latest_reference_taken = models.DateTimeField(
+      'latest reference taken',
+      default=DEFAULT_FLUSHED_PUB_DATE)
+
+  @property
+  def references(self):
+    """The references waiting to be collated, oldest first."""
+    return self._get_unflushed_references()\
+               .filter(pub_date__lte=self.latest_reference_taken)
+
+  def get_references_published_before(self, date):
+    """The references published after the latest flushed one and before
+    the given date (whether they were taken or not), oldest first."""
+    return self._get_unflushed_references().filter(pub_date__lt=date)
+
+  def _get_unflushed_references(self):
+    references = self.feed.source.productions\
+                                 .filter(pub_date__gt=self.latest_reference_flushed)
+    if self.latest_reference_flushed == DEFAULT_FLUSHED_PUB_DATE:
+      # Backward compatibility for before/after addition
+      # of the 'latest_reference_flushed attribute'
+      references = references.filter(
+          pub_date__gte=self.last_completed_collation_date)
+    # The collations' own references are produced by the same source
+    return references.exclude(url__contains=build_collated_reference_url_marker(self.feed))\
+                     .order_by("pub_date", "pk")
 
   def flush(self, completion_date):
-    self.latest_reference_flushed = max(r.pub_date for r in self.references.all())
-    self.references.clear()
+    """Forget about all the references waiting to be collated.
+
+    Note: calling save() is the caller's responsibility.
+    """
+    self.latest_reference_flushed = max(self.latest_reference_flushed,
+                                        self.latest_reference_taken)
     self.last_completed_collation_date = completion_date
 
   def take(self, reference):
+    """Add a reference produced by the feed's source to the ones waiting
+    to be collated.
+
+    Note: calling save() is the caller's responsibility.
+    """
+    if build_collated_reference_url_marker(self.feed) in reference.url:
+      return
     threshold = self.latest_reference_flushed
     pub_date = reference.pub_date
     if pub_date <= threshold:
@@ -100,4 +167,53 @@ class WebFeedCollation(models.Model):
       # of the 'latest_reference_flushed attribute'
       if pub_date < self.last_completed_collation_date:
         return
-    self.references.add(reference)
+    self.latest_reference_taken = max(self.latest_reference_taken, pub_date)
+
+
+class PrettifiedDescription(models.Model):
+  """Prettified version of a reference's description as inserted in
+  the collations (see WOM_RIVER_PERSIST_PRETTIFIED_HTML)."""
+  reference = models.OneToOneField(Reference, primary_key=True,
+                                   related_name="+",
+                                   on_delete=models.CASCADE)
+  # Hash of the description the html was built from
+  description_hash = models.CharField(max_length=CONTENT_FINGERPRINT_LENGTH)
+  html = models.TextField()
+
+
+class FeedCollectionRun(models.Model):
+  """Metrics about one collection of news over a set of feeds."""
+  # When the collection started
+  start_date = models.DateTimeField(db_index=True)
+  # Name of the lane the collection was run for (if any)
+  lane = models.CharField(max_length=16, default="", blank=True)
+  # Duration of the whole collection (in seconds)
+  duration = models.FloatField(default=0.0)
+  num_feeds = models.IntegerField(default=0)
+  num_failed_feeds = models.IntegerField(default=0)
+  # Number of entries read from the feeds
+  num_entries = models.IntegerField(default=0)
+  num_new_references = models.IntegerField(default=0)
+  # Max number of feeds that were waiting to be downloaded or to be
+  # saved at the same time.
+  max_queue_depth = models.IntegerField(default=0)
+
+
+class FeedFetchSample(models.Model):
+  """Metrics about the collection of news from a feed."""
+  # Collection the sample was taken for (if any)
+  run = models.ForeignKey(FeedCollectionRun, null=True,
+                          on_delete=models.CASCADE)
+  feed = models.ForeignKey(WebFeed, on_delete=models.CASCADE)
+  fetch_date = models.DateTimeField(db_index=True)
+  # Status of the fetch as given to FeedStatus.check_and_record
+  status = models.IntegerField()
+  is_broken = models.BooleanField(default=False)
+  # Durations (in seconds) of the download, of the parsing and of the
+  # update of the db (the first two being unknown for failed fetches).
+  fetch_duration = models.FloatField(null=True)
+  parse_duration = models.FloatField(null=True)
+  db_duration = models.FloatField(default=0.0)
+  # Number of entries read from the feed
+  num_entries = models.IntegerField(default=0)
+  num_new_references = models.IntegerField(default=0)
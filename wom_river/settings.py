@@ -0,0 +1,166 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Gather all parameters specific to this application: the default
+values and the way to read them from the global django site settings.
+"""
+
+from django.conf import settings
+
+from datetime import timedelta
+
+# Number of feeds that can be downloaded at the same time when
+# collecting news (1 means a plain sequential collection).
+if hasattr(settings, "WOM_RIVER_FEED_FETCH_WORKERS"):
+  FEED_FETCH_WORKERS = settings.WOM_RIVER_FEED_FETCH_WORKERS
+else:
+  FEED_FETCH_WORKERS = 8
+
+# Max number of feeds downloaded at the same time from a same host (to
+# stay polite with hosts serving lots of feeds like feedburner).
+if hasattr(settings, "WOM_RIVER_FEED_FETCH_MAX_PER_HOST"):
+  FEED_FETCH_MAX_PER_HOST = settings.WOM_RIVER_FEED_FETCH_MAX_PER_HOST
+else:
+  FEED_FETCH_MAX_PER_HOST = 2
+
+# Shortest delay between two polls of a same feed (it makes no sense to
+# make it shorter than the period of the news collection task).
+if hasattr(settings, "WOM_RIVER_FEED_POLL_MIN_INTERVAL"):
+  FEED_POLL_MIN_INTERVAL = settings.WOM_RIVER_FEED_POLL_MIN_INTERVAL
+else:
+  FEED_POLL_MIN_INTERVAL = timedelta(minutes=20)
+
+# Longest delay between two polls of a same feed, whatever its posting
+# rate, the hints it gives or the failures it has.
+if hasattr(settings, "WOM_RIVER_FEED_POLL_MAX_INTERVAL"):
+  FEED_POLL_MAX_INTERVAL = settings.WOM_RIVER_FEED_POLL_MAX_INTERVAL
+else:
+  FEED_POLL_MAX_INTERVAL = timedelta(days=1)
+
+# Number of references saved with the same bulk queries when collecting
+# news from a feed.
+if hasattr(settings, "WOM_RIVER_REFERENCE_SAVE_BATCH_SIZE"):
+  REFERENCE_SAVE_BATCH_SIZE = settings.WOM_RIVER_REFERENCE_SAVE_BATCH_SIZE
+else:
+  REFERENCE_SAVE_BATCH_SIZE = 100
+
+# Max number of bytes read from a feed at each update (the items
+# beyond are ignored).
+if hasattr(settings, "WOM_RIVER_FEED_MAX_BYTES"):
+  FEED_MAX_BYTES = settings.WOM_RIVER_FEED_MAX_BYTES
+else:
+  FEED_MAX_BYTES = 10*1024*1024
+
+# Number of processes dedicated to parsing the downloaded feeds (0
+# meaning that feeds are parsed by the threads downloading them, which
+# may be enough as long as parsing doesn't hog the CPU).
+if hasattr(settings, "WOM_RIVER_FEED_PARSE_PROCESSES"):
+  FEED_PARSE_PROCESSES = settings.WOM_RIVER_FEED_PARSE_PROCESSES
+else:
+  FEED_PARSE_PROCESSES = 0
+
+# Timeout, in seconds, of the HTTP requests used to download feeds and
+# web pages: either a single value or a (connect, read) pair.
+if hasattr(settings, "WOM_RIVER_HTTP_TIMEOUT"):
+  HTTP_TIMEOUT = settings.WOM_RIVER_HTTP_TIMEOUT
+else:
+  HTTP_TIMEOUT = (10, 30)
+
+# Max number of connections open at the same time to a same host (and
+# kept alive to be reused by the next requests).
+if hasattr(settings, "WOM_RIVER_HTTP_MAX_CONNECTIONS_PER_HOST"):
+  HTTP_MAX_CONNECTIONS_PER_HOST = settings.WOM_RIVER_HTTP_MAX_CONNECTIONS_PER_HOST
+else:
+  HTTP_MAX_CONNECTIONS_PER_HOST = 4
+
+# Max number of hosts for which connections are kept alive.
+if hasattr(settings, "WOM_RIVER_HTTP_MAX_POOLED_HOSTS"):
+  HTTP_MAX_POOLED_HOSTS = settings.WOM_RIVER_HTTP_MAX_POOLED_HOSTS
+else:
+  HTTP_MAX_POOLED_HOSTS = 100
+
+# Timeouts, in seconds, to connect to a feed's server, to wait for each
+# piece of the feed's data and to download the whole feed.
+if hasattr(settings, "WOM_RIVER_FEED_FETCH_CONNECT_TIMEOUT"):
+  FEED_FETCH_CONNECT_TIMEOUT = settings.WOM_RIVER_FEED_FETCH_CONNECT_TIMEOUT
+else:
+  FEED_FETCH_CONNECT_TIMEOUT = 10
+
+if hasattr(settings, "WOM_RIVER_FEED_FETCH_READ_TIMEOUT"):
+  FEED_FETCH_READ_TIMEOUT = settings.WOM_RIVER_FEED_FETCH_READ_TIMEOUT
+else:
+  FEED_FETCH_READ_TIMEOUT = 30
+
+if hasattr(settings, "WOM_RIVER_FEED_FETCH_TOTAL_TIMEOUT"):
+  FEED_FETCH_TOTAL_TIMEOUT = settings.WOM_RIVER_FEED_FETCH_TOTAL_TIMEOUT
+else:
+  FEED_FETCH_TOTAL_TIMEOUT = 120
+
+# Feeds whose download usually takes more than this number of seconds
+# are collected after all the others (in a "slow lane").
+if hasattr(settings, "WOM_RIVER_SLOW_FEED_LATENCY"):
+  SLOW_FEED_LATENCY = settings.WOM_RIVER_SLOW_FEED_LATENCY
+else:
+  SLOW_FEED_LATENCY = 10
+
+# Number of feeds downloaded at the same time in the slow lane.
+if hasattr(settings, "WOM_RIVER_SLOW_FEED_FETCH_WORKERS"):
+  SLOW_FEED_FETCH_WORKERS = settings.WOM_RIVER_SLOW_FEED_FETCH_WORKERS
+else:
+  SLOW_FEED_FETCH_WORKERS = 2
+
+# Whether to record metrics about each feed collection (see
+# wom_river.metrics) and for how long to keep them.
+if hasattr(settings, "WOM_RIVER_COLLECT_METRICS"):
+  COLLECT_METRICS = settings.WOM_RIVER_COLLECT_METRICS
+else:
+  COLLECT_METRICS = True
+
+if hasattr(settings, "WOM_RIVER_METRICS_RETENTION"):
+  METRICS_RETENTION = settings.WOM_RIVER_METRICS_RETENTION
+else:
+  METRICS_RETENTION = timedelta(days=7)
+
+# Whether to serve the metrics in Prometheus' text format at /metrics
+if hasattr(settings, "WOM_RIVER_METRICS_ENDPOINT"):
+  METRICS_ENDPOINT = settings.WOM_RIVER_METRICS_ENDPOINT
+else:
+  METRICS_ENDPOINT = False
+
+# Parser used by BeautifulSoup to prettify the references' descriptions
+# in collations ("html.parser" or, if lxml is installed, the faster
+# "lxml").
+if hasattr(settings, "WOM_RIVER_HTML_PARSER"):
+  HTML_PARSER = settings.WOM_RIVER_HTML_PARSER
+else:
+  HTML_PARSER = "html.parser"
+
+# Max number of prettified descriptions kept in memory by each process,
+# and whether to also keep them in the db.
+if hasattr(settings, "WOM_RIVER_PRETTIFIED_HTML_CACHE_SIZE"):
+  PRETTIFIED_HTML_CACHE_SIZE = settings.WOM_RIVER_PRETTIFIED_HTML_CACHE_SIZE
+else:
+  PRETTIFIED_HTML_CACHE_SIZE = 2000
+
+if hasattr(settings, "WOM_RIVER_PERSIST_PRETTIFIED_HTML"):
+  PERSIST_PRETTIFIED_HTML = settings.WOM_RIVER_PERSIST_PRETTIFIED_HTML
+else:
+  PERSIST_PRETTIFIED_HTML = False
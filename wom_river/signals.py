@@ -0,0 +1,35 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Signals sent while collecting news, for the apps built on top of
+wom_river to react to them.
+"""
+
+from django.dispatch import Signal
+
+
+# Sent (with the WebFeed class as sender) within the transaction saving
+# new references collected from a feed, with the following arguments:
+# - feed: the WebFeed the references were collected from
+# - references: the list of references that were saved (newly created
+#   or updated) and linked to the feed's source.
+references_collected = Signal()
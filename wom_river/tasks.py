@@ -19,14 +19,20 @@
 #
 
 import feedparser
-from bs4 import BeautifulSoup
 
 from datetime import datetime, timezone
 from urllib.parse import urlsplit
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+import django
+from requests.exceptions import Timeout
 
 from django.utils.html import strip_tags
 
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import MultipleObjectsReturned
 
@@ -35,8 +41,50 @@ from django.conf import settings
 from wom_pebbles.models import Reference, build_safe_code_from_url
 
 from wom_river.models import WebFeed
+from wom_river.models import PrettifiedDescription
+from wom_river.models import build_collated_reference_url_marker
+from wom_river.signals import references_collected
+from wom_river.metrics import (
+    start_collection_run,
+    record_fetch_sample,
+    finish_collection_run,
+    )
 from wom_river.utils.read_opml import parse_opml
 from wom_river.utils.feed_status import FeedStatus
+from wom_river.utils.concurrent_fetch import fetch_concurrently
+from wom_river.utils.feed_stream import download_feed
+from wom_river.utils.http_client import http_get
+from wom_river.utils.poll_schedule import (
+    POSTING_RATE_SAMPLE_SIZE,
+    FEED_HINT_KEYS,
+    estimate_posting_interval,
+    get_http_hint,
+    get_feed_hint,
+    clamp_interval,
+    )
+from wom_river.utils.html_fragments import (
+    LRUCache,
+    hash_html_fragment,
+    prettify_html_fragment,
+    get_html_fragment_text,
+    )
+from wom_river.settings import (
+    FEED_FETCH_WORKERS,
+    FEED_FETCH_MAX_PER_HOST,
+    FEED_POLL_MIN_INTERVAL,
+    FEED_POLL_MAX_INTERVAL,
+    REFERENCE_SAVE_BATCH_SIZE,
+    FEED_MAX_BYTES,
+    FEED_PARSE_PROCESSES,
+    FEED_FETCH_CONNECT_TIMEOUT,
+    FEED_FETCH_READ_TIMEOUT,
+    FEED_FETCH_TOTAL_TIMEOUT,
+    SLOW_FEED_LATENCY,
+    SLOW_FEED_FETCH_WORKERS,
+    HTML_PARSER,
+    PRETTIFIED_HTML_CACHE_SIZE,
+    PERSIST_PRETTIFIED_HTML,
+    )
 
 from wom_pebbles.models import URL_MAX_LENGTH
 
@@ -44,11 +92,12 @@ from wom_pebbles.tasks import truncate_reference_title
 from wom_pebbles.tasks import sanitize_url
 
 import html
+import hashlib
+import time
 
 import logging
 logger = logging.getLogger(__name__)
 
-WOM_UNSANITIZED_LINK_ENTRY_KEY = "wom_unsanitized_link"
 WOM_NOLINK_ENTRY_SCHEME = "wom-river-nolink"
 
 def UnescapedHTMLFromXMLContent(s):
@@ -99,48 +148,24 @@ def get_date_from_feedparser_entry(entry):
   return datetime(*(updated_date_utc),tzinfo=timezone.utc)
 
 
-def create_reference_from_feedparser_entry(entry,date,previous_ref):
-  """Takes a FeedParser entry and create a reference from it and
-  attributing it the publication date given in argument.
+# A feed entry with all the information needed to build a Reference
+# from it.
+PreparedEntry = namedtuple("PreparedEntry",
+                           "url, date, title, description, info, tags, "
+                           "fingerprint")
 
-  If the corresponding Reference already exists, it must be given as
-  the previous_ref argument, and if previous_ref is None, it will be
-  assumed that there is no matching Rerefence in the db.
 
-  Note: Enforce Dave Winer's recommendation for linkblog:
-  http://scripting.com/2014/04/07/howToDisplayTitlelessFeedItems.html
-  with a little twist: if a feed item has no title we will use the
-  (possibly truncated) description as a title and if there is no
-  description the link will be used. In any case the description of a
-  reference is set even if this description is also used for the
-  title.
-
-  Return a tuple with the unsaved reference and a list of tag names.
+def get_feedparser_entry_fingerprint(entry):
+  """Return a digest of the parts of a feedparser entry that end up in a
+  Reference (title, description and link).
   """
-  url = entry.link
-  info = ""
-  tags = set()
-  if entry.get("tags",None):
-    tags = set([t.term for t in entry.tags])
-  description = UnescapedHTMLFromXMLContent(entry.get("description", ""))
-  if previous_ref is None:
-    # set the title only for new ref (should avoid weird behaviour
-    # from the user point of view)
-    if WOM_UNSANITIZED_LINK_ENTRY_KEY in entry:
-       info = f"<p><i><a href='{entry[WOM_UNSANITIZED_LINK_ENTRY_KEY]}'>URL</a></i></p>"
-    title = truncate_reference_title(
-       strip_tags(UnescapedHTMLFromXMLContent(entry.get("title", "")) \
-                   or strip_tags(description) \
-                   or url))
-    ref = Reference(url=url,title=title)
-  else:
-    ref = previous_ref
-  ref.description = info + description
-  ref.pub_date = date
-  return (ref,tags)
+  content = "\0".join((entry.get("title", ""),
+                       entry.get("description", ""),
+                       entry.get("link", "")))
+  return hashlib.sha1(content.encode("utf-8")).hexdigest()
 
 
-def get_and_patch_link(feed, entry):
+def get_and_patch_link(feed_url, entry):
     """Return the link.
     If no direct link found, try to find a best effort replacement.
     """
@@ -162,23 +187,194 @@ def get_and_patch_link(feed, entry):
     # if they don't then, no point in crafting any URL.
     content_piece = (entry.get("title", "").strip() or entry.get("description", "").strip())[:32]
     if not content_piece:
-      logger.debug(f"Skipping a feed entry that has none of ('title', 'description', 'link'), from {feed.xmlURL}")
+      logger.debug(f"Skipping a feed entry that has none of ('title', 'description', 'link'), from {feed_url}")
       return None
     try:
-      feed_url_split = urlsplit(feed.xmlURL)
+      feed_url_split = urlsplit(feed_url)
       feed_url_split = feed_url_split._replace(scheme=WOM_NOLINK_ENTRY_SCHEME)
       fake_url = f"{feed_url_split.geturl()}#{content_piece}"
       entry.link = fake_url
       return fake_url
     except Exception as e:
-      logger.error(f"Failed to craft a link for entry {entry} from feed {feed.xmlURL} because of exception: {e}")
+      logger.error(f"Failed to craft a link for entry {entry} from feed {feed_url} because of exception: {e}")
     return None
 
 
-def add_new_references_from_parsed_feed(feed, entries, default_date):
+def prepare_feedparser_entry(feed_url, entry):
+  """Extract from a FeedParser entry all the information needed to
+  create or update a Reference.
+
+  Note: Enforce Dave Winer's recommendation for linkblog:
+  http://scripting.com/2014/04/07/howToDisplayTitlelessFeedItems.html
+  with a little twist: if a feed item has no title we will use the
+  (possibly truncated) description as a title and if there is no
+  description the link will be used. In any case the description of a
+  reference is set even if this description is also used for the
+  title.
+
+  Return a PreparedEntry or None if no link could be found or crafted
+  for the entry.
+
+  Note: doesn't touch the db and can then be run in worker processes.
+  """
+  entry_link = get_and_patch_link(feed_url, entry)
+  if not entry_link:
+    logger.debug(f"Skipping a feed entry where no link could be crafted: {entry}")
+    return None
+  info = ""
+  entry_link_sanitized, did_truncate = sanitize_url(entry_link)
+  if did_truncate:
+    logger.warning("Found an url of length %d (>%d) \
+when importing references from feed." % (len(entry_link), URL_MAX_LENGTH))
+    # Save the full url in info to limit the loss of information
+    info = f"<p><i><a href='{entry_link}'>URL</a></i></p>"
+    entry.link = entry_link_sanitized
+  url = entry.link
+  tags = set()
+  if entry.get("tags",None):
+    tags = set([t.term for t in entry.tags])
+  description = UnescapedHTMLFromXMLContent(entry.get("description", ""))
+  title = truncate_reference_title(
+     strip_tags(UnescapedHTMLFromXMLContent(entry.get("title", "")) \
+                 or strip_tags(description) \
+                 or url))
+  return PreparedEntry(url, get_date_from_feedparser_entry(entry),
+                       title, description, info, tags,
+                       get_feedparser_entry_fingerprint(entry))
+
+
+def prepare_feedparser_entries(feed_url, entries):
+  prepared_entries = (prepare_feedparser_entry(feed_url, e) for e in entries)
+  return [e for e in prepared_entries if e is not None]
+
+
+def create_reference_from_prepared_entry(entry, date, previous_ref):
+  """Create a reference from a PreparedEntry attributing it the
+  publication date given in argument.
+
+  If the corresponding Reference already exists, it must be given as
+  the previous_ref argument, and if previous_ref is None, it will be
+  assumed that there is no matching Rerefence in the db.
+
+  Return a tuple with the unsaved reference and a list of tag names.
+  """
+  if previous_ref is None:
+    # set the title only for new ref (should avoid weird behaviour
+    # from the user point of view)
+    ref = Reference(url=entry.url, title=entry.title)
+    ref.description = entry.info + entry.description
+  else:
+    ref = previous_ref
+    ref.description = entry.description
+  ref.pub_date = date
+  ref.content_fingerprint = entry.fingerprint
+  return (ref, entry.tags)
+
+
+def save_references_in_bulk(references, source):
+  """Insert the new references, update the existing ones and link them
+  all to the source, with a fixed number of queries.
+
+  Note: if anything goes wrong, the db must be rolled back by the
+  caller, the references being then left as if never saved.
+  """
+  new_references = []
+  updated_references = []
+  seen = set()
+  for r in references:
+    # a same reference may appear several times in a feed
+    if id(r) in seen:
+      continue
+    seen.add(id(r))
+    if r.pk is None:
+      new_references.append(r)
+    else:
+      updated_references.append(r)
+  try:
+    if new_references:
+      Reference.objects.bulk_create(new_references)
+      if any(r.pk is None for r in new_references):
+        # some db backends can't tell the id of the inserted rows
+        pk_by_url = dict(Reference.objects\
+                         .filter(url__in=[r.url for r in new_references])\
+                         .values_list("url", "pk"))
+        for r in new_references:
+          r.pk = pk_by_url[r.url]
+    if updated_references:
+      Reference.objects.bulk_update(updated_references,
+                                    ["description", "pub_date",
+                                     "content_fingerprint"])
+    ReferenceSource = Reference.sources.through
+    ReferenceSource.objects.bulk_create(
+        [ReferenceSource(from_reference_id=r.pk, to_reference_id=source.pk)
+         for r in new_references + updated_references],
+        ignore_conflicts=True)
+  except Exception:
+    for r in new_references:
+      r.pk = None
+      r._state.adding = True
+    raise
+
+
+def save_references_one_by_one(references_and_tags, source):
+  """Save the references and link them to the source, skipping the
+  ones that can't be saved.
+
+  Return the list of (reference, tags) that were saved.
+  """
+  saved_references = []
+  for r, tags in references_and_tags:
+    try:
+      with transaction.atomic():
+        r.save()
+        r.sources.add(source)
+    except Exception as e:
+      logger.error("Skipping news item %s because of exception: %s."\
+                   % (r.url,e))
+      continue
+    saved_references.append((r, tags))
+  return saved_references
+
+
+def add_new_references_from_parsed_feed(feed, entries, default_date,
+                                        batch_size=REFERENCE_SAVE_BATCH_SIZE):
   """Create and save references from the entries found in a feedparser
   generated list.
 
+  Returns a dictionary mapping the saved references to the tags that are
+  associated to them in the feed.
+  """
+  return add_new_references_from_prepared_entries(
+      feed, prepare_feedparser_entries(feed.xmlURL, entries), default_date,
+      batch_size)
+
+
+def announce_collected_references(feed, references):
+  """Send the references_collected signal for references just saved
+  from a feed.
+
+  A failing receiver is only logged, so that it can't prevent the
+  references from being saved.
+  """
+  if not references:
+    return
+  try:
+    with transaction.atomic():
+      references_collected.send(sender=WebFeed, feed=feed,
+                                references=references)
+  except Exception as e:
+    logger.error("Failed to announce news items collected from %s (%s)."\
+                 % (feed.xmlURL, e))
+
+
+def add_new_references_from_prepared_entries(
+    feed, entries, default_date, batch_size=REFERENCE_SAVE_BATCH_SIZE):
+  """Create and save references from a list of PreparedEntry.
+
+  References are saved by batches of batch_size with bulk queries, and
+  if a batch fails its references are saved one by one so that only the
+  faulty ones are skipped.
+
   Returns a dictionary mapping the saved references to the tags that are
   associated to them in the feed.
   """
@@ -187,27 +383,15 @@ def add_new_references_from_parsed_feed(feed, entries, default_date):
   latest_item_date = feed_last_update_check
   all_references = []
   ref_by_url = {}
-  entries_with_link = []
-  for e in entries:
-    entry_link = get_and_patch_link(feed, e)
-    if not entry_link:
-      logger.debug(f"Skipping a feed entry where no link could be crafted: {e}")
-      continue
-    entry_link_sanitized, did_truncate = sanitize_url(entry_link)
-    if did_truncate:
-      logger.warning("Found an url of length %d (>%d) \
-when importing references from feed." % (len(entry_link), URL_MAX_LENGTH))
-      # Save the full url in info to limit the loss of information
-      e[WOM_UNSANITIZED_LINK_ENTRY_KEY] =  entry_link
-      entry_link = entry_link_sanitized
-      e.link = entry_link
-    entries_with_link.append((e, entry_link))
-  entries_url = [link for e, link in entries_with_link]
+  entries_url = [e.url for e in entries]
   existing_references = list(Reference.objects.filter(url__in=entries_url).all())
   existing_references_by_url = dict([(r.url,r) for r in existing_references])
+  references_from_source = set(common_source.productions\
+                               .filter(url__in=entries_url)\
+                               .values_list("pk", flat=True))
   entries_with_dates = []
-  for e, link in entries_with_link:
-    date = get_date_from_feedparser_entry(e)
+  for e in entries:
+    date = e.date
     # For items that actually have no dates declared in the feed,
     # we'll default their date to the existing reference
     # with the same link (if any):
@@ -219,8 +403,8 @@ when importing references from feed." % (len(entry_link), URL_MAX_LENGTH))
     #   linked content will be ignored for such feed which is fair
     #   for a feed not providing dates.
     if date is None:
-      if link in existing_references_by_url:
-        date = existing_references_by_url[link].pub_date
+      if e.url in existing_references_by_url:
+        date = existing_references_by_url[e.url].pub_date
       else:
         date = default_date
     entries_with_dates.append((e, date))
@@ -230,12 +414,18 @@ when importing references from feed." % (len(entry_link), URL_MAX_LENGTH))
       if d > feed_last_update_check
       ]
   for entry,date in new_entries:
-    entry_link = entry.link
-    previous_ref = existing_references_by_url.get(entry_link,None)
+    previous_ref = existing_references_by_url.get(entry.url,None)
     if previous_ref is None:
       # there may also be duplicate in the current feed list of items
-      previous_ref = ref_by_url.get(entry_link,None)
-    r,tags = create_reference_from_feedparser_entry(entry,date,previous_ref)
+      previous_ref = ref_by_url.get(entry.url,None)
+    elif (previous_ref.content_fingerprint == entry.fingerprint
+          and previous_ref.pk in references_from_source):
+      # Some feeds bump the date of all their items at each build:
+      # don't rewrite (nor announce as new) the unchanged ones.
+      if date > latest_item_date:
+        latest_item_date = date
+      continue
+    r,tags = create_reference_from_prepared_entry(entry,date,previous_ref)
     ref_by_url[r.url] = r
     current_ref_date = r.pub_date
     all_references.append((r,tags))
@@ -244,29 +434,41 @@ when importing references from feed." % (len(entry_link), URL_MAX_LENGTH))
   # save all references at once
   saved_references = []
   with transaction.atomic():
-    for r, tags in all_references:
+    for start in range(0, len(all_references), batch_size):
+      batch = all_references[start:start+batch_size]
       try:
-        r.save()
-        r.sources.add(common_source)
+        with transaction.atomic():
+          save_references_in_bulk([r for r, _ in batch], common_source)
+        saved_batch = batch
       except Exception as e:
-        logger.error("Skipping news item %s because of exception: %s."\
-                     % (r.url,e))
-        continue
-      saved_references.append((r, tags))
+        logger.warning("Saving news items one by one after a failed "\
+                       "bulk save (%s)." % e)
+        saved_batch = save_references_one_by_one(batch, common_source)
+      announce_collected_references(feed, [r for r, _ in saved_batch])
+      saved_references.extend(saved_batch)
   feed.last_update_check = latest_item_date
   feed.save()
   return dict(saved_references)
 
 
+def download_and_parse_feed(feed_url):
+  """Download a feed with the shared HTTP client and parse it with feedparser."""
+  with http_get(feed_url,
+                headers={"Accept": feedparser.http.ACCEPT_HEADER}) as r:
+    response_headers = {k.lower(): v for k, v in r.headers.items()}
+    response_headers.setdefault("content-location", r.url)
+    return feedparser.parse(r.content, response_headers=response_headers)
+
+
 def try_get_feed_title(feed_url):
   """Try to parse and extract a feed url, returns None if anything fails.
   """
   try:
-    d = feedparser.parse(feed_url, agent=settings.USER_AGENT)
+    d = download_and_parse_feed(feed_url)
     return d.feed.get("title", None)
   except Exception as e:
     logger.error("Could not find title for feed at %s because of a parse problem (%s))."\
-                 % (d.feed.source.url,e))
+                 % (feed_url,e))
     return None
 
 
@@ -275,14 +477,14 @@ def try_get_feed_site_url(feed_url):
   Returns None if anything fails.
   """
   try:
-    d = feedparser.parse(feed_url, agent=settings.USER_AGENT)
+    d = download_and_parse_feed(feed_url)
     return (d.feed.get("link", None)
             or d.feed.get("publisher_detail", {}).get("href", None)
             or d.feed.get("author_detail", {}).get("href", None)
             )
   except Exception as e:
     logger.error("Could not find the website associated to the feed at %s because of a parse problem (%s))."\
-                 % (d.feed.source.url,e))
+                 % (feed_url,e))
     return None
 
 
@@ -299,42 +501,296 @@ def get_feedparser_status(feedparser_result):
   return 200
 
 
-def collect_new_references_for_feed(feed):
-  """Get the feed data from its URL and collect the new references into the db.
-  Return a dictionary mapping the new references to a corresponding set of tags.
+# Result of the parsing of a feed: its entries as PreparedEntry, its
+# date and what could help to schedule the next fetch (the response's
+# headers and the feed's own hints).
+ParsedFeed = namedtuple("ParsedFeed", "entries, date, headers, hints")
+
+# Result of the network and parsing part of a feed's collection (with
+# the durations of the download and of the parsing in seconds if known).
+FeedFetchResult = namedtuple("FeedFetchResult",
+                             "parsed_feed, status, actual_href, fetch_date, "
+                             "etag, modified, duration, parse_duration",
+                             defaults=(None, None))
+
+# Weight of the latest download's duration in a feed's fetch latency.
+FETCH_LATENCY_SMOOTHING = 0.3
+
+
+def parse_feed_download(feed_url, download):
+  """Parse the content of a FeedDownload and prepare its entries.
+
+  Raise an exception if the content can't be parsed at all.
+
+  Note: CPU-bound, it doesn't touch the db and its input and output
+  can be pickled so that it can be run in worker processes.
   """
-  logger.debug(f"Parsing feed {feed.xmlURL}")
-  now = datetime.now(timezone.utc)
+  if download.content is None:
+    return ParsedFeed([], None, download.headers, {})
+  response_headers = dict(download.headers)
+  response_headers.setdefault("content-location", download.href)
+  d = feedparser.parse(download.content, response_headers=response_headers)
+  get_feedparser_status(d)
+  hints = {k: d.feed[k] for k in FEED_HINT_KEYS if k in d.feed}
+  return ParsedFeed(prepare_feedparser_entries(feed_url, d.entries),
+                    get_date_from_feedparser_feed(d),
+                    download.headers,
+                    hints)
+
+
+def fetch_feed(feed_url, etag=None, modified=None, stop_date=None,
+               parse=parse_feed_download):
+  """Get the feed data from its URL and parse it.
+
+  If given, the etag and modified validators obtained at a previous
+  fetch are sent to the server which can then answer with a 304 status
+  (and nothing to parse) if the feed didn't change in the meantime.
+
+  The feed is downloaded by chunks and only its first FEED_MAX_BYTES
+  are considered. If stop_date is given, the download also stops once
+  the feed's items (when listed newest first) get older than stop_date.
+
+  The download is aborted if connecting to the server, waiting for a
+  piece of data or getting the whole feed takes longer than the
+  FEED_FETCH_*_TIMEOUT settings.
+
+  The download is then parsed by calling parse(feed_url, download),
+  which is expected to behave like parse_feed_download.
+
+  Return a FeedFetchResult whose status is FeedStatus.STATUS_TIMEOUT
+  if the download timed out or FeedStatus.STATUS_PARSING_EXCEPTION if
+  anything else went wrong (parsed_feed being None in both cases).
+
+  Note: doesn't touch the db and can then be run in worker threads.
+  """
+  fetch_date = datetime.now(timezone.utc)
+  request_headers = {"User-Agent": settings.USER_AGENT,
+                     "Accept": feedparser.http.ACCEPT_HEADER}
+  if etag:
+    request_headers["If-None-Match"] = etag
+  if modified:
+    request_headers["If-Modified-Since"] = modified
+  start_time = time.monotonic()
   try:
-    d = feedparser.parse(feed.xmlURL, agent=settings.USER_AGENT)
-    status = get_feedparser_status(d)
-    actual_href = d.get("href", feed.xmlURL)
+    download = download_feed(feed_url, request_headers, FEED_MAX_BYTES,
+                             stop_date=stop_date,
+                             min_items=POSTING_RATE_SAMPLE_SIZE,
+                             timeout=(FEED_FETCH_CONNECT_TIMEOUT,
+                                      FEED_FETCH_READ_TIMEOUT),
+                             total_timeout=FEED_FETCH_TOTAL_TIMEOUT)
+    duration = time.monotonic() - start_time
+    if download.is_truncated:
+      logger.debug(f"Only read the first {len(download.content)} bytes of feed at {feed_url}")
+    parsed_feed = parse(feed_url, download)
+    parse_duration = time.monotonic() - start_time - duration
+  except Timeout as e:
+    logger.warning("Skipping feed at %s because it timed out (%s)."\
+                   % (feed_url,e))
+    return FeedFetchResult(None, FeedStatus.STATUS_TIMEOUT,
+                           None, fetch_date, None, None,
+                           time.monotonic() - start_time)
   except Exception as e:
     logger.error("Skipping feed at %s because of a parse problem (%s))."\
-                 % (feed.source.url,e))
-    status = FeedStatus.STATUS_PARSING_EXCEPTION
-    actual_href = None
-  feed_status = FeedStatus.check_and_record(feed, status, actual_href, now)
+                 % (feed_url,e))
+    return FeedFetchResult(None, FeedStatus.STATUS_PARSING_EXCEPTION,
+                           None, fetch_date, None, None,
+                           time.monotonic() - start_time)
+  return FeedFetchResult(parsed_feed, download.status, download.href,
+                         fetch_date,
+                         download.headers.get("etag", None),
+                         download.headers.get("last-modified", None),
+                         duration, parse_duration)
+
+
+def fetch_web_feed(feed, parse=parse_feed_download):
+  """Call fetch_feed with the url, validators and last update date of a
+  WebFeed."""
+  return fetch_feed(feed.xmlURL, feed.http_etag, feed.http_last_modified,
+                    feed.last_update_check, parse)
+
+
+def record_http_validators(feed, fetch_result):
+  """Remember the validators of the last fetch for the next conditional
+  fetch of the same feed (validators that can't be stored are just
+  forgotten, which only means that the next fetch won't be conditional).
+
+  Note: calling save() is the caller's responsibility.
+  """
+  max_length = WebFeed._meta.get_field("http_etag").max_length
+  etag = fetch_result.etag or ""
+  modified = fetch_result.modified or ""
+  feed.http_etag = etag if len(etag) <= max_length else ""
+  feed.http_last_modified = modified if len(modified) <= max_length else ""
+
+
+def schedule_next_poll(feed, fetch_result):
+  """Decide when the feed should be polled again after the given fetch.
+
+  The base delay is half the feed's estimated posting interval (or a
+  growing backoff if the feed is failing, or a slowly growing version of
+  the previous delay if the feed didn't change), it is then stretched
+  to respect the hints from the server and the feed, and bounded by
+  FEED_POLL_MIN_INTERVAL and FEED_POLL_MAX_INTERVAL.
+
+  Note: must be called after the feed's status was recorded and
+  calling save() is the caller's responsibility.
+  """
+  now = fetch_result.fetch_date
+  d = fetch_result.parsed_feed
+  interval = None
+  if feed.last_update_failed:
+    # The backoff grows with the duration of the failure.
+    interval = now - feed.latest_update_failure_start_date
+  elif fetch_result.status == FeedStatus.STATUS_NOT_MODIFIED:
+    interval = feed.poll_interval * 1.5
+  elif d is not None:
+    posting_interval = estimate_posting_interval(
+        (e.date for e in d.entries), now)
+    if posting_interval is not None:
+      interval = posting_interval / 2
+  if interval is None:
+    interval = feed.poll_interval
+  if d is not None:
+    hints = [h for h in (get_http_hint(d.headers, now),
+                         get_feed_hint(d.hints))
+             if h is not None]
+    interval = max([interval] + hints)
+  interval = clamp_interval(interval,
+                            FEED_POLL_MIN_INTERVAL, FEED_POLL_MAX_INTERVAL)
+  feed.poll_interval = interval
+  feed.next_poll_at = now + interval
+
+
+def record_fetch_latency(feed, fetch_result):
+  """Update the rolling average of the feed's download durations.
+
+  Note: calling save() is the caller's responsibility.
+  """
+  if fetch_result.duration is None:
+    return
+  feed.fetch_latency = (FETCH_LATENCY_SMOOTHING*fetch_result.duration
+                        + (1-FETCH_LATENCY_SMOOTHING)*feed.fetch_latency)
+
+
+def add_new_references_from_fetched_feed(feed, fetch_result, run=None):
+  """Record the feed's status, collect the new references from the
+  result of fetch_feed into the db and schedule the feed's next poll.
+
+  A metrics sample is also recorded (and accounted for in the given
+  FeedCollectionRun if any).
+
+  Return a dictionary mapping the new references to a corresponding set of tags.
+  """
+  start_time = time.monotonic()
+  new_references = record_fetched_feed(feed, fetch_result)
+  schedule_next_poll(feed, fetch_result)
+  record_fetch_latency(feed, fetch_result)
+  feed.save(update_fields=["poll_interval", "next_poll_at", "fetch_latency"])
+  record_fetch_sample(run, feed, fetch_result,
+                      is_broken=feed.last_update_failed,
+                      db_duration=time.monotonic() - start_time,
+                      num_new_references=len(new_references))
+  return new_references
+
+
+def record_fetched_feed(feed, fetch_result):
+  """Record the feed's status and collect the new references from the
+  result of fetch_feed into the db.
+  """
+  feed_status = FeedStatus.check_and_record(feed,
+                                            fetch_result.status,
+                                            fetch_result.actual_href,
+                                            fetch_result.fetch_date)
   if feed_status.is_broken:
       logger.warning(f"Feed at {feed.xmlURL} currently appears broken ({feed_status.diagnostic}).")
       return []
-  default_date = get_date_from_feedparser_feed(d) or now
-  return add_new_references_from_parsed_feed(feed, d.entries, default_date)
+  if fetch_result.status == FeedStatus.STATUS_NOT_MODIFIED:
+    logger.debug(f"Feed at {feed.xmlURL} not modified since last update.")
+    return {}
+  record_http_validators(feed, fetch_result)
+  parsed_feed = fetch_result.parsed_feed
+  default_date = parsed_feed.date or fetch_result.fetch_date
+  return add_new_references_from_prepared_entries(feed, parsed_feed.entries,
+                                                  default_date)
+
+
+def collect_new_references_for_feed(feed):
+  """Get the feed data from its URL and collect the new references into the db.
+  Return a dictionary mapping the new references to a corresponding set of tags.
+  """
+  logger.debug(f"Parsing feed {feed.xmlURL}")
+  return add_new_references_from_fetched_feed(feed, fetch_web_feed(feed))
+
 
+def parse_feed_download_in_pool(pool, feed_url, download):
+  return pool.submit(parse_feed_download, feed_url, download).result()
 
-def collect_news_from_feeds(feeds):
+
+def collect_news_from_feeds(feeds,
+                            num_workers=FEED_FETCH_WORKERS,
+                            max_per_host=FEED_FETCH_MAX_PER_HOST,
+                            num_parse_processes=FEED_PARSE_PROCESSES,
+                            lane=""):
   """Fetch and parse all given feeds to collect new items and fill the db of
   References with them.
+
+  Up to num_workers feeds are downloaded at the same time (with at most
+  max_per_host of them from a same host) while the new items are saved
+  in the db as soon as each feed is available.
+
+  If num_parse_processes is positive, the feeds are parsed in a pool of
+  as many processes instead of the downloading threads, so that parsing
+  can use several cores.
+
+  Metrics about the whole collection are recorded under the given lane
+  name.
+  """
+  start_time = time.monotonic()
+  run = start_collection_run(lane)
+  fetch_stats = {}
+  parse_pool = None
+  parse = parse_feed_download
+  if num_parse_processes > 0:
+    parse_pool = ProcessPoolExecutor(max_workers=num_parse_processes,
+                                     mp_context=get_context("spawn"),
+                                     initializer=django.setup)
+    parse = partial(parse_feed_download_in_pool, parse_pool)
+  try:
+    fetched_feeds = fetch_concurrently(feeds,
+                                       partial(fetch_web_feed, parse=parse),
+                                       lambda feed: feed.xmlURL,
+                                       num_workers,
+                                       max_per_host,
+                                       fetch_stats)
+    for feed, fetch_result in fetched_feeds:
+      logger.debug(f"Collecting news from feed {feed.xmlURL}")
+      add_new_references_from_fetched_feed(feed, fetch_result, run)
+  finally:
+    if parse_pool is not None:
+      parse_pool.shutdown()
+  finish_collection_run(run, time.monotonic() - start_time,
+                        fetch_stats.get("max_queue_depth", 0))
+
+def collect_news_from_feeds_by_lanes(feeds):
+  """Collect news from a queryset of feeds, the feeds that are usually
+  slow to download being collected after the others and with fewer
+  workers so that they don't delay the collection of the others.
   """
-  for feed in feeds:
-    collect_new_references_for_feed(feed)
+  collect_news_from_feeds(
+      feeds.filter(fetch_latency__lt=SLOW_FEED_LATENCY).iterator(),
+      lane="fast")
+  collect_news_from_feeds(
+      feeds.filter(fetch_latency__gte=SLOW_FEED_LATENCY).iterator(),
+      num_workers=SLOW_FEED_FETCH_WORKERS,
+      lane="slow")
+
 
 def collect_news_from_all_feeds():
   """Fetch and parse all feeds to collect new items and fill the db of
   References with them.
   """
-  feeds = WebFeed.objects.exclude(permanent_failure_detected=True).iterator()
-  collect_news_from_feeds(feeds)
+  collect_news_from_feeds_by_lanes(
+      WebFeed.objects.exclude(permanent_failure_detected=True))
 
 
 def import_feedsources_from_opml(opml_txt):
@@ -374,26 +830,77 @@ def import_feedsources_from_opml(opml_txt):
   return dict(feeds_and_tags)
 
 
+# Prettified descriptions of the references, keyed by reference id and
+# description hash.
+PRETTIFIED_HTML_CACHE = LRUCache(PRETTIFIED_HTML_CACHE_SIZE)
+
+
+def prettify_description(ref):
+  # Due to the accumulation of possibly flacky content, it's better
+  # to prettify piece by piece (it did happen that prettifying the
+  # whole collation in one go broke beautifulsoup in the case when
+  # each description only contained a <p> without ever closing it.)
+  try:
+    return prettify_html_fragment(ref.description, HTML_PARSER)
+  except Exception as e:
+    # In some rare cases the prettifier fails, then we take just the
+    # text.  Note: such a case occured but was not reproducible on
+    # just any setup, meaning that it may relate to the version of
+    # python+bs available.
+    logger.warning(
+        f"Description prettification failed on {ref.url} with {e}")
+    return get_html_fragment_text(ref.description, HTML_PARSER)
+
+
+def get_prettified_descriptions(references):
+  """Return the list of the references' prettified descriptions, only
+  parsing the ones that are neither in the process' cache nor (with
+  PERSIST_PRETTIFIED_HTML) in the db."""
+  keys = [(ref.pk, hash_html_fragment(ref.description))
+          if ref.pk is not None else None
+          for ref in references]
+  descriptions = [PRETTIFIED_HTML_CACHE.get(key) if key is not None else None
+                  for key in keys]
+  missing = {key for key, d in zip(keys, descriptions)
+             if d is None and key is not None}
+  persisted = {}
+  if PERSIST_PRETTIFIED_HTML and missing:
+    for pd in PrettifiedDescription.objects\
+                                   .filter(reference_id__in=[pk for pk, _ in missing]):
+      key = (pd.reference_id, pd.description_hash)
+      if key in missing:
+        persisted[key] = pd.html
+  new_descriptions = {}
+  for i, (ref, key) in enumerate(zip(references, keys)):
+    if descriptions[i] is not None:
+      continue
+    if key in persisted:
+      descriptions[i] = persisted[key]
+    else:
+      descriptions[i] = prettify_description(ref)
+      if key is not None:
+        new_descriptions[key] = descriptions[i]
+    if key is not None:
+      PRETTIFIED_HTML_CACHE.set(key, descriptions[i])
+  if PERSIST_PRETTIFIED_HTML and new_descriptions:
+    with transaction.atomic():
+      PrettifiedDescription.objects\
+                           .filter(reference_id__in=[pk for pk, _ in new_descriptions])\
+                           .delete()
+      # Another worker may have persisted the same descriptions meanwhile
+      # (and a row left with an outdated hash is just parsed again).
+      PrettifiedDescription.objects.bulk_create(
+        [PrettifiedDescription(reference_id=pk, description_hash=h, html=html)
+         for (pk, h), html in new_descriptions.items()],
+        ignore_conflicts=True)
+  return descriptions
+
+
 def generate_collated_content(references):
   doc_lines = []
-  for ref in references:
+  for ref, description in zip(references, get_prettified_descriptions(references)):
     doc_lines.append(f"<h2><a href='{ref.url}'>{ref.title}</a></h2>")
-    # Due to the accumulation of possibly flacky content, it's better
-    # to prettify piece by piece (it did happen that prettifying the
-    # whole collation in one go broke beautifulsoup in the case when
-    # each description only contained a <p> without ever closing it.)
-    soup = BeautifulSoup(ref.description, 'html.parser')
-    try:
-      doc_lines.append(soup.prettify())
-    except Exception as e:
-      # In some rare cases the prettifier fails, then we take just the
-      # text.  Note: such a case occured but was not reproducible on
-      # just any setup, meaning that it may relate to the version of
-      # python+bs available.
-      logger.warning(
-          f"Description prettification failed on {ref.url} with {e}")
-      soup2 = BeautifulSoup(ref.description, 'html.parser')
-      doc_lines.append(soup2.text)
+    doc_lines.append(description)
     doc_lines.append("<br/>")
   return "\n".join(doc_lines)
 
@@ -412,10 +919,45 @@ def format_date_extent(delta):
   return f"{displayed_minutes}min"
 
 
+def build_collated_reference_url(url_parent_path, feed, pub_date,
+                                 earliest_pub_date):
+  # NOTE: the feed's code in the url is what tells the collated
+  # references apart from the feed's items (see
+  # build_collated_reference_url_marker)
+  feed_url_code = build_safe_code_from_url(feed.xmlURL)
+  return "{}/{}/{}/{}/{}".format(
+      url_parent_path.rstrip("/"),
+      feed.source.url.rstrip("/"),
+      feed_url_code,
+      int((pub_date
+           - datetime.fromtimestamp(0, timezone.utc))
+          .total_seconds()),
+      int((earliest_pub_date
+           - datetime.fromtimestamp(0, timezone.utc))
+          .total_seconds())
+          )
+
+
+def create_collated_reference(url, feed, references, pub_date, date_extent):
+  description = generate_collated_content(references)
+  date_extent_str = format_date_extent(date_extent)
+  t = f"{feed.source.title} /{date_extent_str}"
+  r = Reference(url=url,
+                title=t,
+                pub_date=pub_date,
+                description=description)
+  r.save()
+  r.sources.add(feed.source)
+  return r
+
+
 def yield_collated_reference(url_parent_path, feed, feed_collation,
                              min_num_ref_target, max_num_ref_target,
-                             timeout, processing_date):
-  references = list(feed_collation.references.order_by('pub_date').all())
+                             timeout, processing_date,
+                             eligible_reference_ids=None):
+  references = [r for r in feed_collation.references
+                if eligible_reference_ids is None
+                or r.pk in eligible_reference_ids]
   num_refs = len(references)
   if num_refs == 0:
     return
@@ -435,34 +977,14 @@ def yield_collated_reference(url_parent_path, feed, feed_collation,
   young_enough = age < 1.5*timeout
   if too_few_refs and young_enough and num_refs_below_cap:
     return
-  source = feed.source
-  source_url_code = source.url
-  feed_url_code = build_safe_code_from_url(feed.xmlURL)
-  pub_date = processing_date
-  url = "{}/{}/{}/{}/{}".format(
-      url_parent_path.rstrip("/"),
-      source_url_code.rstrip("/"),
-      feed_url_code,
-      int((pub_date
-           - datetime.fromtimestamp(0, timezone.utc))
-          .total_seconds()),
-      int((earliest_pub_date
-           - datetime.fromtimestamp(0, timezone.utc))
-          .total_seconds())
-          )
+  url = build_collated_reference_url(url_parent_path, feed,
+                                     processing_date, earliest_pub_date)
   same_refs = Reference.objects.filter(url=url).all()
   if same_refs:
     logger.warning(f"Skipped duplicated collated reference for {url}")
     return
-  description = generate_collated_content(processed_references)
-  date_extent_str = format_date_extent(date_extent)
-  t = f"{source.title} /{date_extent_str}"
-  r = Reference(url=url,
-                title=t,
-                pub_date=pub_date,
-                description=description)
-  r.save()
-  r.sources.add(source)
+  r = create_collated_reference(url, feed, processed_references,
+                                processing_date, date_extent)
   feed_collation.flush(processing_date)
   feed_collation.save()
   yield r
@@ -473,12 +995,88 @@ def generate_collations(url_parent_path,
                         feed, feed_collation, feed_references,
                         min_num_ref_target, max_num_ref_target,
                         timeout, processing_date):
+  """Take the given references in the collation and yield the collated
+  references built along the way.
+
+  Only the buffered references that are among feed_references are
+  collated, the other ones having been left out by the caller (eg
+  because the user already knows them).
+  """
+  feed_references = list(feed_references)
+  eligible_reference_ids = {ref.pk for ref in feed_references}
   for ref in feed_references:
     yield from yield_collated_reference(url_parent_path, feed, feed_collation,
                                         min_num_ref_target, max_num_ref_target,
-                                        timeout, processing_date)
+                                        timeout, processing_date,
+                                        eligible_reference_ids)
     feed_collation.take(ref)
   else:
     yield from yield_collated_reference(url_parent_path, feed, feed_collation,
                                         min_num_ref_target, max_num_ref_target,
-                                        timeout, processing_date)
+                                        timeout, processing_date,
+                                        eligible_reference_ids)
+  feed_collation.save()
+
+
+def get_collation_window_start(date, window):
+  """Return the start of the time window of the given duration holding
+  date (windows being aligned on the epoch)."""
+  epoch = datetime.fromtimestamp(0, timezone.utc)
+  return epoch + ((date - epoch) // window) * window
+
+
+def get_or_create_shared_collated_reference(url, feed, references,
+                                            window_start, window_end):
+  try:
+    return Reference.objects.get(url=url)
+  except ObjectDoesNotExist:
+    pass
+  try:
+    with transaction.atomic():
+      return create_collated_reference(url, feed, references, window_end,
+                                       window_end - window_start)
+  except IntegrityError:
+    # Created meanwhile for another user
+    return Reference.objects.get(url=url)
+
+
+def generate_shared_collations(url_parent_path, feed, feed_collation,
+                               window, max_num_ref_target, processing_date):
+  """Yield one collated reference for each time window (of the given
+  duration) that ended and in which the feed published some items
+  since the collation was last flushed.
+
+  The collated references only depend on the feed, on the time window
+  and on the items they hold, so that they are built once and shared by
+  all the collations of the feed that use the same url_parent_path,
+  each collation just keeping track of the latest item it has seen.
+  Items collected after their window was collated are then gathered in
+  an extra collated reference for that window.
+
+  Being shared, the collated references hold all the window's items,
+  including the ones that a given user may already know.
+
+  Note: there is no minimum number of items to wait for (as in
+  generate_collations), the windows being fixed to be shared.
+  """
+  end = get_collation_window_start(processing_date, window)
+  references = list(feed_collation.get_references_published_before(end))
+  if not references:
+    return
+  references_by_window = defaultdict(list)
+  for ref in references:
+    references_by_window[get_collation_window_start(ref.pub_date, window)].append(ref)
+  for window_start, window_references in sorted(references_by_window.items()):
+    num_refs = len(window_references)
+    if max_num_ref_target < num_refs:
+      logger.warning(f"Collated references list cropped from {num_refs} to {max_num_ref_target}")
+      window_references = window_references[:max_num_ref_target]
+    url = build_collated_reference_url(url_parent_path, feed,
+                                       window_references[-1].pub_date,
+                                       window_references[0].pub_date)
+    yield get_or_create_shared_collated_reference(
+        url, feed, window_references, window_start, window_start + window)
+  feed_collation.latest_reference_taken = max(feed_collation.latest_reference_taken,
+                                              references[-1].pub_date)
+  feed_collation.flush(processing_date)
+  feed_collation.save()
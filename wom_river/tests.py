@@ -20,27 +20,71 @@
 
 from datetime import datetime, timedelta, timezone
 
+import threading
+from importlib.util import find_spec
+from io import StringIO
+from unittest import skipUnless
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 import feedparser
+from bs4 import BeautifulSoup
+import mock
+import requests
+from urllib3.exceptions import ReadTimeoutError
+from requests.structures import CaseInsensitiveDict
 
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 
-from wom_pebbles.models import Reference
+from wom_pebbles.models import Reference, build_safe_code_from_url
 
 from wom_river.models import (
     WebFeed,
     URL_MAX_LENGTH,
-    WebFeedCollation
+    WebFeedCollation,
+    DEFAULT_FLUSHED_PUB_DATE,
+    FeedCollectionRun,
+    FeedFetchSample,
+    PrettifiedDescription,
     )
+from wom_river.metrics import format_prometheus_metrics
 
 from wom_river.tasks import (
     import_feedsources_from_opml,
     add_new_references_from_parsed_feed,
     generate_collated_content,
+    PRETTIFIED_HTML_CACHE,
     yield_collated_reference,
     generate_collations,
+    generate_shared_collations,
+    collect_news_from_feeds,
+    collect_new_references_for_feed,
+    schedule_next_poll,
+    FeedFetchResult,
+    ParsedFeed,
+    PreparedEntry,
+    fetch_feed,
+    record_fetch_latency,
     )
 
 from wom_river.utils.feed_status import FeedStatus
+from wom_river.utils.concurrent_fetch import fetch_concurrently
+from wom_river.utils.feed_stream import download_feed, TotalTimeout
+from wom_river.utils.http_client import build_session
+from wom_river.utils.html_fragments import LRUCache, prettify_html_fragment
+from wom_river.utils.poll_schedule import (
+    estimate_posting_interval,
+    get_http_hint,
+    get_feed_hint,
+    )
+from wom_river.settings import (
+    FEED_POLL_MIN_INTERVAL,
+    FEED_POLL_MAX_INTERVAL,
+    METRICS_RETENTION,
+    )
 
 from django.contrib.auth.models import User
 
@@ -431,6 +475,139 @@ class AddReferencesFromFeedParserTaskOnBrokenFeedTest(TestCase):
     self.assertEqual(first_dates, new_dates)
 
 
+class AddReferencesInBulkTest(TestCase):
+
+  ITEM_TEMPLATE = """\
+    <item>
+      <title>Item {i}</title>
+      <link>http://mouf/{i}</link>
+      <description>Item {i} description</description>
+      <pubDate>Sun, 17 Nov 2013 16:{i:02d}:06 GMT</pubDate>
+    </item>
+"""
+
+  def setUp(self):
+    self.date = datetime(2013, 11, 17, 0, 0, tzinfo=timezone.utc)
+    self.source = Reference.objects.create(url="http://mouf",
+                                           title="mouf",
+                                           pub_date=self.date)
+    self.web_feed = WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                                           last_update_check=self.date,
+                                           source=self.source)
+    items = "".join(self.ITEM_TEMPLATE.format(i=i) for i in range(50))
+    self.entries = feedparser.parse(
+        f"<rss version=\"2.0\"><channel>{items}</channel></rss>").entries
+
+  def test_number_of_queries_does_not_depend_on_number_of_entries(self):
+    with CaptureQueriesContext(connection) as queries:
+      refs = add_new_references_from_parsed_feed(self.web_feed, self.entries,
+                                                 None, batch_size=100)
+    self.assertEqual(50, len(refs))
+    self.assertLess(len(queries), 15)
+    self.assertEqual(50, self.source.productions.count())
+
+  def test_existing_references_are_updated_and_linked_to_source(self):
+    Reference.objects.create(url="http://mouf/3", title="Old title",
+                             description="Old description",
+                             pub_date=self.date)
+    add_new_references_from_parsed_feed(self.web_feed, self.entries,
+                                        None, batch_size=20)
+    self.assertEqual(51, Reference.objects.count())
+    ref = Reference.objects.get(url="http://mouf/3")
+    self.assertEqual("Old title", ref.title)
+    self.assertEqual("Item 3 description", ref.description)
+    self.assertIn(self.source, ref.sources.all())
+    self.assertEqual(50, self.source.productions.count())
+
+  def test_failed_batch_is_saved_one_by_one_skipping_faulty_entries(self):
+    original_save = Reference.save
+    def failing_save(ref, *args, **kwargs):
+      if ref.url == "http://mouf/7":
+        raise ValueError("faulty entry")
+      return original_save(ref, *args, **kwargs)
+    with mock.patch("wom_river.tasks.save_references_in_bulk",
+                    side_effect=ValueError("failed batch")),\
+         mock.patch.object(Reference, "save", autospec=True,
+                           side_effect=failing_save):
+      refs = add_new_references_from_parsed_feed(self.web_feed, self.entries,
+                                                 None, batch_size=20)
+    self.assertEqual(49, len(refs))
+    self.assertFalse(Reference.objects.filter(url="http://mouf/7").exists())
+    self.assertEqual(49, self.source.productions.count())
+
+  def test_failure_after_bulk_insert_falls_back_to_one_by_one(self):
+    with mock.patch("wom_river.tasks.Reference.sources.through.objects.bulk_create",
+                    side_effect=ValueError("failed link")):
+      refs = add_new_references_from_parsed_feed(self.web_feed, self.entries,
+                                                 None, batch_size=100)
+    # the references inserted before the failure were rolled back and
+    # are inserted again one by one.
+    self.assertEqual(50, len(refs))
+    self.assertEqual(51, Reference.objects.count())
+    self.assertEqual(50, self.source.productions.count())
+
+
+class ContentFingerprintTest(TestCase):
+
+  RSS_TEMPLATE = """\
+<rss version="2.0"><channel>
+    <item>
+      <title>Item</title>
+      <link>http://mouf/item</link>
+      <description>{description}</description>
+      <pubDate>{date}</pubDate>
+    </item>
+</channel></rss>
+"""
+
+  def setUp(self):
+    self.date = datetime(2013, 11, 17, 0, 0, tzinfo=timezone.utc)
+    self.source = Reference.objects.create(url="http://mouf",
+                                           title="mouf",
+                                           pub_date=self.date)
+    self.web_feed = WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                                           last_update_check=self.date,
+                                           source=self.source)
+
+  def add_from_feed(self, description, date):
+    entries = feedparser.parse(
+        self.RSS_TEMPLATE.format(description=description, date=date)).entries
+    return add_new_references_from_parsed_feed(self.web_feed, entries, None)
+
+  def test_unchanged_item_with_bumped_date_is_skipped(self):
+    self.add_from_feed("Same", "Sun, 17 Nov 2013 16:56:06 GMT")
+    first_pub_date = Reference.objects.get(url="http://mouf/item").pub_date
+    with CaptureQueriesContext(connection) as queries:
+      refs = self.add_from_feed("Same", "Mon, 18 Nov 2013 16:56:06 GMT")
+    self.assertEqual(0, len(refs))
+    self.assertFalse(any(q["sql"].startswith("UPDATE \"wom_pebbles_reference\"")
+                         for q in queries.captured_queries))
+    self.assertEqual(first_pub_date,
+                     Reference.objects.get(url="http://mouf/item").pub_date)
+    self.assertEqual(datetime(2013, 11, 18, 16, 56, 6, tzinfo=timezone.utc),
+                     WebFeed.objects.get(pk=self.web_feed.pk).last_update_check)
+
+  def test_changed_item_is_updated(self):
+    self.add_from_feed("Before", "Sun, 17 Nov 2013 16:56:06 GMT")
+    refs = self.add_from_feed("After", "Mon, 18 Nov 2013 16:56:06 GMT")
+    self.assertEqual(1, len(refs))
+    self.assertEqual("After",
+                     Reference.objects.get(url="http://mouf/item").description)
+
+  def test_same_item_from_another_source_is_linked(self):
+    self.add_from_feed("Same", "Sun, 17 Nov 2013 16:56:06 GMT")
+    other_source = Reference.objects.create(url="http://other",
+                                            title="other",
+                                            pub_date=self.date)
+    self.web_feed = WebFeed.objects.create(xmlURL="http://other/rss.xml",
+                                           last_update_check=self.date,
+                                           source=other_source)
+    refs = self.add_from_feed("Same", "Sun, 17 Nov 2013 16:56:06 GMT")
+    self.assertEqual(1, len(refs))
+    self.assertEqual(2, Reference.objects.get(url="http://mouf/item")\
+                     .sources.count())
+
+
 class WebFeedCollationModelTest(TestCase):
 
   def setUp(self):
@@ -458,6 +635,7 @@ class WebFeedCollationModelTest(TestCase):
     date = self.date + timedelta(days=1)
     r = Reference.objects.create(url="http://mouf/1",
                                  pub_date=date)
+    r.sources.add(self.source)
     self.collation.take(r)
     taken_refs = list(self.collation.references.all())
     self.assertEqual(1, len(taken_refs))
@@ -467,6 +645,7 @@ class WebFeedCollationModelTest(TestCase):
     date = self.date + timedelta(days=1)
     r = Reference.objects.create(url="http://mouf/1",
                                  pub_date=date)
+    r.sources.add(self.source)
     self.collation.take(r)
     # Take date in the reference's past to be sure the
     # completion date is not taken into account
@@ -475,6 +654,7 @@ class WebFeedCollationModelTest(TestCase):
     self.assertEqual(0, len(self.collation.references.all()))
     r2 = Reference.objects.create(url="http://mouf/2",
                                   pub_date=date)
+    r2.sources.add(self.source)
     self.collation.take(r2)
     self.assertEqual(0, len(self.collation.references.all()))
 
@@ -482,6 +662,7 @@ class WebFeedCollationModelTest(TestCase):
     date = self.date + timedelta(days=1)
     r = Reference.objects.create(url="http://mouf/1",
                                  pub_date=date)
+    r.sources.add(self.source)
     self.collation.take(r)
     completion_date = date + timedelta(days=1)
     self.collation.flush(completion_date)
@@ -490,6 +671,30 @@ class WebFeedCollationModelTest(TestCase):
     self.assertEqual(date, self.collation.latest_reference_flushed)
 
 
+  def test_take_and_flush_run_no_query(self):
+    date = self.date + timedelta(days=1)
+    r = Reference.objects.create(url="http://mouf/1",
+                                 pub_date=date)
+    r.sources.add(self.source)
+    with CaptureQueriesContext(connection) as queries:
+      self.collation.take(r)
+      self.collation.flush(date)
+    self.assertEqual(0, len(queries.captured_queries))
+
+  def test_references_exclude_collated_references(self):
+    date = self.date + timedelta(days=1)
+    r = Reference.objects.create(url="http://mouf/1",
+                                 pub_date=date)
+    collated = Reference.objects.create(
+        url="wom-tests:/c/http://mouf/{}/1/1".format(
+            build_safe_code_from_url(self.feed.xmlURL)),
+        pub_date=date)
+    for ref in (r, collated):
+      ref.sources.add(self.source)
+      self.collation.take(ref)
+    self.assertEqual([r], list(self.collation.references))
+
+
 def remove_whitespaces(s):
   return "".join(s.split())
 
@@ -524,6 +729,81 @@ class GenerateCollatedContentTaskTest(TestCase):
                      remove_whitespaces(res))
 
 
+class PrettifiedDescriptionCacheTest(TestCase):
+
+  def setUp(self):
+    PRETTIFIED_HTML_CACHE.clear()
+    date = datetime.now(timezone.utc)
+    self.references = [
+      Reference.objects.create(url=f"http://mouf/{i}",
+                               title=f"Hop {i}",
+                               description=f"<p>glop <b>{i}</b>",
+                               pub_date=date)
+      for i in range(5)]
+
+  def tearDown(self):
+    PRETTIFIED_HTML_CACHE.clear()
+
+  def generate_counting_parses(self):
+    with mock.patch("wom_river.utils.html_fragments.BeautifulSoup",
+                    wraps=BeautifulSoup) as soup:
+      content = generate_collated_content(self.references)
+    return content, soup.call_count
+
+  def test_descriptions_are_parsed_once(self):
+    content, num_parses = self.generate_counting_parses()
+    self.assertEqual(5, num_parses)
+    self.assertEqual((content, 0), self.generate_counting_parses())
+
+  def test_changed_description_is_parsed_again(self):
+    content, _ = self.generate_counting_parses()
+    self.references[0].description = "<p>changed"
+    new_content, num_parses = self.generate_counting_parses()
+    self.assertEqual(1, num_parses)
+    self.assertIn("changed", new_content)
+
+  def test_persisted_descriptions_are_not_parsed_again(self):
+    with mock.patch("wom_river.tasks.PERSIST_PRETTIFIED_HTML", True):
+      content, _ = self.generate_counting_parses()
+      self.assertEqual(5, PrettifiedDescription.objects.count())
+      PRETTIFIED_HTML_CACHE.clear()
+      self.assertEqual((content, 0), self.generate_counting_parses())
+
+  def test_concurrently_persisted_descriptions_are_kept(self):
+    bulk_create = PrettifiedDescription.objects.bulk_create
+    def racing_bulk_create(descriptions, **kwargs):
+      descriptions = list(descriptions)
+      # another worker persists the same description first
+      PrettifiedDescription.objects.create(
+        reference_id=descriptions[0].reference_id,
+        description_hash=descriptions[0].description_hash,
+        html=descriptions[0].html)
+      return bulk_create(descriptions, **kwargs)
+    with mock.patch("wom_river.tasks.PERSIST_PRETTIFIED_HTML", True), \
+         mock.patch.object(PrettifiedDescription.objects, "bulk_create",
+                           side_effect=racing_bulk_create):
+      content, _ = self.generate_counting_parses()
+    self.assertIn("glop", content)
+    self.assertEqual(5, PrettifiedDescription.objects.count())
+
+  @skipUnless(find_spec("lxml"), "lxml is not installed")
+  def test_lxml_parser_keeps_a_fragment(self):
+    html = prettify_html_fragment("<p>glop <b>1</b><p>pas", "lxml")
+    self.assertNotIn("<html>", html)
+    self.assertNotIn("<body>", html)
+    self.assertEqual(2, html.count("</p>"))
+
+  def test_lru_cache_forgets_least_recently_used_items(self):
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    self.assertEqual(1, cache.get("a"))
+    cache.set("c", 3)
+    self.assertEqual(2, len(cache))
+    self.assertIsNone(cache.get("b"))
+    self.assertEqual(1, cache.get("a"))
+
+
 class YieldCollatedReferencesTaskTest(TestCase):
 
   def setUp(self):
@@ -543,6 +823,10 @@ class YieldCollatedReferencesTaskTest(TestCase):
     self.max_num_ref_target = 20
     self.timeout = timedelta(days=2)
 
+  def _take(self, r):
+    r.sources.add(self.source)
+    self.collation.take(r)
+
   def _add_reference_1(self):
     title1 = "Hop 1"
     url1 = "http://mouf/1"
@@ -557,7 +841,7 @@ class YieldCollatedReferencesTaskTest(TestCase):
 <h2><a href='{url1}'>{title1}</a></h2>
 {desc1}
 <br/>"""
-    self.collation.references.add(r1)
+    self._take(r1)
     return r1
 
   def _add_reference_2(self):
@@ -574,7 +858,7 @@ class YieldCollatedReferencesTaskTest(TestCase):
 <h2><a href='{url2}'>{title2}</a></h2>
 {desc2}
 <br/>"""
-    self.collation.references.add(r2)
+    self._take(r2)
     return r2
 
   def test_given_empty_collation_yields_empty_results(self):
@@ -682,7 +966,8 @@ class YieldCollatedReferencesTaskTest(TestCase):
     self.assertEqual(1, len(res))
     # Cheating a bit to force processing of the collation with a same processing_date.
     self.collation.last_completed_collation_date = last_completion_date
-    self.collation.references.add(r1)
+    self.collation.latest_reference_flushed = DEFAULT_FLUSHED_PUB_DATE
+    self._take(r1)
     res = list(yield_collated_reference(self.parent_path,
                                         self.feed,
                                         self.collation,
@@ -706,7 +991,10 @@ class YieldCollatedReferencesTaskTest(TestCase):
                                         timeout,
                                         processing_date))
     self.assertEqual(1, len(res))
-    self.collation.references.add(r1)
+    r3 = Reference.objects.create(url="http://mouf/3",
+                                  title="Hip 3",
+                                  pub_date=datetime.fromtimestamp(30, timezone.utc))
+    self._take(r3)
     processing_date = processing_date + timeout + timedelta(days=1)
     res = list(yield_collated_reference(self.parent_path,
                                         self.feed,
@@ -740,7 +1028,7 @@ class YieldCollatedReferencesTaskTest(TestCase):
                                     title=title,
                                     description=desc,
                                     pub_date=date)
-        self.collation.references.add(r)
+        self._take(r)
     res = list(yield_collated_reference(self.parent_path,
                                         self.feed,
                                         self.collation,
@@ -770,6 +1058,7 @@ class GenerateCollationsTaskTest(TestCase):
     self.timeout = timedelta(days=2)
     self.r1 = self._add_reference_1()
     self.r2 = self._add_reference_2()
+    self.source.productions.add(self.r1, self.r2)
 
   def _add_reference_1(self):
     title1 = "Hop 1"
@@ -867,6 +1156,107 @@ class GenerateCollationsTaskTest(TestCase):
                                    processing_date))
     self.assertEqual(1, len(res))
 
+  def test_collation_leaves_out_references_not_taken(self):
+    last_completion_date = self.collation.last_completed_collation_date
+    timeout = timedelta(days=15)
+    processing_date = last_completion_date + timeout + timedelta(days=1)
+    res = list(generate_collations(self.parent_path,
+                                   self.feed,
+                                   self.collation,
+                                   [self.r2],
+                                   1,
+                                   10,
+                                   timeout,
+                                   processing_date))
+    self.assertEqual(1, len(res))
+    self.assertIn(self.r2.title, res[0].description)
+    self.assertNotIn(self.r1.title, res[0].description)
+
+
+class GenerateSharedCollationsTaskTest(TestCase):
+
+  def setUp(self):
+    self.window = timedelta(days=1)
+    self.date = datetime(2020, 1, 10, tzinfo=timezone.utc)
+    self.source = Reference.objects.create(
+        url="http://mouf",
+        title="mouf",
+        pub_date=self.date)
+    self.parent_path = "wom-tests:/shared"
+    self.feed = WebFeed.objects.create(
+        xmlURL="http://mouf/bla.xml",
+        last_update_check=self.date,
+        source=self.source)
+    self.collations = [
+      WebFeedCollation.objects.create(
+        feed=self.feed,
+        last_completed_collation_date=self.date - 3*self.window)
+      for _ in range(2)]
+    # 2 items in each of the last 2 days and one for the current day
+    for i, hours in enumerate((-40, -30, -20, -10, 2)):
+      r = Reference.objects.create(url=f"http://mouf/{i}",
+                                   title=f"item {i}",
+                                   pub_date=self.date + timedelta(hours=hours))
+      r.sources.add(self.source)
+
+  def generate(self, collation, processing_date):
+    return list(generate_shared_collations(self.parent_path, self.feed,
+                                           collation, self.window, 10,
+                                           processing_date))
+
+  def test_one_collated_reference_per_ended_window(self):
+    processing_date = self.date + timedelta(hours=5)
+    refs = self.generate(self.collations[0], processing_date)
+    self.assertEqual([self.date - self.window, self.date],
+                     [r.pub_date for r in refs])
+    self.assertIn("item 0", refs[0].description)
+    self.assertIn("item 1", refs[0].description)
+    self.assertIn("item 3", refs[1].description)
+    self.assertEqual(0, len(self.generate(self.collations[0], processing_date)))
+
+  def test_collated_references_are_shared(self):
+    processing_date = self.date + timedelta(hours=5)
+    refs = self.generate(self.collations[0], processing_date)
+    num_references = Reference.objects.count()
+    with mock.patch("wom_river.tasks.generate_collated_content") as generate_content:
+      other_refs = self.generate(self.collations[1], processing_date)
+    self.assertEqual(refs, other_refs)
+    self.assertEqual(num_references, Reference.objects.count())
+    generate_content.assert_not_called()
+
+  def test_collated_references_are_not_collated_again(self):
+    self.generate(self.collations[0], self.date + timedelta(hours=5))
+    refs = self.generate(self.collations[0], self.date + self.window)
+    self.assertEqual(1, len(refs))
+    self.assertNotIn("wom-tests", refs[0].description)
+    self.assertIn("item 4", refs[0].description)
+
+  def test_late_items_are_collated_apart(self):
+    refs = self.generate(self.collations[0], self.date + timedelta(hours=5))
+    r = Reference.objects.create(url="http://mouf/late",
+                                 title="late item",
+                                 pub_date=self.date - timedelta(hours=5))
+    r.sources.add(self.source)
+    late_refs = self.generate(self.collations[0], self.date + timedelta(hours=6))
+    self.assertEqual(1, len(late_refs))
+    self.assertNotIn(late_refs[0], refs)
+    self.assertEqual(self.date, late_refs[0].pub_date)
+    self.assertIn("late item", late_refs[0].description)
+    self.assertNotIn("item 3", late_refs[0].description)
+    other_refs = self.generate(self.collations[1], self.date + timedelta(hours=6))
+    self.assertEqual(refs[0], other_refs[0])
+    self.assertIn("item 3", other_refs[1].description)
+    self.assertIn("late item", other_refs[1].description)
+
+  def test_collation_waits_for_items(self):
+    collation = self.collations[0]
+    collation.last_completed_collation_date = self.date
+    self.assertEqual([], self.generate(collation, self.date + timedelta(hours=5)))
+    self.assertEqual(self.date, collation.last_completed_collation_date)
+    refs = self.generate(collation, self.date + self.window)
+    self.assertEqual(1, len(refs))
+    self.assertIn("item 4", refs[0].description)
+
 
 class FeedStatusTest(TestCase):
 
@@ -920,6 +1310,13 @@ class FeedStatusTest(TestCase):
     self.assertEqual(True, self.feed.permanent_failure_detected)
     self.assertIn("404", self.feed.permanent_failure_diagnostic)
 
+  def test_given_304_after_previous_failure_returns_not_broken(self):
+    self.feed.last_update_failed = True
+    feed_status = FeedStatus.check_and_record(self.feed, 304, None, self.test_date)
+    self.assertEqual(False, feed_status.is_broken)
+    self.assertEqual(False, self.feed.last_update_failed)
+    self.assertEqual(False, self.feed.permanent_failure_detected)
+
   def test_given_200_after_previous_failure_returns_not_broken_and_resets_last_update_failed(self):
     self.feed.last_update_failed = True
     self.test_date = self.date + FeedStatus.GRACE_PERIOD + timedelta(days=1)
@@ -928,3 +1325,678 @@ class FeedStatusTest(TestCase):
     self.assertEqual(False, self.feed.last_update_failed)
     self.assertEqual(self.date, self.feed.latest_update_failure_start_date)
     self.assertEqual(False, self.feed.permanent_failure_detected)
+
+
+class FetchConcurrentlyTest(TestCase):
+
+  def setUp(self):
+    self.lock = threading.Lock()
+    self.running_by_host = {}
+    self.max_running_by_host = {}
+
+  def _fetch(self, url):
+    host = url.split("/")[2]
+    with self.lock:
+      self.running_by_host[host] = self.running_by_host.get(host, 0) + 1
+      self.max_running_by_host[host] = max(self.max_running_by_host.get(host, 0),
+                                           self.running_by_host[host])
+    time.sleep(0.01)
+    with self.lock:
+      self.running_by_host[host] -= 1
+    return url.upper()
+
+  def test_sequential_fetch_keeps_order(self):
+    urls = [f"http://h{i}/rss" for i in range(5)]
+    res = list(fetch_concurrently(urls, self._fetch, lambda u: u, 1))
+    self.assertEqual([(u, u.upper()) for u in urls], res)
+
+  def test_concurrent_fetch_returns_all_results(self):
+    urls = [f"http://h{i%3}/rss{i}" for i in range(30)]
+    res = list(fetch_concurrently(urls, self._fetch, lambda u: u, 8, 2))
+    self.assertCountEqual([(u, u.upper()) for u in urls], res)
+
+  def test_concurrent_fetch_respects_max_per_host(self):
+    urls = [f"http://same.host/rss{i}" for i in range(20)] \
+      + [f"http://h{i}/rss" for i in range(10)]
+    res = list(fetch_concurrently(urls, self._fetch, lambda u: u, 8, 2))
+    self.assertEqual(len(urls), len(res))
+    self.assertGreaterEqual(2, self.max_running_by_host["same.host"])
+
+
+class FakeRawResponse:
+  """Stand-in for the urllib3 response behind a FakeFeedResponse, giving
+  the chunks of the latter's iter_content one by one."""
+
+  connection = None
+
+  def __init__(self, response):
+    self.response = response
+    self.chunks = None
+
+  def read1(self, amt, decode_content=None):
+    if self.chunks is None:
+      self.chunks = self.response.iter_content(amt)
+    return next(self.chunks, b"")
+
+
+class FakeFeedResponse:
+  """Stand-in for a streamed requests' Response."""
+
+  def __init__(self, url, status=200, content=b"", headers=None,
+               history=()):
+    self.url = url
+    self.status_code = status
+    self.content = content
+    self.headers = CaseInsensitiveDict(headers or {})
+    self.history = list(history)
+    self.raw = FakeRawResponse(self)
+
+  def iter_content(self, chunk_size):
+    for i in range(0, len(self.content), chunk_size):
+      yield self.content[i:i+chunk_size]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+def fake_feed_server(respond):
+  """Patch the feed downloads so that respond(url, request_headers)
+  gives the response."""
+  return mock.patch("wom_river.utils.feed_stream.http_get",
+                    side_effect=lambda url, headers, **kwargs: respond(url, headers))
+
+
+class CollectNewsFromFeedsTaskTest(TestCase):
+
+  RSS_TEMPLATE = """\
+<?xml version="1.0"?>
+<rss version="2.0">
+  <channel>
+    <title>{name}</title>
+    <link>http://{name}</link>
+    <description>A RSS test source</description>
+    <item>
+      <title>{name} item</title>
+      <link>http://{name}/item</link>
+      <pubDate>Sun, 17 Nov 2013 19:01:58 GMT</pubDate>
+    </item>
+  </channel>
+</rss>
+"""
+
+  def setUp(self):
+    self.feeds = []
+    for i in range(6):
+      name = f"src{i}.example"
+      source = Reference.objects.create(url=f"http://{name}",
+                                        title=name,
+                                        pub_date=datetime.now(timezone.utc))
+      self.feeds.append(WebFeed.objects.create(
+          xmlURL=f"http://{name}/rss.xml",
+          source=source,
+          last_update_check=datetime.fromtimestamp(0, timezone.utc)))
+    def respond(url, headers):
+      if "src5" in url:
+        raise requests.ConnectionError("Network unreachable")
+      return FakeFeedResponse(
+          url, content=self.RSS_TEMPLATE.format(name=url.split("/")[2]).encode())
+    patcher = fake_feed_server(respond)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def _check_collected_news(self):
+    for i in range(5):
+      ref = Reference.objects.get(url=f"http://src{i}.example/item")
+      self.assertEqual(f"src{i}.example item", ref.title)
+      self.assertIn(self.feeds[i].source, ref.sources.all())
+    self.assertFalse(Reference.objects.filter(url="http://src5.example/item").exists())
+    broken_feed = WebFeed.objects.get(xmlURL="http://src5.example/rss.xml")
+    self.assertTrue(broken_feed.last_update_failed)
+
+  def test_sequential_collection(self):
+    collect_news_from_feeds(self.feeds, num_workers=1)
+    self._check_collected_news()
+
+  def test_concurrent_collection(self):
+    collect_news_from_feeds(self.feeds, num_workers=4, max_per_host=1)
+    self._check_collected_news()
+
+  def test_collection_with_parsing_processes(self):
+    collect_news_from_feeds(self.feeds, num_workers=4, max_per_host=1,
+                            num_parse_processes=2)
+    self._check_collected_news()
+
+
+class FeedCollectionMetricsTest(TestCase):
+
+  RSS_TEMPLATE = CollectNewsFromFeedsTaskTest.RSS_TEMPLATE
+  setUp = CollectNewsFromFeedsTaskTest.setUp
+  _check_collected_news = CollectNewsFromFeedsTaskTest._check_collected_news
+
+  def test_collection_records_run_and_samples(self):
+    collect_news_from_feeds(self.feeds, num_workers=4, max_per_host=1,
+                            lane="fast")
+    run = FeedCollectionRun.objects.get()
+    self.assertEqual("fast", run.lane)
+    self.assertEqual(6, run.num_feeds)
+    self.assertEqual(1, run.num_failed_feeds)
+    self.assertEqual(5, run.num_entries)
+    self.assertEqual(5, run.num_new_references)
+    self.assertTrue(run.duration > 0)
+    samples = FeedFetchSample.objects.filter(run=run)
+    self.assertEqual(6, samples.count())
+    broken_sample = samples.get(feed__xmlURL="http://src5.example/rss.xml")
+    self.assertTrue(broken_sample.is_broken)
+    self.assertIsNotNone(broken_sample.fetch_duration)
+    sample = samples.get(feed__xmlURL="http://src0.example/rss.xml")
+    self.assertFalse(sample.is_broken)
+    self.assertEqual(200, sample.status)
+    self.assertEqual(1, sample.num_new_references)
+    self.assertTrue(sample.fetch_duration >= 0)
+    self.assertTrue(sample.parse_duration >= 0)
+
+  def test_no_metrics_when_disabled(self):
+    with mock.patch("wom_river.metrics.COLLECT_METRICS", False):
+      collect_news_from_feeds(self.feeds, num_workers=1)
+    self._check_collected_news()
+    self.assertFalse(FeedCollectionRun.objects.exists())
+    self.assertFalse(FeedFetchSample.objects.exists())
+
+  def test_old_metrics_are_deleted(self):
+    old_date = datetime.now(timezone.utc) - METRICS_RETENTION - timedelta(days=1)
+    old_run = FeedCollectionRun.objects.create(start_date=old_date)
+    FeedFetchSample.objects.create(run=None, feed=self.feeds[0],
+                                   fetch_date=old_date, status=200)
+    collect_news_from_feeds(self.feeds, num_workers=1)
+    self.assertFalse(FeedCollectionRun.objects.filter(pk=old_run.pk).exists())
+    self.assertFalse(FeedFetchSample.objects.filter(fetch_date=old_date).exists())
+    self.assertEqual(6, FeedFetchSample.objects.count())
+
+  def test_prometheus_metrics(self):
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    collect_news_from_feeds(self.feeds, num_workers=1, lane="slow")
+    text = format_prometheus_metrics(since)
+    self.assertIn("# TYPE wom_river_last_run_num_feeds gauge", text)
+    self.assertIn('wom_river_last_run_num_feeds{lane="slow"} 6\n', text)
+    self.assertIn("wom_river_feed_num_failures 1\n", text)
+    self.assertIn("wom_river_feed_num_new_references 5\n", text)
+
+  def test_report_command(self):
+    collect_news_from_feeds(self.feeds, num_workers=1, lane="fast")
+    out = StringIO()
+    call_command("feed_collection_report", "--top", "2", stdout=out)
+    report = out.getvalue()
+    self.assertIn("lane 'fast': 1 runs", report)
+    self.assertIn("Slowest feeds (top 2):", report)
+    self.assertEqual(2, report.count("/rss.xml: "))
+
+
+class ConditionalFeedFetchTest(TestCase):
+
+  RSS_XML = CollectNewsFromFeedsTaskTest.RSS_TEMPLATE.format(name="mouf").encode()
+
+  VALIDATORS = {"ETag": '"v1"',
+                "Last-Modified": "Sun, 17 Nov 2013 19:08:15 GMT"}
+
+  def setUp(self):
+    source = Reference.objects.create(url="http://mouf",
+                                      title="mouf",
+                                      pub_date=datetime.now(timezone.utc))
+    self.feed = WebFeed.objects.create(
+        xmlURL="http://mouf/rss.xml",
+        source=source,
+        last_update_check=datetime.fromtimestamp(0, timezone.utc))
+    self.request_headers = []
+
+  def _respond_modified(self, url, headers):
+    self.request_headers.append(headers)
+    return FakeFeedResponse(url, content=self.RSS_XML,
+                            headers=self.VALIDATORS)
+
+  def _respond_not_modified(self, url, headers):
+    self.request_headers.append(headers)
+    return FakeFeedResponse(url, status=304, headers=self.VALIDATORS)
+
+  def test_validators_are_stored_then_sent(self):
+    with fake_feed_server(self._respond_modified):
+      collect_new_references_for_feed(self.feed)
+    self.assertNotIn("If-None-Match", self.request_headers[-1])
+    self.assertNotIn("If-Modified-Since", self.request_headers[-1])
+    feed = WebFeed.objects.get(pk=self.feed.pk)
+    self.assertEqual('"v1"', feed.http_etag)
+    self.assertEqual("Sun, 17 Nov 2013 19:08:15 GMT", feed.http_last_modified)
+    with fake_feed_server(self._respond_not_modified):
+      collect_new_references_for_feed(feed)
+    self.assertEqual('"v1"', self.request_headers[-1]["If-None-Match"])
+    self.assertEqual("Sun, 17 Nov 2013 19:08:15 GMT",
+                     self.request_headers[-1]["If-Modified-Since"])
+
+  def test_not_modified_feed_leaves_references_untouched(self):
+    with fake_feed_server(self._respond_modified):
+      collect_new_references_for_feed(self.feed)
+    ref = Reference.objects.get(url="http://mouf/item")
+    ref.description = "edited"
+    ref.save()
+    last_update_check = WebFeed.objects.get(pk=self.feed.pk).last_update_check
+    feed = WebFeed.objects.get(pk=self.feed.pk)
+    with fake_feed_server(self._respond_not_modified):
+      res = collect_new_references_for_feed(feed)
+    self.assertEqual(0, len(res))
+    self.assertEqual("edited", Reference.objects.get(url="http://mouf/item").description)
+    feed = WebFeed.objects.get(pk=self.feed.pk)
+    self.assertEqual(last_update_check, feed.last_update_check)
+    self.assertFalse(feed.last_update_failed)
+    self.assertEqual('"v1"', feed.http_etag)
+
+
+class PollScheduleTest(TestCase):
+
+  def setUp(self):
+    self.now = datetime(2013, 11, 17, 19, 8, 15, tzinfo=timezone.utc)
+
+  def test_estimate_posting_interval_needs_two_dates(self):
+    self.assertEqual(None, estimate_posting_interval([], self.now))
+    self.assertEqual(None, estimate_posting_interval([self.now, None],
+                                                     self.now))
+
+  def test_estimate_posting_interval_counts_time_since_latest_item(self):
+    dates = [self.now - timedelta(hours=2*i+2) for i in range(3)]
+    self.assertEqual(timedelta(hours=2),
+                     estimate_posting_interval(dates, self.now))
+
+  def test_http_hint_from_retry_after_seconds(self):
+    self.assertEqual(timedelta(seconds=120),
+                     get_http_hint({"retry-after": "120"}, self.now))
+
+  def test_http_hint_from_retry_after_date(self):
+    self.assertEqual(timedelta(hours=1),
+                     get_http_hint({"retry-after": "Sun, 17 Nov 2013 20:08:15 GMT"},
+                                   self.now))
+
+  def test_http_hint_from_cache_control(self):
+    self.assertEqual(timedelta(seconds=600),
+                     get_http_hint({"cache-control": "public, max-age=600",
+                                    "expires": "Sun, 17 Nov 2013 22:08:15 GMT"},
+                                   self.now))
+    self.assertEqual(None,
+                     get_http_hint({"cache-control": "no-cache, max-age=600"},
+                                   self.now))
+
+  def test_http_hint_from_expires(self):
+    self.assertEqual(timedelta(hours=3),
+                     get_http_hint({"expires": "Sun, 17 Nov 2013 22:08:15 GMT"},
+                                   self.now))
+
+  def test_http_hint_ignores_garbage(self):
+    self.assertEqual(None,
+                     get_http_hint({"retry-after": "soon", "expires": "-1"},
+                                   self.now))
+
+  def test_feed_hint_from_ttl_and_sy_update_period(self):
+    self.assertEqual(timedelta(minutes=60), get_feed_hint({"ttl": "60"}))
+    self.assertEqual(timedelta(hours=12),
+                     get_feed_hint({"ttl": "60",
+                                    "sy_updateperiod": "daily",
+                                    "sy_updatefrequency": "2"}))
+    self.assertEqual(None, get_feed_hint({"ttl": "never"}))
+
+
+class ScheduleNextPollTest(TestCase):
+
+  def setUp(self):
+    self.now = datetime(2013, 11, 17, 19, 8, 15, tzinfo=timezone.utc)
+    source = Reference.objects.create(url="http://mouf",
+                                      title="mouf",
+                                      pub_date=self.now)
+    self.feed = WebFeed.objects.create(
+        xmlURL="http://mouf/rss.xml",
+        source=source,
+        last_update_check=datetime.fromtimestamp(0, timezone.utc))
+
+  def make_parsed_feed(self, item_dates, headers=None, **feed_info):
+    entries = [PreparedEntry(f"http://mouf/{i}", d, f"{i}", "", "", set(), "")
+               for i, d in enumerate(item_dates)]
+    return ParsedFeed(entries, None, headers or {}, feed_info)
+
+  def schedule(self, status, parsed_feed):
+    schedule_next_poll(self.feed,
+                       FeedFetchResult(parsed_feed, status, self.feed.xmlURL,
+                                       self.now, None, None))
+    return self.feed.next_poll_at - self.now
+
+  def test_new_feed_is_due(self):
+    self.assertTrue(self.feed.next_poll_at <= self.now)
+
+  def test_busy_feed_is_polled_often(self):
+    dates = [self.now - timedelta(minutes=5*i+1) for i in range(10)]
+    self.assertEqual(FEED_POLL_MIN_INTERVAL,
+                     self.schedule(200, self.make_parsed_feed(dates)))
+
+  def test_interval_follows_posting_rate(self):
+    dates = [self.now - timedelta(hours=4*i+4) for i in range(5)]
+    self.assertEqual(timedelta(hours=2),
+                     self.schedule(200, self.make_parsed_feed(dates)))
+
+  def test_quiet_feed_is_polled_rarely(self):
+    dates = [self.now - timedelta(days=100*i+100) for i in range(3)]
+    self.assertEqual(FEED_POLL_MAX_INTERVAL,
+                     self.schedule(200, self.make_parsed_feed(dates)))
+
+  def test_hints_stretch_interval(self):
+    dates = [self.now - timedelta(minutes=5*i+1) for i in range(10)]
+    self.assertEqual(timedelta(hours=1),
+                     self.schedule(200, self.make_parsed_feed(dates, ttl="60")))
+    self.assertEqual(timedelta(hours=3),
+                     self.schedule(200, self.make_parsed_feed(
+                         dates, headers={"cache-control": "max-age=10800"})))
+
+  def test_not_modified_feed_interval_grows(self):
+    self.feed.poll_interval = timedelta(hours=2)
+    self.assertEqual(timedelta(hours=3),
+                     self.schedule(304, ParsedFeed([], None, {}, {})))
+
+  def test_failing_feed_backs_off(self):
+    self.feed.last_update_failed = True
+    self.feed.latest_update_failure_start_date = self.now
+    self.assertEqual(FEED_POLL_MIN_INTERVAL, self.schedule(500, None))
+    self.feed.latest_update_failure_start_date = self.now - timedelta(hours=5)
+    self.assertEqual(timedelta(hours=5), self.schedule(500, None))
+    self.feed.latest_update_failure_start_date = self.now - timedelta(days=5)
+    self.assertEqual(FEED_POLL_MAX_INTERVAL, self.schedule(500, None))
+
+  def test_collection_saves_the_schedule(self):
+    xml = CollectNewsFromFeedsTaskTest.RSS_TEMPLATE.format(name="mouf")
+    with fake_feed_server(lambda url, headers: FakeFeedResponse(
+        url, content=xml.encode())):
+      collect_new_references_for_feed(self.feed)
+    feed = WebFeed.objects.get(pk=self.feed.pk)
+    self.assertTrue(feed.next_poll_at > datetime.now(timezone.utc))
+    self.assertEqual(feed.poll_interval, self.feed.poll_interval)
+
+
+class StreamedFeedDownloadTest(TestCase):
+
+  ITEM_TEMPLATE = """\
+    <item>
+      <title>Item {i}</title>
+      <link>http://mouf/{i}</link>
+      <description>Description of item {i}</description>
+      <pubDate>{date}</pubDate>
+    </item>
+"""
+
+  def setUp(self):
+    self.newest_date = datetime(2013, 11, 17, 19, 0, tzinfo=timezone.utc)
+
+  def item_date(self, i):
+    return self.newest_date - timedelta(hours=i)
+
+  def make_rss(self, indices):
+    items = "".join(
+        self.ITEM_TEMPLATE.format(
+            i=i, date=self.item_date(i).strftime("%a, %d %b %Y %H:%M:%S GMT"))
+        for i in indices)
+    return ('<?xml version="1.0"?>\n<rss version="2.0"><channel>'
+            f'<title>mouf</title>{items}</channel></rss>').encode()
+
+  def download(self, content, **kwargs):
+    self.response = FakeFeedResponse("http://mouf/rss.xml", content=content)
+    self.read_chunks = 0
+    iter_content = self.response.iter_content
+    def counted_iter_content(chunk_size):
+      for chunk in iter_content(1024):
+        self.read_chunks += 1
+        yield chunk
+    self.response.iter_content = counted_iter_content
+    kwargs.setdefault("max_bytes", 10*len(content))
+    with fake_feed_server(lambda url, headers: self.response):
+      return download_feed("http://mouf/rss.xml", {}, **kwargs)
+
+  def test_complete_download(self):
+    content = self.make_rss(range(100))
+    download = self.download(content)
+    self.assertFalse(download.is_truncated)
+    self.assertEqual(content, download.content)
+
+  def test_stops_after_known_items_of_a_date_ordered_feed(self):
+    content = self.make_rss(range(2000))
+    download = self.download(content, stop_date=self.item_date(20),
+                             min_items=10)
+    self.assertTrue(download.is_truncated)
+    self.assertLess(self.read_chunks*1024, len(content)/10)
+    d = feedparser.parse(download.content)
+    self.assertFalse(d.bozo)
+    self.assertEqual("mouf", d.feed.title)
+    self.assertEqual(["Item %d" % i for i in range(21)],
+                     [e.title for e in d.entries][:21])
+
+  def test_stops_only_after_min_items(self):
+    content = self.make_rss(range(100))
+    download = self.download(content, stop_date=self.newest_date,
+                             min_items=10)
+    d = feedparser.parse(download.content)
+    self.assertFalse(d.bozo)
+    self.assertGreaterEqual(len(d.entries), 10)
+    self.assertLess(len(d.entries), 100)
+
+  def test_does_not_stop_early_for_unordered_feed(self):
+    content = self.make_rss([5, 0] + list(range(6, 100)))
+    download = self.download(content, stop_date=self.item_date(2),
+                             min_items=2)
+    self.assertFalse(download.is_truncated)
+    self.assertEqual(content, download.content)
+
+  def test_size_cap(self):
+    content = self.make_rss(range(2000))
+    download = self.download(content, max_bytes=20*1024)
+    self.assertTrue(download.is_truncated)
+    self.assertLessEqual(len(download.content), 21*1024)
+    d = feedparser.parse(download.content)
+    self.assertFalse(d.bozo)
+    self.assertLess(0, len(d.entries))
+    self.assertLess(len(d.entries), 2000)
+
+  def test_stops_in_atom_feed(self):
+    entries = "".join(f"""\
+  <entry>
+    <title>Entry {i}</title>
+    <link href="http://mouf/{i}"/>
+    <id>http://mouf/{i}</id>
+    <updated>{self.item_date(i).isoformat()}</updated>
+  </entry>
+""" for i in range(500))
+    content = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<feed xmlns="http://www.w3.org/2005/Atom">'
+               f'<title>mouf</title>{entries}</feed>').encode()
+    download = self.download(content, stop_date=self.item_date(30),
+                             min_items=1)
+    self.assertTrue(download.is_truncated)
+    d = feedparser.parse(download.content)
+    self.assertFalse(d.bozo)
+    self.assertEqual(31, len(d.entries))
+
+  def test_permanent_redirection_is_reported(self):
+    redirection = FakeFeedResponse("http://old.mouf/rss.xml", status=301)
+    content = self.make_rss(range(3))
+    response = FakeFeedResponse("http://mouf/rss.xml", content=content,
+                                history=[redirection])
+    with fake_feed_server(lambda url, headers: response):
+      download = download_feed("http://old.mouf/rss.xml", {}, max_bytes=1024*1024)
+    self.assertEqual(301, download.status)
+    self.assertEqual("http://mouf/rss.xml", download.href)
+    self.assertEqual(content, download.content)
+
+  def test_fetch_feed_only_parses_the_new_items(self):
+    content = self.make_rss(range(2000))
+    with fake_feed_server(lambda url, headers: FakeFeedResponse(url, content=content)):
+      result = fetch_feed("http://mouf/rss.xml", stop_date=self.item_date(50))
+    self.assertEqual(200, result.status)
+    self.assertEqual(51, len(result.parsed_feed.entries))
+    self.assertEqual("Item 0", result.parsed_feed.entries[0].title)
+
+
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    self.server.client_ports.add(self.client_address[1])
+    body = b"<html><head><title>mouf</title></head></html>"
+    self.send_response(200)
+    self.send_header("Content-Type", "text/html")
+    self.send_header("Content-Length", str(len(body)))
+    self.send_header("Set-Cookie", "session=1234")
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TricklingRequestHandler(BaseHTTPRequestHandler):
+  """Send a feed one byte at a time, slowly."""
+
+  def do_GET(self):
+    body = b"<rss>" + b" "*100 + b"</rss>"
+    self.send_response(200)
+    self.send_header("Content-Type", "application/rss+xml")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    try:
+      for i in range(len(body)):
+        self.wfile.write(body[i:i+1])
+        self.wfile.flush()
+        time.sleep(0.1)
+    except OSError:
+      pass
+
+  def log_message(self, *args):
+    pass
+
+
+class SharedHTTPSessionTest(TestCase):
+
+  def setUp(self):
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveRequestHandler)
+    self.server.client_ports = set()
+    thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    thread.start()
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+  def test_connections_are_reused(self):
+    session = build_session(10, 2)
+    for i in range(5):
+      with session.get(f"{self.url}/page{i}", timeout=5) as r:
+        self.assertEqual(200, r.status_code)
+    self.assertEqual(1, len(self.server.client_ports))
+
+  def test_connections_per_host_are_bounded(self):
+    session = build_session(10, 2)
+    def get_pages():
+      for i in range(3):
+        session.get(f"{self.url}/page{i}", timeout=5).close()
+    threads = [threading.Thread(target=get_pages) for _ in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertLessEqual(len(self.server.client_ports), 2)
+
+  def test_cookies_are_not_shared(self):
+    session = build_session(10, 2)
+    session.get(self.url, timeout=5).close()
+    self.assertEqual(0, len(session.cookies))
+
+
+class FeedFetchTimeoutTest(TestCase):
+
+  def setUp(self):
+    source = Reference.objects.create(url="http://mouf",
+                                      title="mouf",
+                                      pub_date=datetime.now(timezone.utc))
+    self.feed = WebFeed.objects.create(
+        xmlURL="http://mouf/rss.xml",
+        source=source,
+        last_update_check=datetime.fromtimestamp(0, timezone.utc))
+
+  def test_download_total_timeout(self):
+    response = FakeFeedResponse("http://mouf/rss.xml", content=b"<rss>"*100)
+    def slow_iter_content(chunk_size):
+      for i in range(100):
+        time.sleep(0.01)
+        yield b"<rss>"
+    response.iter_content = slow_iter_content
+    with fake_feed_server(lambda url, headers: response):
+      with self.assertRaises(TotalTimeout):
+        download_feed("http://mouf/rss.xml", {}, 1024*1024,
+                      total_timeout=0.1)
+
+  def test_download_total_timeout_with_trickling_server(self):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TricklingRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    self.addCleanup(server.server_close)
+    self.addCleanup(server.shutdown)
+    start_time = time.monotonic()
+    with self.assertRaises(TotalTimeout):
+      download_feed(f"http://127.0.0.1:{server.server_port}/rss.xml", {},
+                    1024*1024, total_timeout=0.5, timeout=(5, 5))
+    self.assertLess(time.monotonic() - start_time, 2)
+
+  def test_fetch_timeouts_are_passed_and_reported(self):
+    with mock.patch("wom_river.utils.feed_stream.http_get",
+                    side_effect=requests.ConnectTimeout("too long")) as get:
+      result = fetch_feed("http://mouf/rss.xml")
+    self.assertEqual(FeedStatus.STATUS_TIMEOUT, result.status)
+    self.assertIsNone(result.parsed_feed)
+    self.assertIsNotNone(result.duration)
+    self.assertEqual(2, len(get.call_args.kwargs["timeout"]))
+
+  def test_stalled_download_is_reported_as_a_timeout(self):
+    response = FakeFeedResponse("http://mouf/rss.xml", content=b"<rss>"*100)
+    def stalled_iter_content(chunk_size):
+      yield b"<rss>"
+      raise ReadTimeoutError(None, "http://mouf/rss.xml", "Read timed out.")
+    response.iter_content = stalled_iter_content
+    with fake_feed_server(lambda url, headers: response):
+      result = fetch_feed("http://mouf/rss.xml")
+    self.assertEqual(FeedStatus.STATUS_TIMEOUT, result.status)
+    self.assertIsNotNone(result.duration)
+
+  def test_failed_fetch_duration_is_recorded(self):
+    with mock.patch("wom_river.utils.feed_stream.http_get",
+                    side_effect=requests.ConnectionError("refused")):
+      result = fetch_feed("http://mouf/rss.xml")
+    self.assertEqual(FeedStatus.STATUS_PARSING_EXCEPTION, result.status)
+    self.assertIsNotNone(result.duration)
+
+  def test_timeout_is_a_failure(self):
+    feed_status = FeedStatus.check_and_record(
+        self.feed, FeedStatus.STATUS_TIMEOUT, None, datetime.now(timezone.utc))
+    self.assertTrue(feed_status.is_broken)
+    self.assertEqual("Timeout", feed_status.diagnostic)
+    self.assertTrue(self.feed.last_update_failed)
+
+  def test_fetch_latency_is_a_rolling_average(self):
+    result = FeedFetchResult(None, 200, None, datetime.now(timezone.utc),
+                             None, None, 10.0)
+    record_fetch_latency(self.feed, result)
+    self.assertAlmostEqual(3.0, self.feed.fetch_latency)
+    record_fetch_latency(self.feed, result)
+    self.assertAlmostEqual(5.1, self.feed.fetch_latency)
+    record_fetch_latency(self.feed, result._replace(duration=None))
+    self.assertAlmostEqual(5.1, self.feed.fetch_latency)
+
+  def test_fetch_latency_is_saved(self):
+    xml = CollectNewsFromFeedsTaskTest.RSS_TEMPLATE.format(name="mouf")
+    def slow_response(url, headers):
+      time.sleep(0.05)
+      return FakeFeedResponse(url, content=xml.encode())
+    with fake_feed_server(slow_response):
+      collect_new_references_for_feed(self.feed)
+    self.assertLess(0.0, WebFeed.objects.get(pk=self.feed.pk).fetch_latency)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Run network-bound jobs in a pool of threads while limiting the number
+of jobs hitting a same host at the same time.
+"""
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+
+def get_url_host(url):
+  """Return the host part of a url (or an empty string if there is none)."""
+  try:
+    return urlsplit(url).hostname or ""
+  except ValueError:
+    return ""
+
+
+def fetch_concurrently(items, fetch, get_url, num_workers, max_per_host=None,
+                       stats=None):
+  """Call fetch(item) for each item and yield (item, result) pairs as
+  soon as each call completes (ie not necessarily in the input order).
+
+  The fetch calls happen in worker threads so fetch must not raise and
+  must not touch the db, while the consumer of the generator runs in
+  the calling thread and can safely save the results.
+
+  get_url(item) gives the url the item will be fetched from, which is
+  used to make sure that no more than max_per_host items are fetched
+  from the same host at the same time (None or 0 meaning no limit).
+
+  Items are pulled lazily from the input iterable (a bounded number of
+  them being kept waiting for their host to be available).
+
+  If a stats dictionary is given, its "max_queue_depth" key is set to
+  the max number of items that were at the same time waiting either for
+  their host to be available or for their result to be consumed.
+  """
+  if stats is None:
+    stats = {}
+  stats["max_queue_depth"] = 0
+  if num_workers <= 1:
+    for item in items:
+      yield item, fetch(item)
+    return
+  max_per_host = max_per_host or num_workers
+  max_waiting = 4*num_workers
+  remaining_items = iter(items)
+  exhausted = False
+  waiting_by_host = defaultdict(deque)
+  num_waiting = 0
+  running_by_host = defaultdict(int)
+  running = {}
+  with ThreadPoolExecutor(max_workers=num_workers) as executor:
+    def submit(item, host):
+      running_by_host[host] += 1
+      running[executor.submit(fetch, item)] = (item, host)
+    while True:
+      while (not exhausted and len(running) < num_workers
+             and num_waiting < max_waiting):
+        try:
+          item = next(remaining_items)
+        except StopIteration:
+          exhausted = True
+          break
+        host = get_url_host(get_url(item))
+        if running_by_host[host] < max_per_host and not waiting_by_host[host]:
+          submit(item, host)
+        else:
+          waiting_by_host[host].append(item)
+          num_waiting += 1
+      if not running:
+        # Items only wait for a host that has running jobs, so nothing
+        # can be left waiting here.
+        return
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      stats["max_queue_depth"] = max(stats["max_queue_depth"],
+                                     num_waiting + len(done))
+      for future in done:
+        item, host = running.pop(future)
+        running_by_host[host] -= 1
+        if waiting_by_host[host]:
+          submit(waiting_by_host[host].popleft(), host)
+          num_waiting -= 1
+        yield item, future.result()
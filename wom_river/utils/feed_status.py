@@ -4,6 +4,8 @@ from datetime import timedelta
 class FeedStatus:
 
     STATUS_PARSING_EXCEPTION = 26342
+    STATUS_TIMEOUT = 26343
+    STATUS_NOT_MODIFIED = 304
     GRACE_PERIOD = timedelta(weeks=4)
 
     def __init__(self, *, is_broken, diagnostic = None):
@@ -12,7 +14,11 @@ class FeedStatus:
 
     @staticmethod
     def check_and_record(feed, status, actual_href, status_date):
+        """Update the feed's failure info according to the status of
+        its last fetch and tell if the feed should be considered as broken.
 
+        Note: a 304 (Not Modified) status is a success.
+        """
         if status < 400:
             if status==301:
                 feed.xmlURL = actual_href
@@ -29,7 +35,12 @@ class FeedStatus:
             diagnostic = f"Feed declared as Gone (Status {status})"
             feed.set_permanent_failure(diagnostic, status_date)
         else:
-            diagnostic = "Parse Error" if status == FeedStatus.STATUS_PARSING_EXCEPTION else f"Status {status}"
+            if status == FeedStatus.STATUS_PARSING_EXCEPTION:
+                diagnostic = "Parse Error"
+            elif status == FeedStatus.STATUS_TIMEOUT:
+                diagnostic = "Timeout"
+            else:
+                diagnostic = f"Status {status}"
             duration_of_consecutive_failures = (status_date - feed.latest_update_failure_start_date)
             if feed.last_update_failed and duration_of_consecutive_failures > FeedStatus.GRACE_PERIOD:
                 diagnostic = f"Feed update failed after consistently failing since {duration_of_consecutive_failures} ({diagnostic})"
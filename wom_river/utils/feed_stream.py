@@ -0,0 +1,262 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Download a feed by chunks, stopping as soon as the items already known
+are reached (for feeds listing their items newest first) or when a
+maximum size is reached, so that huge feeds don't have to be kept in
+memory as a whole.
+"""
+
+import time
+from collections import namedtuple
+from datetime import timezone
+from xml.parsers import expat
+
+from dateutil import parser as dateparser
+from requests.exceptions import (
+    ChunkedEncodingError,
+    ContentDecodingError,
+    ReadTimeout,
+    Timeout,
+    )
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+
+from wom_river.utils.http_client import http_get
+
+
+# Local names of the elements holding an item of a RSS or Atom feed.
+ITEM_TAGS = frozenset(("item", "entry"))
+
+# Local names of the elements holding the date of an item.
+DATE_TAGS = frozenset(("pubdate", "published", "updated", "date"))
+
+CHUNK_SIZE = 64*1024
+
+# Result of a feed download, with the content possibly truncated to its
+# first items (but still a well formed document whenever possible).
+FeedDownload = namedtuple("FeedDownload",
+                          "status, href, headers, content, is_truncated")
+
+
+class TotalTimeout(Timeout):
+  """The whole download took too long."""
+
+
+def iter_response_content(response, chunk_size, deadline=None):
+  """Iterate over the response's content, yielding each piece of it as
+  soon as it is received (response.iter_content waiting for whole
+  chunks instead).
+
+  If a deadline is given (as a time.monotonic() value), the download
+  is aborted with a TotalTimeout once it's passed, the socket's timeout
+  being shrunk to the time left so that no read can go past it. A
+  server stalling in the middle of the body is reported as a
+  ReadTimeout (instead of the ConnectionError raised by requests).
+  """
+  connection = response.raw.connection
+  sock = connection.sock if connection is not None else None
+  read_timeout = sock.gettimeout() if sock is not None else None
+  try:
+    while True:
+      if deadline is not None:
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+          raise TotalTimeout(f"Download of {response.url} passed its deadline")
+        if sock is not None:
+          sock.settimeout(time_left if read_timeout is None
+                          else min(read_timeout, time_left))
+      try:
+        chunk = response.raw.read1(chunk_size, decode_content=True)
+      except ReadTimeoutError as e:
+        if deadline is not None and time.monotonic() >= deadline:
+          raise TotalTimeout(f"Download of {response.url} passed its deadline") from e
+        raise ReadTimeout(e, response=response) from e
+      except ProtocolError as e:
+        raise ChunkedEncodingError(e) from e
+      except DecodeError as e:
+        raise ContentDecodingError(e) from e
+      if not chunk:
+        return
+      yield chunk
+  finally:
+    if sock is not None and deadline is not None:
+      sock.settimeout(read_timeout)
+
+
+def get_local_name(qname):
+  return qname.rsplit(":", 1)[-1].lower()
+
+
+def parse_item_date(text):
+  try:
+    date = dateparser.parse(text.strip())
+  except (ValueError, OverflowError):
+    return None
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=timezone.utc)
+  return date
+
+
+class ScanDone(Exception):
+  pass
+
+
+class FeedItemScanner:
+  """Scan a RSS or Atom document fed by chunks and keep track of the
+  last complete item: its date and where the document can be cut right
+  after it.
+
+  Scanning stops (and is_done becomes True) at the first item making
+  has_passed(stop_date, min_items) true if a stop_date is given.
+
+  Scanning also stops silently at the first XML error, items being then
+  considered as not ordered by date.
+  """
+
+  def __init__(self, stop_date=None, min_items=1):
+    self.stop_date = stop_date
+    self.min_items = min_items
+    self.is_done = False
+    self.num_items = 0
+    # True as long as all items have a date and come newest first.
+    self.is_date_ordered = True
+    self.last_item_date = None
+    # Position where the last complete item's closing tag starts and
+    # the closing tags needed to end the document from there.
+    self.last_item_cut = None
+    self.last_item_closing = None
+    self.failed = False
+    self._stack = []
+    self._item_depth = None
+    self._item_date = None
+    self._text = []
+    self._parser = expat.ParserCreate()
+    self._parser.buffer_text = True
+    self._parser.StartElementHandler = self._start_element
+    self._parser.EndElementHandler = self._end_element
+    self._parser.CharacterDataHandler = self._char_data
+
+  def feed(self, chunk):
+    if self.failed or self.is_done:
+      return
+    try:
+      self._parser.Parse(chunk, False)
+    except ScanDone:
+      self.is_done = True
+    except expat.ExpatError:
+      self.failed = True
+      self.is_date_ordered = False
+
+  def _start_element(self, name, attrs):
+    self._stack.append(name)
+    self._text = []
+    if self._item_depth is None and get_local_name(name) in ITEM_TAGS:
+      self._item_depth = len(self._stack)
+      self._item_date = None
+
+  def _char_data(self, data):
+    self._text.append(data)
+
+  def _end_element(self, name):
+    depth = len(self._stack)
+    self._stack.pop()
+    if self._item_depth is None:
+      return
+    local_name = get_local_name(name)
+    if depth == self._item_depth+1 and local_name in DATE_TAGS:
+      date = parse_item_date("".join(self._text))
+      if date is not None and (self._item_date is None or date > self._item_date):
+        self._item_date = date
+    elif depth == self._item_depth:
+      self._item_depth = None
+      self.num_items += 1
+      if (self._item_date is None
+          or (self.last_item_date is not None
+              and self._item_date > self.last_item_date)):
+        self.is_date_ordered = False
+      self.last_item_date = self._item_date
+      self.last_item_cut = self._parser.CurrentByteIndex
+      self.last_item_closing = "".join(
+          f"</{n}>" for n in reversed(self._stack + [name])).encode("utf-8")
+      if (self.stop_date is not None
+          and self.has_passed(self.stop_date, self.min_items)):
+        raise ScanDone()
+    self._text = []
+
+  def has_passed(self, date, min_items):
+    """Tell whether at least min_items items were seen and the following
+    ones are all known to be older than date."""
+    return (self.is_date_ordered
+            and self.num_items >= min_items
+            and self.last_item_date is not None
+            and self.last_item_date <= date)
+
+
+def download_feed(url, headers, max_bytes, stop_date=None, min_items=1,
+                  total_timeout=None, **kwargs):
+  """Download the feed at url, sending the given request headers.
+
+  The download stops before the end of the document if it gets bigger
+  than max_bytes or if it lists its items newest first and an item
+  published before stop_date was reached (after at least min_items
+  items). The content is then cut right after the last complete item
+  and properly closed.
+
+  Return a FeedDownload whose content is None for responses that are
+  not a success (including a 304 Not Modified).
+
+  If the download takes more than total_timeout seconds, it is aborted
+  with a TotalTimeout exception (the timeout keyword argument passed to
+  http_get bounding the time to connect and to wait for each piece of
+  data, a server stalling being reported as a ReadTimeout).
+
+  Other keyword arguments are passed to http_get.
+
+  Note: network errors are left to the caller to handle.
+  """
+  start_time = time.monotonic()
+  with http_get(url, headers=headers, stream=True, **kwargs) as r:
+    status = r.status_code
+    if r.history and r.history[0].status_code in (301, 308):
+      # Report a permanent redirection to get the feed's url updated.
+      status = 301
+    response_headers = {k.lower(): v for k, v in r.headers.items()}
+    if r.status_code >= 300:
+      return FeedDownload(status, r.url, response_headers, None, False)
+    content = bytearray()
+    scanner = FeedItemScanner(stop_date, min_items)
+    is_truncated = False
+    deadline = (start_time + total_timeout
+                if total_timeout is not None else None)
+    for chunk in iter_response_content(r, CHUNK_SIZE, deadline):
+      content += chunk
+      scanner.feed(chunk)
+      if len(content) > max_bytes:
+        is_truncated = True
+        break
+      if scanner.is_done:
+        is_truncated = True
+        break
+  if is_truncated and scanner.last_item_cut is not None:
+    del content[scanner.last_item_cut:]
+    content += scanner.last_item_closing
+  return FeedDownload(status, r.url, response_headers, bytes(content),
+                      is_truncated)
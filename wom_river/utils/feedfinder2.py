@@ -40,8 +40,8 @@ if not __FEEDFINDER2_SETUP__:
     __all__ = ["find_feeds"]
 
     import logging
-    import requests
     from bs4 import BeautifulSoup
+    from wom_river.utils.http_client import http_get
     from six.moves.urllib import parse as urlparse
 
 
@@ -64,8 +64,11 @@ class FeedFinder(object):
         self.timeout = timeout
 
     def get_feed(self, url):
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
         try:
-            r = requests.get(url, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+            r = http_get(url, headers={"User-Agent": self.user_agent}, **kwargs)
         except Exception as e:
             logging.warn("Error while getting '{0}'".format(url))
             logging.warn("{0}".format(e))
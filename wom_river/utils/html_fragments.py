@@ -0,0 +1,84 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Prettify the HTML fragments found in the references' descriptions and
+keep the results in a size-bounded cache.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from bs4 import BeautifulSoup
+
+
+def hash_html_fragment(html):
+  return hashlib.sha1(html.encode("utf-8")).hexdigest()
+
+
+def prettify_html_fragment(html, parser="html.parser"):
+  """Return the prettified html, parsed with the given BeautifulSoup
+  parser.
+
+  Note: errors of the prettifier are left to the caller to handle.
+  """
+  soup = BeautifulSoup(html, parser)
+  # Parsers other than python's own wrap the fragment in a whole
+  # document.
+  root = soup if parser == "html.parser" else (soup.body or soup)
+  return root.decode_contents(indent_level=0)
+
+
+def get_html_fragment_text(html, parser="html.parser"):
+  return BeautifulSoup(html, parser).text
+
+
+class LRUCache:
+  """A mapping keeping at most max_size items, forgetting the least
+  recently used ones first (safe to share between threads)."""
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._items)
+
+  def get(self, key, default=None):
+    with self._lock:
+      try:
+        self._items.move_to_end(key)
+      except KeyError:
+        return default
+      return self._items[key]
+
+  def set(self, key, value):
+    with self._lock:
+      self._items[key] = value
+      self._items.move_to_end(key)
+      while len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._items.clear()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+HTTP client shared by everything that downloads feeds or web pages, so
+that connections to a same host are kept alive and reused (saving a
+TCP and TLS handshake per request) and that the number of connections
+opened to a same host stays bounded.
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+
+from wom_river.settings import (
+    HTTP_TIMEOUT,
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    HTTP_MAX_POOLED_HOSTS,
+    )
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def build_session(max_pooled_hosts, max_connections_per_host):
+  """Create a requests' Session keeping alive up to
+  max_connections_per_host connections for each of the
+  max_pooled_hosts most recently used hosts.
+
+  Requests to a host that already has max_connections_per_host
+  connections in use wait for one of them to be released.
+  """
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=max_pooled_hosts,
+                        pool_maxsize=max_connections_per_host,
+                        pool_block=True)
+  session.mount("http://", adapter)
+  session.mount("https://", adapter)
+  # The session is shared by unrelated requests, they must not share
+  # any cookie.
+  session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+  user_agent = getattr(settings, "USER_AGENT", None)
+  if user_agent:
+    session.headers["User-Agent"] = user_agent
+  return session
+
+
+def get_session():
+  """Return the session shared by the whole process."""
+  global _session
+  with _session_lock:
+    if _session is None:
+      _session = build_session(HTTP_MAX_POOLED_HOSTS,
+                               HTTP_MAX_CONNECTIONS_PER_HOST)
+    return _session
+
+
+def http_get(url, headers=None, timeout=HTTP_TIMEOUT, **kwargs):
+  """Send a GET request through the shared session.
+
+  Same arguments as requests.get, but with a default timeout.
+
+  Note: responses must be consumed or closed (eg when using stream=True)
+  for their connection to be given back to the pool.
+  """
+  return get_session().get(url, headers=headers, timeout=timeout, **kwargs)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Helpers to decide how long to wait before polling a feed again, from
+its observed posting rate and from the hints given by the feed itself
+or by the server hosting it.
+"""
+
+import re
+from datetime import timedelta, timezone
+from email.utils import parsedate_to_datetime
+
+
+# Number of most recent items used to estimate a feed's posting rate.
+POSTING_RATE_SAMPLE_SIZE = 10
+
+# Keys of a feedparser's feed holding hints about its update period.
+FEED_HINT_KEYS = ("ttl", "sy_updateperiod", "sy_updatefrequency")
+
+SY_UPDATE_PERIODS = {
+  "hourly": timedelta(hours=1),
+  "daily": timedelta(days=1),
+  "weekly": timedelta(weeks=1),
+  "monthly": timedelta(days=30),
+  "yearly": timedelta(days=365),
+  }
+
+MAX_AGE_RE = re.compile(r"(?:^|[\s,])(?:s-)?max-age\s*=\s*\"?(\d+)")
+
+
+def parse_http_date(value):
+  """Return an aware datetime from an HTTP date or None if it can't be parsed."""
+  try:
+    date = parsedate_to_datetime(value)
+  except (TypeError, ValueError, IndexError):
+    return None
+  if date.tzinfo is None:
+    date = date.replace(tzinfo=timezone.utc)
+  return date
+
+
+def get_retry_after(headers, now):
+  """Extract the delay requested by a Retry-After header (either given as
+  a number of seconds or as a date)."""
+  value = (headers.get("retry-after", None) or "").strip()
+  if not value:
+    return None
+  if value.isdigit():
+    return timedelta(seconds=int(value))
+  date = parse_http_date(value)
+  if date is None:
+    return None
+  return max(timedelta(0), date - now)
+
+
+def get_cache_lifetime(headers, now):
+  """Extract for how long the server considers the feed as fresh, from
+  the Cache-Control header or else from the Expires one."""
+  cache_control = headers.get("cache-control", None) or ""
+  if "no-cache" in cache_control or "no-store" in cache_control:
+    return None
+  max_ages = [int(m) for m in MAX_AGE_RE.findall(cache_control)]
+  if max_ages:
+    return timedelta(seconds=max(max_ages))
+  expires = headers.get("expires", None)
+  if not expires:
+    return None
+  date = parse_http_date(expires)
+  if date is None:
+    return None
+  return max(timedelta(0), date - now)
+
+
+def get_http_hint(headers, now):
+  """Return the minimal delay before a new poll as advised by the HTTP
+  headers of a response, or None if there is no such advice."""
+  hints = [h for h in (get_retry_after(headers, now),
+                       get_cache_lifetime(headers, now))
+           if h is not None]
+  return max(hints) if hints else None
+
+
+def get_feed_hint(feed_info):
+  """Return the minimal delay before a new poll as advised by the feed
+  itself (RSS's ttl or the syndication module's updatePeriod and
+  updateFrequency), or None if there is no such advice."""
+  hints = []
+  try:
+    ttl = int(feed_info.get("ttl", "") or 0)
+  except ValueError:
+    ttl = 0
+  if ttl > 0:
+    hints.append(timedelta(minutes=ttl))
+  period = SY_UPDATE_PERIODS.get(
+      (feed_info.get("sy_updateperiod", None) or "").strip().lower(), None)
+  if period is not None:
+    try:
+      frequency = int(feed_info.get("sy_updatefrequency", "") or 1)
+    except ValueError:
+      frequency = 1
+    hints.append(period / max(1, frequency))
+  return max(hints) if hints else None
+
+
+def estimate_posting_interval(item_dates, now):
+  """Estimate the average delay between two items of a feed from the
+  publication dates of its latest items.
+
+  The time elapsed since the latest item counts as one more interval, so
+  that a feed that stopped posting gets a longer and longer estimate.
+  Return None if there are too few dates for an estimate.
+  """
+  dates = sorted((d for d in item_dates if d is not None),
+                 reverse=True)[:POSTING_RATE_SAMPLE_SIZE]
+  if len(dates) < 2:
+    return None
+  return max(timedelta(0), now - dates[-1]) / len(dates)
+
+
+def clamp_interval(interval, min_interval, max_interval):
+  return max(min_interval, min(interval, max_interval))
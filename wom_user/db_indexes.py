@@ -0,0 +1,42 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Indexes tuned for the hot queries on the users' items (see
+wom_pebbles.db_indexes).
+"""
+
+from wom_pebbles.db_indexes import TunedIndex
+
+
+# WARNING: READ ONLY ! (changing them requires a new migration)
+USER_TUNED_INDEXES = (
+  # for the sieve's unread items
+  TunedIndex("wom_user_rust_unread_idx", "wom_user_referenceuserstatus",
+             ("owner_id", "has_been_read", "reference_pub_date", "id"),
+             ("owner_id", "reference_pub_date", "id"),
+             "NOT has_been_read"),
+  # for the collection's pages as seen by other users
+  TunedIndex("wom_user_bmk_public_idx", "wom_user_userbookmark",
+             ("owner_id", "is_public", "saved_date", "id"),
+             ("owner_id", "saved_date", "id"),
+             "is_public"),
+  )
@@ -0,0 +1,186 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+"""
+Seed a dataset and show how the hot queries on the users' items are
+run (query plans and timings), with and without the tuned indexes.
+
+Everything happens in a transaction that is rolled back at the end,
+so that the command leaves no data behind.
+
+With --compare, the tuned indexes are dropped inside this transaction,
+which is only possible with the databases having a transactional DDL
+(PostgreSQL and SQLite) and locks the tables for the whole run: it is
+meant to be run against a database that isn't in use.
+"""
+
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from wom_pebbles.db_indexes import REFERENCE_TUNED_INDEXES
+from wom_pebbles.models import Reference
+
+from wom_user.db_indexes import USER_TUNED_INDEXES
+from wom_user.models import ReferenceUserStatus
+from wom_user.models import UserBookmark
+from wom_user.settings import MAX_ITEMS_PER_PAGE
+
+
+BENCHMARK_PREFIX = "wom-benchmark"
+
+# Databases whose schema changes can be rolled back
+TRANSACTIONAL_DDL_VENDORS = ("postgresql", "sqlite")
+
+
+def seed_dataset(num_users, num_sources, num_items, now):
+  """Create num_users users following num_sources sources that
+  published num_items each, most of them being read and a few of them
+  being pinned and bookmarked."""
+  users = User.objects.bulk_create(
+    User(username=f"{BENCHMARK_PREFIX}-{u}", password="!")
+    for u in range(num_users))
+  sources = Reference.objects.bulk_create(
+    Reference(url=f"http://{BENCHMARK_PREFIX}/{s}", title=f"source {s}",
+              pub_date=now)
+    for s in range(num_sources))
+  references = Reference.objects.bulk_create(
+    Reference(url=f"http://{BENCHMARK_PREFIX}/{s}/{i}", title=f"item {i}",
+              pub_date=now-timedelta(hours=i), pin_count=int(i % 10 == 0))
+    for s in range(num_sources) for i in range(num_items))
+  ReferenceSource = Reference.sources.through
+  ReferenceSource.objects.bulk_create(
+    ReferenceSource(from_reference=r, to_reference=sources[n // num_items])
+    for n, r in enumerate(references))
+  for user in users:
+    ReferenceUserStatus.objects.bulk_create(
+      (ReferenceUserStatus(owner=user, reference=r,
+                           reference_pub_date=r.pub_date,
+                           main_source=sources[n // num_items],
+                           has_been_read=(n % 5 != 0))
+       for n, r in enumerate(references)),
+      batch_size=1000)
+    UserBookmark.objects.bulk_create(
+      (UserBookmark(owner=user, reference=r, saved_date=r.pub_date,
+                    is_public=(n % 20 == 0))
+       for n, r in enumerate(references) if n % 10 == 0),
+      batch_size=1000)
+  return users[0], sources[0]
+
+
+def analyze_tables(tables):
+  """Refresh the planner's statistics where it's needed to get
+  realistic plans."""
+  if connection.vendor not in ("postgresql", "sqlite"):
+    return
+  with connection.cursor() as cursor:
+    for table in tables:
+      cursor.execute("ANALYZE %s" % connection.ops.quote_name(table))
+
+
+def drop_indexes(indexes):
+  """Drop the indexes inside the current transaction (where the schema
+  editor can't be used with SQLite)."""
+  qn = connection.ops.quote_name
+  with connection.cursor() as cursor:
+    for index in indexes:
+      cursor.execute(connection.SchemaEditorClass.sql_delete_index
+                     % {"table": qn(index.table), "name": qn(index.name)})
+
+
+def get_hot_queries(user, source, now):
+  obsolete_date = now - timedelta(days=7)
+  return (
+    ("unread items (sieve)",
+     ReferenceUserStatus.objects.filter(owner=user, has_been_read=False)
+                                .order_by("reference_pub_date", "id")
+                                [:MAX_ITEMS_PER_PAGE]),
+    ("obsolete unpinned references",
+     Reference.objects.filter(pin_count=0, pub_date__lt=obsolete_date)),
+    ("obsolete unpinned references of a feed",
+     source.productions.filter(pin_count=0, pub_date__lt=obsolete_date)),
+    ("public bookmarks (collection)",
+     UserBookmark.objects.filter(owner=user, is_public=True)
+                         .order_by("-saved_date", "-id")
+                         [:MAX_ITEMS_PER_PAGE]),
+    )
+
+
+def measure(queryset, repeat):
+  """Return the best time (in seconds) taken by the query over repeat
+  runs."""
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    list(queryset.all())
+    timings.append(time.perf_counter() - start)
+  return min(timings)
+
+
+class Command(BaseCommand):
+
+  help = ("Show the plans and timings of the hot queries on the users' "
+          "items over a seeded dataset.")
+
+  def add_arguments(self, parser):
+    parser.add_argument("--users", type=int, default=5,
+                        help="Number of users to create.")
+    parser.add_argument("--sources", type=int, default=10,
+                        help="Number of sources followed by each user.")
+    parser.add_argument("--items", type=int, default=500,
+                        help="Number of items published by each source.")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of runs of each query to time.")
+    parser.add_argument("--compare", action="store_true",
+                        help="Run the queries again without the tuned indexes "
+                        "(locking the tables until the end, PostgreSQL and "
+                        "SQLite only).")
+
+  def handle(self, *args, **options):
+    if (options["compare"]
+        and connection.vendor not in TRANSACTIONAL_DDL_VENDORS):
+      raise CommandError("--compare would drop the tuned indexes for good "
+                         f"with {connection.vendor}.")
+    now = datetime.now(timezone.utc)
+    with transaction.atomic():
+      user, source = seed_dataset(options["users"], options["sources"],
+                                  options["items"], now)
+      tables = {i.table for i in REFERENCE_TUNED_INDEXES + USER_TUNED_INDEXES}
+      analyze_tables(tables)
+      self.report("with tuned indexes", user, source, now, options["repeat"])
+      if options["compare"]:
+        drop_indexes(REFERENCE_TUNED_INDEXES + USER_TUNED_INDEXES)
+        analyze_tables(tables)
+        self.report("without tuned indexes", user, source, now,
+                    options["repeat"])
+      transaction.set_rollback(True)
+
+  def report(self, title, user, source, now, repeat):
+    self.stdout.write(f"=== {title} ({connection.vendor}) ===")
+    for name, queryset in get_hot_queries(user, source, now):
+      self.stdout.write(f"--- {name}")
+      self.stdout.write(queryset.explain())
+      self.stdout.write(f"best of {repeat}: "
+                        f"{measure(queryset, repeat)*1000:.2f}ms")
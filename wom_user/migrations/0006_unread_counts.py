@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:55
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_unread_references(apps, schema_editor):
+    ReferenceUserStatus = apps.get_model('wom_user', 'ReferenceUserStatus')
+    UnreadCount = apps.get_model('wom_user', 'UnreadCount')
+    UserProfile = apps.get_model('wom_user', 'UserProfile')
+    counts = ReferenceUserStatus.objects.filter(has_been_read=False)\
+        .values('owner_id', 'main_source_id')\
+        .annotate(count=Count('id')).order_by()
+    totals = {}
+    new_counts = []
+    for c in counts:
+        new_counts.append(UnreadCount(owner_id=c['owner_id'],
+                                      source_id=c['main_source_id'],
+                                      count=c['count']))
+        totals[c['owner_id']] = totals.get(c['owner_id'], 0) + c['count']
+    UnreadCount.objects.bulk_create(new_counts)
+    for owner_id, total in totals.items():
+        UserProfile.objects.filter(owner_id=owner_id)\
+                           .update(num_unread_references=total)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_pebbles', '0003_reference_content_fingerprint'),
+        ('wom_user', '0005_userprofile_unread_status_checked_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='num_unread_references',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UnreadCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='wom_pebbles.reference')),
+            ],
+            options={
+                'unique_together': {('owner', 'source')},
+            },
+        ),
+        migrations.RunPython(count_unread_references,
+                             migrations.RunPython.noop),
+    ]
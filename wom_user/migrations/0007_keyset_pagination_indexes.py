@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_pebbles', '0003_reference_content_fingerprint'),
+        ('wom_user', '0006_unread_counts'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referenceuserstatus',
+            index=models.Index(fields=['owner', '-reference_pub_date', '-id'], name='wom_user_rust_river_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userbookmark',
+            index=models.Index(fields=['owner', '-saved_date', '-id'], name='wom_user_bmk_collection_idx'),
+        ),
+    ]
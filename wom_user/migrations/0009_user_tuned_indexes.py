@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from wom_pebbles.db_indexes import create_tuned_indexes, drop_tuned_indexes
+from wom_user.db_indexes import USER_TUNED_INDEXES
+
+
+def add_indexes(apps, schema_editor):
+    create_tuned_indexes(schema_editor, USER_TUNED_INDEXES)
+
+
+def remove_indexes(apps, schema_editor):
+    drop_tuned_indexes(schema_editor, USER_TUNED_INDEXES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wom_user', '0008_read_watermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_indexes, remove_indexes),
+    ]
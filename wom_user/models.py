@@ -18,18 +18,29 @@
 # along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import Counter
+from datetime import datetime, timezone
+
 from django.db import models
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+from django.db.models.signals import m2m_changed
+from django.core.exceptions import ObjectDoesNotExist
+from django.dispatch import receiver
 
 from django.contrib.auth.models import User
 
 from wom_pebbles.models import Reference
 
 from wom_river.models import WebFeed, WebFeedCollation
+from wom_river.signals import references_collected
 
 from wom_classification.models import get_item_tag_names
 
 from wom_tributary.models import GeneratedFeed
 
+from wom_user.settings import UNREAD_STATUS_FAN_OUT
+
 
 class UserProfile(models.Model):
   """
@@ -47,10 +58,38 @@ class UserProfile(models.Model):
   public_sources = models.ManyToManyField(Reference,related_name="publicly_related_userprofile")
   # Feeds providing anything else than the plain content of "simple" web feed
   generated_feeds = models.ManyToManyField(GeneratedFeed,related_name="userprofile")
+  # Date of the last time the unread items of all followed feeds were
+  # turned into ReferenceUserStatus (reset when the followed feeds change)
+  unread_status_checked_at = models.DateTimeField(
+      default=datetime.fromtimestamp(0, timezone.utc))
+  # Number of unread ReferenceUserStatus (maintained along with the
+  # UnreadCount of each source)
+  num_unread_references = models.IntegerField(default=0)
   
   def __str__(self):
     return "%s>Profile" % self.owner
 
+  def invalidate_unread_status(self):
+    """Mark the unread statuses as needing a check."""
+    UserProfile.objects.filter(pk=self.pk)\
+                       .update(unread_status_checked_at=datetime.fromtimestamp(0, timezone.utc))
+
+
+@receiver(m2m_changed, sender=UserProfile.web_feeds.through)
+@receiver(m2m_changed, sender=UserProfile.collating_feeds.through)
+@receiver(m2m_changed, sender=UserProfile.generated_feeds.through)
+def invalidate_unread_status_on_followed_feeds_change(sender, instance, action,
+                                                      reverse, pk_set, **kwargs):
+  """Make sure that the items of a newly followed feed show up at the
+  next visit of the river or sieve."""
+  if action not in ("post_add", "post_remove", "post_clear"):
+    return
+  if not reverse:
+    instance.invalidate_unread_status()
+  elif pk_set:
+    UserProfile.objects.filter(pk__in=pk_set)\
+                       .update(unread_status_checked_at=datetime.fromtimestamp(0, timezone.utc))
+
 
 class UserBookmark(models.Model):
   """This is the "personal" facette of a Reference and may contain
@@ -69,6 +108,13 @@ class UserBookmark(models.Model):
   is_public = models.BooleanField(default=False)
   # User-specific note about the reference
   comment = models.TextField(default="", blank=True)
+
+  class Meta:
+    indexes = [
+      # for the collection's pages (see wom_user.pagination)
+      models.Index(fields=["owner", "-saved_date", "-id"],
+                   name="wom_user_bmk_collection_idx"),
+      ]
   
   def __str__(self):
     return "%s%s>%s" % (self.owner,"" if self.is_public else "<private",
@@ -135,6 +181,13 @@ class ReferenceUserStatus(models.Model):
   has_been_saved = models.BooleanField(default=False)
   # The main source (used to ease display)
   main_source = models.ForeignKey(Reference,related_name="+", on_delete=models.CASCADE)
+
+  class Meta:
+    indexes = [
+      # for the river's pages (see wom_user.pagination)
+      models.Index(fields=["owner", "-reference_pub_date", "-id"],
+                   name="wom_user_rust_river_idx"),
+      ]
   
   
   def __str__(self):
@@ -144,3 +197,266 @@ class ReferenceUserStatus(models.Model):
   def get_tag_names(self):
     """Get the names of the tags related to this reference."""
     return get_item_tag_names(self.owner,self.reference)
+
+
+class ReadWatermark(models.Model):
+  """Date up to which all the items of a source are considered as
+  already seen by a user, kept when the ReferenceUserStatus of read
+  items are compacted away, so that they don't come back as unread.
+  """
+  owner = models.ForeignKey(User, on_delete=models.CASCADE)
+  source = models.ForeignKey(Reference, related_name="read_watermarks",
+                             on_delete=models.CASCADE)
+  read_until = models.DateTimeField()
+
+  class Meta:
+    unique_together = ("owner", "source")
+
+
+def raise_read_watermarks(watermarks):
+  """Make sure that the read watermarks given as a mapping of (owner
+  id, source id) to a date are at least at this date."""
+  if not watermarks:
+    return
+  with transaction.atomic():
+    existing = {(w.owner_id, w.source_id): w
+                for w in ReadWatermark.objects.select_for_update()\
+                .filter(owner_id__in={o for o, _ in watermarks},
+                        source_id__in={s for _, s in watermarks})\
+                .order_by("pk")
+                if (w.owner_id, w.source_id) in watermarks}
+    raised = []
+    new_watermarks = []
+    for (owner_id, source_id), date in watermarks.items():
+      w = existing.get((owner_id, source_id), None)
+      if w is None:
+        new_watermarks.append(ReadWatermark(owner_id=owner_id,
+                                            source_id=source_id,
+                                            read_until=date))
+      elif w.read_until < date:
+        w.read_until = date
+        raised.append(w)
+    ReadWatermark.objects.bulk_update(raised, ["read_until"])
+    ReadWatermark.objects.bulk_create(new_watermarks)
+
+
+def exclude_references_below_read_watermark(references, user):
+  """Filter out of a Reference queryset the references that are older
+  than the user's read watermark of one of their sources."""
+  return references.exclude(Exists(
+    ReadWatermark.objects.filter(owner=user,
+                                 source__productions=OuterRef("pk"),
+                                 read_until__gte=OuterRef("pub_date"))))
+
+
+class UnreadCount(models.Model):
+  """Number of unread ReferenceUserStatus of a user having a given
+  main source, maintained to avoid counting them at each page view.
+  """
+  owner = models.ForeignKey(User, on_delete=models.CASCADE)
+  source = models.ForeignKey(Reference, related_name="+", on_delete=models.CASCADE)
+  count = models.IntegerField(default=0)
+
+  class Meta:
+    unique_together = ("owner", "source")
+
+
+def update_unread_counts(deltas):
+  """Apply the changes given as a mapping of (owner id, source id) to
+  the variation of the number of unread items, to the per source and
+  per user counts (with a constant number of queries).
+  """
+  deltas = {key: delta for key, delta in deltas.items() if delta}
+  if not deltas:
+    return
+  total_deltas = Counter()
+  for (owner_id, _), delta in deltas.items():
+    total_deltas[owner_id] += delta
+  with transaction.atomic():
+    # Create the missing rows first, ignoring the ones concurrently
+    # created by another update, so that all of them can be locked.
+    # The rows are locked in a consistent order to avoid deadlocks with
+    # the other updates.
+    UnreadCount.objects.bulk_create(
+      [UnreadCount(owner_id=owner_id, source_id=source_id, count=0)
+       for owner_id, source_id in sorted(deltas)],
+      ignore_conflicts=True)
+    counts = [c for c in UnreadCount.objects.select_for_update()\
+              .filter(owner_id__in=total_deltas.keys(),
+                      source_id__in={s for _, s in deltas})\
+              .order_by("pk")
+              if (c.owner_id, c.source_id) in deltas]
+    for count in counts:
+      count.count = max(0, count.count+deltas[(count.owner_id, count.source_id)])
+    UnreadCount.objects.bulk_update(counts, ["count"])
+    profiles = list(UserProfile.objects.select_for_update()\
+                    .filter(owner_id__in=total_deltas.keys())\
+                    .order_by("pk"))
+    for profile in profiles:
+      profile.num_unread_references = max(
+        0, profile.num_unread_references+total_deltas[profile.owner_id])
+    UserProfile.objects.bulk_update(profiles, ["num_unread_references"])
+
+
+def add_to_unread_counts(rusts):
+  """Count newly created ReferenceUserStatus."""
+  update_unread_counts(Counter((r.owner_id, r.main_source_id)
+                               for r in rusts if not r.has_been_read))
+
+
+def mark_as_read(rusts):
+  """Mark the unread ReferenceUserStatus of a queryset as read with a
+  single UPDATE (and update the unread counts accordingly).
+
+  Return the number of ReferenceUserStatus that were marked as read.
+  """
+  rusts = rusts.filter(has_been_read=False)
+  with transaction.atomic():
+    counts = rusts.values_list("owner_id", "main_source_id")\
+                  .annotate(count=Count("id"))\
+                  .order_by()
+    deltas = {(owner_id, source_id): -count
+              for owner_id, source_id, count in counts}
+    num_read = rusts.update(has_been_read=True)
+    update_unread_counts(deltas)
+  return num_read
+
+
+def recount_unread_counts(user=None):
+  """Recompute the unread counts (of a given user or of all users) from
+  scratch, typically after ReferenceUserStatus were deleted in bulk.
+
+  The counts are replaced in one transaction, locking them in the same
+  order as update_unread_counts.
+  """
+  rusts = ReferenceUserStatus.objects.filter(has_been_read=False)
+  counts = UnreadCount.objects.all()
+  profiles = UserProfile.objects.all()
+  if user is not None:
+    rusts = rusts.filter(owner=user)
+    counts = counts.filter(owner=user)
+    profiles = profiles.filter(owner=user)
+  new_counts = {(c["owner_id"], c["main_source_id"]): c["count"]
+                for c in rusts.values("owner_id", "main_source_id")\
+                              .annotate(count=Count("id"))\
+                              .order_by()}
+  totals = Counter()
+  for (owner_id, _), count in new_counts.items():
+    totals[owner_id] += count
+  with transaction.atomic():
+    UnreadCount.objects.bulk_create(
+      [UnreadCount(owner_id=owner_id, source_id=source_id, count=0)
+       for owner_id, source_id in sorted(new_counts)],
+      ignore_conflicts=True)
+    locked_counts = list(counts.select_for_update().order_by("pk"))
+    for c in locked_counts:
+      c.count = new_counts.get((c.owner_id, c.source_id), 0)
+    UnreadCount.objects.bulk_update(locked_counts, ["count"])
+    counts.filter(count=0).delete()
+    locked_profiles = list(profiles.select_for_update().order_by("pk"))
+    for profile in locked_profiles:
+      profile.num_unread_references = totals[profile.owner_id]
+    UserProfile.objects.bulk_update(locked_profiles, ["num_unread_references"])
+
+
+# Memo of the Reference representing an unknown source (see
+# get_unknown_reference).
+_unknown_reference = None
+
+
+def _remember_unknown_reference(reference):
+  global _unknown_reference
+  _unknown_reference = reference
+
+
+def get_unknown_reference():
+  """Returns 'the' Reference representing an unknown source.
+  NOTE: Will create it if it hasn't been created yet.
+
+  The reference is memoized for the whole process once it is known to
+  be committed (it is pinned so that it's never deleted as obsolete).
+  """
+  if _unknown_reference is not None:
+    return _unknown_reference
+  try:
+    s = Reference.objects.get(url="<unknown>")
+  except ObjectDoesNotExist:
+    s = Reference(url="<unknown>",title="<unknown>",
+                  pin_count=1,
+                  pub_date=datetime.fromtimestamp(0, timezone.utc))
+    s.save()
+  transaction.on_commit(lambda: _remember_unknown_reference(s))
+  return s
+
+
+def get_main_source_candidates(owner_ids):
+  """Return the links between references and their sources known to
+  the given owners, the main source of each reference for each owner
+  (ie the oldest of its sources known to the owner) coming first."""
+  ReferenceSource = Reference.sources.through
+  return ReferenceSource.objects\
+                        .filter(to_reference__userprofile__owner_id__in=owner_ids)\
+                        .order_by("to_reference__pub_date", "to_reference_id")
+
+
+def get_main_source_ids_by_owner(owner_ids, references):
+  """Return a dict mapping (owner id, reference id) pairs to the id of
+  the reference's main source for the owner, ie the oldest of its
+  sources known to the owner (or the unknown reference, see
+  get_unknown_reference, if there is none).
+  """
+  sources = get_main_source_candidates(owner_ids)\
+              .filter(from_reference_id__in=[r.pk for r in references])\
+              .values_list("to_reference__userprofile__owner_id",
+                           "from_reference_id", "to_reference_id")
+  main_source_ids = {}
+  for owner_id, ref_id, source_id in sources:
+    main_source_ids.setdefault((owner_id, ref_id), source_id)
+  if len(main_source_ids) < len(owner_ids)*len(references):
+    unknown_reference_id = get_unknown_reference().pk
+    for owner_id in owner_ids:
+      for r in references:
+        main_source_ids.setdefault((owner_id, r.pk), unknown_reference_id)
+  return main_source_ids
+
+
+@receiver(references_collected)
+def fan_out_reference_user_statuses(sender, feed, references, **kwargs):
+  """Create the unread statuses of references newly collected from a
+  feed for all the users following it.
+
+  Users collating the feed are left out, their unread items being
+  generated from the collations by check_user_unread_feed_items.
+
+  The main source of each status is picked as check_user_unread_feed_items
+  does (see get_main_source_ids_by_owner).
+  """
+  if not UNREAD_STATUS_FAN_OUT:
+    return
+  owner_ids = list(UserProfile.objects\
+                   .filter(web_feeds=feed)\
+                   .exclude(collating_feeds__feed=feed)\
+                   .values_list("owner_id", flat=True)\
+                   .distinct())
+  if not owner_ids:
+    return
+  references = list({r.pk: r for r in references}.values())
+  read_watermarks = dict(ReadWatermark.objects\
+                         .filter(owner_id__in=owner_ids, source=feed.source_id)\
+                         .values_list("owner_id", "read_until"))
+  existing_statuses = set(ReferenceUserStatus.objects\
+                          .filter(owner_id__in=owner_ids,
+                                  reference__in=references)\
+                          .values_list("owner_id", "reference_id"))
+  main_source_ids = get_main_source_ids_by_owner(owner_ids, references)
+  new_rusts = ReferenceUserStatus.objects.bulk_create(
+    [ReferenceUserStatus(reference=r,
+                         owner_id=owner_id,
+                         reference_pub_date=r.pub_date,
+                         main_source_id=main_source_ids[(owner_id, r.pk)])
+     for owner_id in owner_ids
+     for r in references
+     if (owner_id, r.pk) not in existing_statuses
+     and (owner_id not in read_watermarks
+          or r.pub_date > read_watermarks[owner_id])])
+  add_to_unread_counts(new_rusts)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars)
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+"""
+Paginate lists of items ordered newest first with cursors (the date and
+id of the items at the edges of a page) instead of page offsets, so
+that reaching a deep page costs the same as reaching the first one.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+
+EPOCH = datetime.fromtimestamp(0, timezone.utc)
+
+
+def encode_cursor(date, pk):
+  """Build a compact url-safe cursor from an item's date and id."""
+  return "%d_%d" % ((date - EPOCH) // timedelta(microseconds=1), pk)
+
+
+def decode_cursor(cursor):
+  """Return the (date, id) encoded in a cursor or None if it is invalid."""
+  try:
+    microseconds, pk = (int(v) for v in cursor.split("_"))
+    return EPOCH + timedelta(microseconds=microseconds), pk
+  except (AttributeError, ValueError, OverflowError):
+    return None
+
+
+class KeysetPage:
+  """A page of items, iterable like the pages of Django's Paginator."""
+
+  def __init__(self, object_list, paginator, number, has_next, has_previous):
+    self.object_list = object_list
+    self.paginator = paginator
+    self.number = number
+    self._has_next = has_next
+    self._has_previous = has_previous
+
+  def __len__(self):
+    return len(self.object_list)
+
+  def __iter__(self):
+    return iter(self.object_list)
+
+  def __getitem__(self, index):
+    return self.object_list[index]
+
+  def has_next(self):
+    return self._has_next
+
+  def has_previous(self):
+    return self._has_previous
+
+  def has_other_pages(self):
+    return self._has_next or self._has_previous
+
+  def next_page_number(self):
+    return self.number+1
+
+  def previous_page_number(self):
+    return max(1, self.number-1)
+
+  def next_cursor(self):
+    if not self.object_list:
+      return ""
+    return self.paginator.get_cursor(self.object_list[-1])
+
+  def previous_cursor(self):
+    if not self.object_list:
+      return ""
+    return self.paginator.get_cursor(self.object_list[0])
+
+
+class KeysetPaginator:
+  """Paginate a queryset by date, newest first, ties being broken by
+  decreasing id.
+
+  The total number of items is only counted if the count attribute is
+  actually used.
+  """
+
+  def __init__(self, queryset, date_field, per_page):
+    self.queryset = queryset
+    self.date_field = date_field
+    self.per_page = per_page
+
+  @cached_property
+  def count(self):
+    return self.queryset.count()
+
+  def get_cursor(self, item):
+    return encode_cursor(getattr(item, self.date_field), item.pk)
+
+  def page(self, after=None, before=None, number=1):
+    """Get the page of items older than the 'after' cursor, or the one of
+    the items newer than the 'before' cursor, or else the first page.
+
+    The page number is only used as a label for the page.
+    """
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+    d = self.date_field
+    if after is not None:
+      date, pk = after
+      items = list(self.queryset\
+                   .filter(Q(**{f"{d}__lt": date}) | Q(**{d: date, "pk__lt": pk}))\
+                   .order_by(f"-{d}", "-pk")[:self.per_page+1])
+      has_next = len(items) > self.per_page
+      return KeysetPage(items[:self.per_page], self, max(2, number),
+                        has_next, True)
+    if before is not None:
+      date, pk = before
+      items = list(self.queryset\
+                   .filter(Q(**{f"{d}__gt": date}) | Q(**{d: date, "pk__gt": pk}))\
+                   .order_by(d, "pk")[:self.per_page+1])
+      has_previous = len(items) > self.per_page
+      items = list(reversed(items[:self.per_page]))
+      if not has_previous:
+        number = 1
+      return KeysetPage(items, self, number, True, has_previous)
+    items = list(self.queryset.order_by(f"-{d}", "-pk")[:self.per_page+1])
+    return KeysetPage(items[:self.per_page], self, 1,
+                      len(items) > self.per_page, False)
+
+  def get_page(self, query_dict):
+    """Get the page selected by the 'after', 'before' and 'page'
+    parameters of a request."""
+    try:
+      number = int(query_dict.get("page", 1))
+    except ValueError:
+      number = 1
+    return self.page(after=query_dict.get("after"),
+                     before=query_dict.get("before"),
+                     number=number)
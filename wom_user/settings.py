@@ -42,6 +42,64 @@ if hasattr(settings,"WOM_WEB_FEED_COLLATION_TIMEOUT"):
 else:
   WEB_FEED_COLLATION_TIMEOUT = timedelta(days=1)
 
+# Whether the collations of a feed are shared by all the users
+# collating it (one collated reference being built per time window of
+# WEB_FEED_COLLATION_TIMEOUT) instead of being built for each user
+# (WEB_FEED_COLLATION_MIN_NUM_REF_TARGET doesn't apply to them, the
+# time windows being the same for all users)
+if hasattr(settings,"WOM_USER_SHARED_COLLATIONS"):
+  SHARED_COLLATIONS = settings.WOM_USER_SHARED_COLLATIONS
+else:
+  SHARED_COLLATIONS = False
+
+# Max age of the last check of a user's unread items before the river
+# and sieve views check them again by themselves (which they should
+# not have to do when news are collected regularly)
+if hasattr(settings,"WOM_USER_UNREAD_STATUS_MAX_AGE"):
+  UNREAD_STATUS_MAX_AGE = settings.WOM_USER_UNREAD_STATUS_MAX_AGE
+else:
+  UNREAD_STATUS_MAX_AGE = timedelta(hours=1)
+
+# Whether to create the unread statuses of the followers of a feed as
+# soon as new items are collected from it
+if hasattr(settings,"WOM_USER_UNREAD_STATUS_FAN_OUT"):
+  UNREAD_STATUS_FAN_OUT = settings.WOM_USER_UNREAD_STATUS_FAN_OUT
+else:
+  UNREAD_STATUS_FAN_OUT = True
+
+# Age (in terms of publication date) after which the status of read
+# (and not saved) items is deleted, only a per source read watermark
+# being kept
+if hasattr(settings,"WOM_USER_READ_STATUS_RETENTION"):
+  READ_STATUS_RETENTION = settings.WOM_USER_READ_STATUS_RETENTION
+else:
+  READ_STATUS_RETENTION = timedelta(weeks=8)
+
+if hasattr(settings,"WOM_USER_READ_STATUS_COMPACTION_BATCH_SIZE"):
+  READ_STATUS_COMPACTION_BATCH_SIZE = settings.WOM_USER_READ_STATUS_COMPACTION_BATCH_SIZE
+else:
+  READ_STATUS_COMPACTION_BATCH_SIZE = 1000
+
+# Max number of obsolete references deleted in a same transaction
+if hasattr(settings,"WOM_USER_OBSOLETE_REFERENCES_BATCH_SIZE"):
+  OBSOLETE_REFERENCES_BATCH_SIZE = settings.WOM_USER_OBSOLETE_REFERENCES_BATCH_SIZE
+else:
+  OBSOLETE_REFERENCES_BATCH_SIZE = 1000
+
+# Time (in seconds) a batch of deletions of obsolete references should
+# take at most, the batches being made smaller when they take longer
+if hasattr(settings,"WOM_USER_OBSOLETE_REFERENCES_BATCH_DURATION"):
+  OBSOLETE_REFERENCES_BATCH_DURATION = settings.WOM_USER_OBSOLETE_REFERENCES_BATCH_DURATION
+else:
+  OBSOLETE_REFERENCES_BATCH_DURATION = 2.0
+
+# Time (in seconds) after which a deletion of obsolete references
+# stops, leaving the remaining ones to the next deletion
+if hasattr(settings,"WOM_USER_OBSOLETE_REFERENCES_TIME_BUDGET"):
+  OBSOLETE_REFERENCES_TIME_BUDGET = settings.WOM_USER_OBSOLETE_REFERENCES_TIME_BUDGET
+else:
+  OBSOLETE_REFERENCES_TIME_BUDGET = 300.0
+
 if hasattr(settings,"WOM_USER_MAX_ITEMS_PER_PAGE"):
   MAX_ITEMS_PER_PAGE = settings.WOM_USER_MAX_ITEMS_PER_PAGE
 else:
@@ -19,16 +19,24 @@
 #
 
 from django.db import transaction
+from django.db.models import Exists, Max, OuterRef, Q, Subquery
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.exceptions import MultipleObjectsReturned
 
+import time
 from datetime import datetime, timezone
 
 from django.conf import settings
 from wom_user.settings import (
     WEB_FEED_COLLATION_MIN_NUM_REF_TARGET,
     WEB_FEED_COLLATION_MAX_NUM_REF_TARGET,
-    WEB_FEED_COLLATION_TIMEOUT
+    WEB_FEED_COLLATION_TIMEOUT,
+    UNREAD_STATUS_MAX_AGE,
+    READ_STATUS_RETENTION,
+    READ_STATUS_COMPACTION_BATCH_SIZE,
+    OBSOLETE_REFERENCES_BATCH_SIZE,
+    OBSOLETE_REFERENCES_BATCH_DURATION,
+    OBSOLETE_REFERENCES_TIME_BUDGET,
+    SHARED_COLLATIONS,
     )
 
 if settings.USE_CELERY:
@@ -52,16 +60,26 @@ else:
 from wom_pebbles.tasks import delete_old_unpinned_references
 from wom_pebbles.tasks import import_references_from_ns_bookmark_list
 
+from wom_river.settings import REFERENCE_SAVE_BATCH_SIZE
+from wom_river.settings import FEED_POLL_MIN_INTERVAL
 from wom_river.tasks import (
-    collect_news_from_feeds,
+    collect_news_from_feeds_by_lanes,
     import_feedsources_from_opml,
-    generate_collations
+    generate_collations,
+    generate_shared_collations,
     )
 
 from wom_pebbles.models import Reference
 from wom_user.models import UserBookmark
 from wom_user.models import UserProfile
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import add_to_unread_counts
+from wom_user.models import get_main_source_ids_by_owner
+from wom_user.models import get_main_source_candidates
+from wom_user.models import get_unknown_reference
+from wom_user.models import recount_unread_counts
+from wom_user.models import raise_read_watermarks
+from wom_user.models import exclude_references_below_read_watermark
 
 from wom_classification.models import TAG_NAME_MAX_LENGTH
 from wom_classification.models import set_item_tag_names
@@ -81,19 +99,46 @@ logger = logging.getLogger(__name__)
 @periodic_task(run_every=crontab(hour="*", minute="*/20", day_of_week="*"))
 def collect_all_new_references_regularly():
   collect_news_from_followed_feeds()
+  check_all_users_unread_feed_items()
 
 @periodic_task(run_every=crontab(hour="*/1", day_of_week="*"))
 def collect_all_new_mastodon_references_regularly():
   collect_news_from_mastodon_feeds(1)
+  check_all_users_unread_feed_items()
 
 @periodic_task(run_every=crontab(hour="*/12", day_of_week="*"))
 def delete_obsolete_unpinned_references_regularly():
   delete_obsolete_unpinned_references_from_feeds()
 
+@periodic_task(run_every=crontab(hour="*/12", minute="30", day_of_week="*"))
+def delete_corrupted_rusts_regularly():
+  clean_corrupted_rusts()
+
+@periodic_task(run_every=crontab(hour="5", minute="0", day_of_week="*"))
+def delete_orphan_references_regularly():
+  delete_orphan_references()
+
+@periodic_task(run_every=crontab(hour="4", minute="0", day_of_week="*"))
+def compact_read_rusts_regularly():
+  compact_read_reference_user_statuses(
+    datetime.now(timezone.utc) - READ_STATUS_RETENTION)
+
 
 def collect_news_from_followed_feeds():
-  feeds = WebFeed.objects.exclude(userprofile=None).exclude(permanent_failure_detected=True).iterator()
-  collect_news_from_feeds(feeds)
+  """Collect news from the followed feeds that are due for a new poll.
+
+  Feeds due within half the shortest poll interval are collected too:
+  as a feed's next poll is scheduled from the end of its download, the
+  feeds polled at the shortest interval would otherwise always be due
+  a few seconds after the start of the next run and wait for the
+  following one.
+  """
+  due_date = datetime.now(timezone.utc) + FEED_POLL_MIN_INTERVAL / 2
+  feeds = WebFeed.objects.exclude(userprofile=None)\
+                         .exclude(permanent_failure_detected=True)\
+                         .filter(next_poll_at__lte=due_date)\
+                         .order_by("next_poll_at")
+  collect_news_from_feeds_by_lanes(feeds)
 
 
 @task()
@@ -156,36 +201,27 @@ class FakeReferenceUserStatus:
     self.user = None 
 
 
-def get_unknown_reference():
-  """Returns 'the' Reference representing an unknown source.
-  NOTE: Will create it if it hasn't been created yet.
+def get_main_source_ids(user, references):
+  """Return a dict mapping the ids of the given references to the id of
+  their main source for the user (see get_main_source_ids_by_owner).
   """
-  try:
-    return Reference.objects.get(url="<unknown>")
-  except ObjectDoesNotExist:
-    s = Reference(url="<unknown>",title="<unknown>",
-                  pin_count=1,
-                  pub_date=datetime.fromtimestamp(0, timezone.utc))        
-    s.save()
-    return s
-
-  
+  return {ref_id: source_id
+          for (_, ref_id), source_id
+          in get_main_source_ids_by_owner([user.pk], references).items()}
+
+
 def generate_reference_user_status(user,references):
   """Generate reference user status instances for a given set of references.
   WARNING: the new instances are not saved in the database!
   """
+  references = list(references)
+  if not references:
+    return []
+  main_source_ids = get_main_source_ids(user, references)
   new_ref_status = []
   for ref in references:
-    source_query = ref.sources.filter(userprofile=user.userprofile)\
-                              .distinct().order_by("pub_date")
-    try:
-      s = source_query.get()
-    except MultipleObjectsReturned:
-      s = source_query.all()[0]
-    except ObjectDoesNotExist:
-      s = get_unknown_reference()
     rust = ReferenceUserStatus()
-    rust.main_source = s
+    rust.main_source_id = main_source_ids[ref.pk]
     rust.owner = user
     rust.reference = ref
     rust.reference_pub_date = ref.pub_date
@@ -193,67 +229,73 @@ def generate_reference_user_status(user,references):
   return new_ref_status
 
 
-def clean_corrupted_rusts(user):
-  """Check that a user's ReferenceUserStatus still correspond to a
-  valid reference and a valid main_source.
+def clean_corrupted_rusts(user=None):
+  """Delete the ReferenceUserStatus (of a given user or of all users)
+  that don't point to a valid reference and a valid main_source anymore.
+
+  Return the number of deleted instances.
   """
-  # first cleanup strange corruption happening sometimes in the db
-  for rust in ReferenceUserStatus.objects.filter(owner=user,has_been_read=False):
-    corrupted = False
-    try:
-      rust_ref = str(rust.reference)
-    except ObjectDoesNotExist:
-      rust_ref = "not-found"
-      corrupted = True
-    except Exception as e:
-      rust_ref = "err(%s)" % e
-    try:
-      rust_src = str(rust.main_source)
-    except ObjectDoesNotExist:
-      rust_src = "not-found"
-      corrupted = True
-    except Exception as e:
-      rust_src = "err(%s)" % e
-    if corrupted:
-      logger.warning("Deleting corrupted ReferenceUserStatus: \
-read %s, pub_date %s, reference %s, source %s." \
-                     % (rust.has_been_read,rust.reference_pub_date,
-                        rust_ref,rust_src))
-      try:
-        rust.delete()
-      except Exception as e:
-        logger.error("Could not delete a corrupted ReferenceUserStatus (%s)." % e)
-        continue
+  # cleanup strange corruption happening sometimes in the db
+  rusts = ReferenceUserStatus.objects.all()
+  if user is not None:
+    rusts = rusts.filter(owner=user)
+  corrupted_rusts = rusts.filter(
+    ~Exists(Reference.objects.filter(pk=OuterRef("reference_id")))
+    | ~Exists(Reference.objects.filter(pk=OuterRef("main_source_id"))))
+  corrupted_count, _ = corrupted_rusts.delete()
+  if corrupted_count:
+    logger.warning("Deleted %d corrupted ReferenceUserStatus." % corrupted_count)
+    recount_unread_counts(user)
+  else:
+    logger.info("No corrupted ReferenceUserStatus found.")
+  return corrupted_count
 
 # TODO test
 def build_feed_collation_map(user):
-  collating_feeds = user.userprofile.collating_feeds.select_related("feed").all()
+  # Only the followed feeds are collated (the collation of a feed being
+  # kept when the user stops following it).
+  profile = user.userprofile
+  collating_feeds = profile.collating_feeds.select_related("feed")\
+                                           .filter(feed__in=profile.web_feeds.all())
   return {cf.feed: cf for cf in collating_feeds}
 
     
-@task()  
-def check_user_unread_feed_items(user):
-  """Browse all feed sources registered by a given user and create as
-  many ReferenceUserStatus instances as there are unread items.
+def generate_collated_reference_user_status(user, feed_collations):
+  """Generate the collations of the user's collated feeds and return the
+  (unsaved) reference user statuses of the resulting references.
 
-  NOTE: will avoid creating 2 reference user statuses pointing to a
-  same reference.
+  With SHARED_COLLATIONS, the collated references are built once per
+  feed and time window for all users, and the user only gets the ones
+  holding items of ended windows that were not collated for them yet.
   """
-  clean_corrupted_rusts(user)
   new_ref_status = []
   processed_references = set()
-  discarded_ref_count = 0
-  feed_collations = build_feed_collation_map(user)
-  collation_url_parent_path = f"wom-user:/collation/{user.username}"
-  for feed in user.userprofile.web_feeds.select_related("source").all():
-    feed_references = set(feed.source.productions
-                          .exclude(referenceuserstatus__owner=user).all())
-    if feed in feed_collations:
+  if SHARED_COLLATIONS:
+    collation_url_parent_path = "wom-user:/collation/shared"
+  else:
+    collation_url_parent_path = f"wom-user:/collation/{user.username}"
+  for feed, feed_collation in feed_collations.items():
+    if SHARED_COLLATIONS:
+      with transaction.atomic():
+        feed_references = set(
+          generate_shared_collations(collation_url_parent_path,
+                                     feed,
+                                     feed_collation,
+                                     WEB_FEED_COLLATION_TIMEOUT,
+                                     WEB_FEED_COLLATION_MAX_NUM_REF_TARGET,
+                                     datetime.now(timezone.utc)))
+      # the shared references may already be known to the user
+      feed_references.difference_update(
+        Reference.objects.filter(pk__in=[r.pk for r in feed_references],
+                                 referenceuserstatus__owner=user))
+    else:
+      feed_references = set(exclude_references_below_read_watermark(
+        feed.source.productions.exclude(referenceuserstatus__owner=user), user))
       with transaction.atomic():
         feed_references = set(
           generate_collations(collation_url_parent_path,
                               feed,
-                              feed_collations[feed],
+                              feed_collation,
                               feed_references,
                               WEB_FEED_COLLATION_MIN_NUM_REF_TARGET,
                               WEB_FEED_COLLATION_MAX_NUM_REF_TARGET,
@@ -262,37 +304,282 @@ def check_user_unread_feed_items(user):
     # filter out rust that have the same reference
     new_references = feed_references-processed_references
     new_ref_status += generate_reference_user_status(user,new_references)
-    discarded_ref_count += len(feed_references)-len(new_references)
     processed_references.update(feed_references)
-    # At least for some time, let's control the effect of the filtering
-    if discarded_ref_count:
-      logger.debug("Discarded {0} duplicate feed items from news feed {1}."\
-                   .format(discarded_ref_count,feed.xmlURL))
+  return new_ref_status
+
+
+def get_unread_references_with_main_source(user, excluded_feeds):
+  """Return a queryset of (reference id, pub_date, main source id)
+  tuples for all the references produced by the sources of the user's
+  web feeds (except the excluded ones) and generated feeds that don't
+  have a reference user status yet.
+
+  The main source is picked as by get_main_source_ids_by_owner (but is
+  None if the reference has no source known to the user).
+  """
+  profile = user.userprofile
+  feed_sources = profile.web_feeds.exclude(pk__in=[f.pk for f in excluded_feeds])\
+                                  .values("source_id")
+  generated_feed_sources = profile.generated_feeds.values("source_id")
+  main_source = get_main_source_candidates([user.pk])\
+                  .filter(from_reference_id=OuterRef("pk"))\
+                  .values("to_reference_id")[:1]
+  references = Reference.objects\
+                        .filter(Q(sources__in=feed_sources)
+                                | Q(sources__in=generated_feed_sources))\
+                        .exclude(referenceuserstatus__owner=user)
+  return exclude_references_below_read_watermark(references, user)\
+                  .distinct()\
+                  .annotate(main_source_id=Subquery(main_source))\
+                  .values_list("pk", "pub_date", "main_source_id")
+
+
+@task()  
+def check_user_unread_feed_items(user):
+  """Browse all feed sources registered by a given user and create as
+  many ReferenceUserStatus instances as there are unread items.
+
+  The items of the collated feeds are handled feed by feed, while the
+  items of all other feeds are found (and saved) with a constant number
+  of queries.
+
+  NOTE: will avoid creating 2 reference user statuses pointing to a
+  same reference.
+  """
+  check_date = datetime.now(timezone.utc)
+  feed_collations = build_feed_collation_map(user)
+  new_ref_status = generate_collated_reference_user_status(user, feed_collations)
   with transaction.atomic():
-    for r in new_ref_status:
-      r.save()
-  for feed in user.userprofile.generated_feeds.select_related("source").all():
-    # filter out rust that have the same reference
-    feed_references = set(feed.source.productions.exclude(referenceuserstatus__owner=user).all())
-    new_references = feed_references-processed_references
-    new_ref_status += generate_reference_user_status(user,new_references)
-    discarded_ref_count += len(feed_references)-len(new_references)
-    processed_references.update(feed_references)
-    # At least for some time, let's control the effect of the filtering
-    if discarded_ref_count:
-      logger.debug("Discarded {0} duplicate feed items from generated feed {1}."\
-                   .format(discarded_ref_count,feed.title))
+    ReferenceUserStatus.objects.bulk_create(new_ref_status)
+    add_to_unread_counts(new_ref_status)
+  unread_references = list(
+    get_unread_references_with_main_source(user, feed_collations.keys()))
+  if any(main_source_id is None for _, _, main_source_id in unread_references):
+    unknown_reference_id = get_unknown_reference().pk
+  else:
+    unknown_reference_id = None
+  unread_ref_status = [
+    ReferenceUserStatus(reference_id=ref_id,
+                        owner=user,
+                        reference_pub_date=pub_date,
+                        main_source_id=main_source_id or unknown_reference_id)
+    for ref_id, pub_date, main_source_id in unread_references]
   with transaction.atomic():
-    for r in new_ref_status:
-      r.save()
+    ReferenceUserStatus.objects.bulk_create(unread_ref_status,
+                                            batch_size=REFERENCE_SAVE_BATCH_SIZE)
+    add_to_unread_counts(unread_ref_status)
+  new_ref_status += unread_ref_status
+  UserProfile.objects.filter(owner=user)\
+                     .update(unread_status_checked_at=check_date)
   return len(new_ref_status)
 
 
+def is_unread_status_stale(user, now):
+  """Tell whether the user's unread items were not checked recently
+  enough (or the followed feeds changed since)."""
+  checked_at = UserProfile.objects.filter(owner=user)\
+                                  .values_list("unread_status_checked_at", flat=True)\
+                                  .get()
+  return checked_at < now - UNREAD_STATUS_MAX_AGE
+
+
+def check_user_unread_feed_items_if_stale(user):
+  """Catch up with the user's unread items only if the background
+  checks did not do it recently. Return the number of new unread items.
+  """
+  if not is_unread_status_stale(user, datetime.now(timezone.utc)):
+    return 0
+  return check_user_unread_feed_items(user)
+
+
+@task()
+def check_all_users_unread_feed_items():
+  """Create the ReferenceUserStatus of the unread items of all users,
+  so that the river and sieve views don't have to."""
+  for profile in UserProfile.objects.select_related("owner").all():
+    check_user_unread_feed_items(profile.owner)
+
+
+@task()
+def compact_read_reference_user_statuses(horizon_date,
+                                         batch_size=READ_STATUS_COMPACTION_BATCH_SIZE):
+  """Delete by batches the ReferenceUserStatus of items read (and not
+  saved) that were published before horizon_date, keeping track of
+  them with per (user, source) read watermarks.
+
+  Return the number of deleted instances.
+  """
+  compactable_rusts = ReferenceUserStatus.objects\
+                                         .filter(has_been_read=True,
+                                                 has_been_saved=False,
+                                                 reference_pub_date__lt=horizon_date)
+  deleted_count = 0
+  while True:
+    with transaction.atomic():
+      batch_pks = list(compactable_rusts.order_by("pk")\
+                       .values_list("pk", flat=True)[:batch_size])
+      if not batch_pks:
+        break
+      batch = ReferenceUserStatus.objects.filter(pk__in=batch_pks)
+      # The references are watermarked on all their sources, as any of
+      # them may be the one through which the user follows them.
+      ReferenceSource = Reference.sources.through
+      watermarks = ReferenceSource.objects\
+        .filter(from_reference__referenceuserstatus__in=batch)\
+        .values_list("from_reference__referenceuserstatus__owner_id",
+                     "to_reference_id")\
+        .annotate(read_until=Max("from_reference__pub_date"))\
+        .order_by()
+      raise_read_watermarks({(owner_id, source_id): read_until
+                             for owner_id, source_id, read_until in watermarks})
+      batch_count, _ = batch.delete()
+    deleted_count += batch_count
+  logger.info("Compacted %d read ReferenceUserStatus." % deleted_count)
+  return deleted_count
+
+
+def get_obsolete_references_by_relevance_duration(now):
+  """Return a list of (relevance duration, querysets of references)
+  pairs, with the unpinned references that were published by the
+  sources of the feeds having this relevance duration, and are older
+  than it.
+  """
+  durations = set(WebFeed.objects.values_list("item_relevance_duration", flat=True)\
+                  .distinct().order_by())
+  durations.update(GeneratedFeed.objects.values_list("item_relevance_duration", flat=True)\
+                   .distinct().order_by())
+  obsolete_references = []
+  for duration in sorted(durations):
+    web_feed_sources = WebFeed.objects.filter(item_relevance_duration=duration)\
+                                      .values("source_id")
+    generated_feed_sources = GeneratedFeed.objects.filter(item_relevance_duration=duration)\
+                                                  .values("source_id")
+    references = Reference.objects\
+                          .filter(Q(sources__in=web_feed_sources)
+                                  | Q(sources__in=generated_feed_sources),
+                                  pin_count=0, pub_date__lt=now-duration)
+    obsolete_references.append((duration, references))
+  return obsolete_references
+
+
+def delete_obsolete_references_by_batches(obsolete_references,
+                                          batch_size=OBSOLETE_REFERENCES_BATCH_SIZE,
+                                          batch_duration=OBSOLETE_REFERENCES_BATCH_DURATION,
+                                          time_budget=OBSOLETE_REFERENCES_TIME_BUDGET):
+  """Delete the references of each queryset by batches of at most
+  batch_size references (in the order of their ids), each batch in its
+  own transaction.
+
+  Batches get smaller when they take more than batch_duration seconds
+  (and larger again when they're fast enough), and the deletion stops
+  after the first batch ending past time_budget seconds: as deleted
+  references don't match the querysets anymore, the next deletion
+  resumes where this one stopped.
+
+  Return a (number of deleted references, total number of deleted rows
+  including the cascades, False if the deletion stopped because of the
+  time budget) tuple.
+  """
+  start_time = time.monotonic()
+  current_batch_size = batch_size
+  deleted_references = 0
+  deleted_rows = 0
+  for references in obsolete_references:
+    last_pk = 0
+    while True:
+      batch_start_time = time.monotonic()
+      with transaction.atomic():
+        batch_pks = list(references.filter(pk__gt=last_pk)\
+                         .order_by("pk").distinct()\
+                         .values_list("pk", flat=True)[:current_batch_size])
+        if not batch_pks:
+          break
+        batch_rows, batch_counts = Reference.objects.filter(pk__in=batch_pks).delete()
+      last_pk = batch_pks[-1]
+      deleted_references += batch_counts.get(Reference._meta.label, 0)
+      deleted_rows += batch_rows
+      duration = time.monotonic() - batch_start_time
+      if duration > batch_duration:
+        current_batch_size = max(1, current_batch_size // 2)
+      elif duration < batch_duration / 2:
+        current_batch_size = min(batch_size, current_batch_size * 2)
+      if time.monotonic() - start_time > time_budget:
+        return deleted_references, deleted_rows, False
+  return deleted_references, deleted_rows, True
+
+
+def get_orphan_references():
+  """Return the unpinned references that can't be reached by any user.
+
+  The references that are reachable (and kept) are the sources known
+  to the users or to any feed, the references produced by the sources
+  known to the users or by the feeds they follow (whether they collate
+  them or not), the bookmarked ones and the sources of the pinned
+  references.
+  """
+  followed_feeds = WebFeed.objects.filter(userprofile__isnull=False)
+  followed_generated_feeds = GeneratedFeed.objects.filter(userprofile__isnull=False)
+  user_sources = UserProfile.sources.through.objects.values("reference_id")
+  public_sources = UserProfile.public_sources.through.objects.values("reference_id")
+  live_sources = Reference.objects.filter(
+    Q(pk__in=followed_feeds.values("source_id"))
+    | Q(pk__in=followed_generated_feeds.values("source_id"))
+    | Q(pk__in=user_sources))
+  ReferenceSource = Reference.sources.through
+  return Reference.objects\
+                  .filter(pin_count=0)\
+                  .exclude(pk__in=WebFeed.objects.values("source_id"))\
+                  .exclude(pk__in=GeneratedFeed.objects.values("source_id"))\
+                  .exclude(pk__in=user_sources)\
+                  .exclude(pk__in=public_sources)\
+                  .exclude(pk__in=UserBookmark.objects.values("reference_id"))\
+                  .exclude(Exists(ReferenceSource.objects.filter(
+                    from_reference_id=OuterRef("pk"),
+                    to_reference__in=live_sources)))\
+                  .exclude(Exists(ReferenceSource.objects.filter(
+                    to_reference_id=OuterRef("pk"),
+                    from_reference__pin_count__gt=0)))
+
+
+@task()
+def delete_orphan_references():
+  """Delete (by batches) the references that can't be reached by any
+  user anymore, like the ones produced by feeds that nobody follows.
+
+  Return the number of deleted references.
+  """
+  start_time = time.monotonic()
+  deleted_references, deleted_rows, is_complete = \
+    delete_obsolete_references_by_batches([get_orphan_references()])
+  duration = time.monotonic() - start_time
+  logger.info("Deleted %d orphan references (%d rows) in %.1fs (%.1f rows/s)%s."
+              % (deleted_references, deleted_rows, duration,
+                 deleted_rows / duration if duration > 0 else 0.0,
+                 "" if is_complete else ", stopped after the time budget"))
+  if deleted_references:
+    recount_unread_counts()
+  return deleted_references
+
+
 @task()
 def delete_obsolete_unpinned_references_from_feeds():
-  for feed in WebFeed.objects.select_related("source").all():
-      date_threshold = datetime.now(timezone.utc) - feed.item_relevance_duration
-      feed.source.productions.filter(pin_count=0, pub_date__lt=date_threshold).delete()
-  for feed in GeneratedFeed.objects.select_related("source").all():
-      date_threshold = datetime.now(timezone.utc) - feed.item_relevance_duration
-      feed.source.productions.filter(pin_count=0, pub_date__lt=date_threshold).delete()
+  """Delete the unpinned references that are older than the relevance
+  duration of the feeds that produced them (feeds having the same
+  relevance duration being handled with the same queries).
+
+  Return the number of deleted references.
+  """
+  start_time = time.monotonic()
+  obsolete_references = get_obsolete_references_by_relevance_duration(
+    datetime.now(timezone.utc))
+  deleted_references, deleted_rows, is_complete = \
+    delete_obsolete_references_by_batches(r for _, r in obsolete_references)
+  duration = time.monotonic() - start_time
+  logger.info("Deleted %d obsolete references (%d rows) in %.1fs (%.1f rows/s)%s."
+              % (deleted_references, deleted_rows, duration,
+                 deleted_rows / duration if duration > 0 else 0.0,
+                 "" if is_complete else ", stopped after the time budget"))
+  if deleted_references:
+    # The statuses of the deleted references went away with them
+    recount_unread_counts()
+  return deleted_references
@@ -0,0 +1,73 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+
+from io import StringIO
+
+import mock
+
+from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+
+from django.contrib.auth.models import User
+
+from wom_pebbles.db_indexes import REFERENCE_TUNED_INDEXES
+from wom_pebbles.models import Reference
+
+from wom_user.db_indexes import USER_TUNED_INDEXES
+
+
+class TunedIndexesTest(TestCase):
+
+  def test_tuned_indexes_are_created_by_migrations(self):
+    with connection.cursor() as cursor:
+      for index in REFERENCE_TUNED_INDEXES + USER_TUNED_INDEXES:
+        constraints = connection.introspection.get_constraints(cursor,
+                                                               index.table)
+        self.assertIn(index.name, constraints)
+        self.assertTrue(constraints[index.name]["index"])
+
+  def test_benchmark_shows_plans_and_leaves_no_data(self):
+    num_users = User.objects.count()
+    num_references = Reference.objects.count()
+    out = StringIO()
+    call_command("benchmark_hot_queries", users=2, sources=2, items=30,
+                 repeat=1, compare=True, stdout=out)
+    report = out.getvalue()
+    self.assertIn("=== with tuned indexes", report)
+    self.assertIn("=== without tuned indexes", report)
+    self.assertIn("wom_user_rust_unread_idx", report)
+    self.assertEqual(num_users, User.objects.count())
+    self.assertEqual(num_references, Reference.objects.count())
+    with connection.cursor() as cursor:
+      constraints = connection.introspection.get_constraints(
+        cursor, "wom_user_referenceuserstatus")
+    self.assertIn("wom_user_rust_unread_idx", constraints)
+
+  def test_benchmark_comparison_needs_transactional_ddl(self):
+    num_references = Reference.objects.count()
+    with mock.patch.object(connection, "vendor", "mysql"):
+      with self.assertRaises(CommandError):
+        call_command("benchmark_hot_queries", users=1, sources=1, items=10,
+                     repeat=1, compare=True, stdout=StringIO())
+    self.assertEqual(num_references, Reference.objects.count())
@@ -0,0 +1,126 @@
+# -*- coding: utf-8; indent-tabs-mode: nil; python-indent: 2 -*-
+#
+# Copyright (C) 2013-2019 Thibauld Nion
+#
+# This file is part of WaterOnMars (https://github.com/tibonihoo/wateronmars) 
+#
+# WaterOnMars is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# WaterOnMars is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+# 
+# You should have received a copy of the GNU Affero General Public License
+# along with WaterOnMars.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+from datetime import datetime, timedelta, timezone
+
+from django.urls import reverse
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+
+from django.contrib.auth.models import User
+
+from wom_pebbles.models import Reference
+
+from wom_user.models import UserProfile
+from wom_user.models import ReferenceUserStatus
+from wom_user.pagination import (
+    KeysetPaginator,
+    encode_cursor,
+    decode_cursor,
+    )
+
+
+class KeysetPaginatorTest(TestCase):
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="uA",password="pA")
+    UserProfile.objects.create(owner=self.user)
+    self.date = datetime(2013, 11, 17, 19, 8, 15, tzinfo=timezone.utc)
+    source = Reference.objects.create(url="http://mouf",title="mouf",
+                                      pub_date=self.date)
+    for i in range(10):
+      # pairs of items share a same date
+      pub_date = self.date + timedelta(hours=i//2)
+      ref = Reference.objects.create(url=f"http://mouf/{i}",title=f"{i}",
+                                     pub_date=pub_date)
+      ReferenceUserStatus.objects.create(reference=ref,
+                                         owner=self.user,
+                                         reference_pub_date=pub_date,
+                                         main_source=source)
+    self.expected_titles = [r.reference.title for r in
+                            ReferenceUserStatus.objects\
+                            .order_by("-reference_pub_date", "-id")\
+                            .select_related("reference")]
+    self.paginator = KeysetPaginator(
+      ReferenceUserStatus.objects.filter(owner=self.user)\
+                                 .select_related("reference"),
+      "reference_pub_date", 3)
+
+  def test_cursor_round_trip(self):
+    date = self.date + timedelta(microseconds=7)
+    self.assertEqual((date, 42), decode_cursor(encode_cursor(date, 42)))
+    self.assertEqual(None, decode_cursor("not_a_cursor"))
+
+  def test_going_forward_lists_all_items_once(self):
+    page = self.paginator.page()
+    self.assertFalse(page.has_previous())
+    titles = [r.reference.title for r in page]
+    while page.has_next():
+      page = self.paginator.page(after=page.next_cursor(),
+                                 number=page.next_page_number())
+      self.assertTrue(page.has_previous())
+      titles += [r.reference.title for r in page]
+    self.assertEqual(self.expected_titles, titles)
+    self.assertEqual(4, page.number)
+    self.assertEqual(1, len(page))
+
+  def test_going_backward(self):
+    second_page = self.paginator.page(after=self.paginator.page().next_cursor(),
+                                      number=2)
+    third_page = self.paginator.page(after=second_page.next_cursor(), number=3)
+    page = self.paginator.page(before=third_page.previous_cursor(),
+                               number=third_page.previous_page_number())
+    self.assertEqual(2, page.number)
+    self.assertEqual(self.expected_titles[3:6],
+                     [r.reference.title for r in page])
+    self.assertTrue(page.has_previous())
+    page = self.paginator.page(before=page.previous_cursor(), number=1)
+    self.assertEqual(self.expected_titles[:3],
+                     [r.reference.title for r in page])
+    self.assertFalse(page.has_previous())
+    self.assertTrue(page.has_next())
+
+  def test_invalid_cursor_gives_first_page(self):
+    page = self.paginator.page(after="garbage", number=12)
+    self.assertEqual(1, page.number)
+    self.assertEqual(self.expected_titles[:3],
+                     [r.reference.title for r in page])
+
+  def test_deep_pages_neither_offset_nor_count(self):
+    page = self.paginator.page()
+    with CaptureQueriesContext(connection) as queries:
+      self.paginator.page(after=page.next_cursor(), number=2)
+    self.assertEqual(1, len(queries.captured_queries))
+    sql = queries.captured_queries[0]["sql"].upper()
+    self.assertNotIn("OFFSET", sql)
+    self.assertNotIn("COUNT(", sql)
+
+  def test_river_view_links_to_next_page(self):
+    resp = self.client.get(reverse("user_river_view",
+                                   kwargs={"owner_name":"uA"}),
+                           {"after": self.paginator.page().next_cursor(),
+                            "page": 2})
+    self.assertEqual(200,resp.status_code)
+    items = resp.context["news_items"]
+    self.assertEqual(2, items.number)
+    self.assertEqual(self.expected_titles[3:3+len(items)],
+                     [r.reference.title for r in items])
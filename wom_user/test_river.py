@@ -19,12 +19,14 @@
 #
 
 import json
+import mock
 
 from datetime import datetime, timedelta, timezone
 
 from django.urls import reverse
 
 from django.test import TestCase
+from django.db import connection
 
 from wom_pebbles.models import (
     Reference,
@@ -47,6 +49,22 @@ from wom_user.settings import (
 from wom_user.views import MAX_ITEMS_PER_PAGE
 from wom_user.tasks import import_user_feedsources_from_opml
 from wom_user.tasks import check_user_unread_feed_items
+from wom_user.tasks import collect_news_from_followed_feeds
+from wom_user.tasks import clean_corrupted_rusts
+from wom_user.tasks import delete_obsolete_unpinned_references_from_feeds
+from wom_user.tasks import get_obsolete_references_by_relevance_duration
+from wom_user.tasks import delete_obsolete_references_by_batches
+from wom_user.tasks import delete_orphan_references
+from wom_user.tasks import get_main_source_ids
+
+from wom_river.tasks import (
+    add_new_references_from_prepared_entries,
+    schedule_next_poll,
+    FeedFetchResult,
+    ParsedFeed,
+    PreparedEntry,
+    )
+from wom_river.settings import FEED_POLL_MIN_INTERVAL
 
 from wom_classification.models import Tag
 from wom_classification.models import get_item_tag_names
@@ -290,6 +308,304 @@ class ImportUserFeedSourceFromOPMLTaskTest(TestCase):
       WebFeed.objects.get(source__url="http://www.openculture.com"))
     self.assertEqual(["Culture"],src_tags)
 
+class CollectNewsFromFollowedFeedsTaskTest(TestCase):
+
+  def setUp(self):
+    self.date = datetime.now(timezone.utc)
+    self.user = User.objects.create_user(username="uA",password="pA")
+    self.user_profile = UserProfile.objects.create(owner=self.user)
+    self.feeds = {}
+    for name, next_poll_delay in (("due", -timedelta(minutes=1)),
+                                  ("late", -timedelta(days=2)),
+                                  ("early", timedelta(hours=1)),
+                                  ("unfollowed", -timedelta(days=1))):
+      r = Reference.objects.create(url=f"http://{name}",title=name,
+                                   pub_date=self.date)
+      self.feeds[name] = WebFeed.objects.create(
+        xmlURL=f"http://{name}/rss.xml",
+        last_update_check=self.date,
+        next_poll_at=self.date+next_poll_delay,
+        source=r)
+      if name != "unfollowed":
+        self.user_profile.web_feeds.add(self.feeds[name])
+
+  def collect_by_lanes(self):
+    with mock.patch("wom_river.tasks.collect_news_from_feeds") as collect:
+      collect_news_from_followed_feeds()
+    return [[f.xmlURL for f in call.args[0]] for call in collect.call_args_list]
+
+  def test_only_due_feeds_are_collected_most_late_first(self):
+    self.assertEqual([["http://late/rss.xml", "http://due/rss.xml"], []],
+                     self.collect_by_lanes())
+
+  def test_slow_feeds_are_collected_last(self):
+    self.feeds["late"].fetch_latency = 60
+    self.feeds["late"].save()
+    self.assertEqual([["http://due/rss.xml"], ["http://late/rss.xml"]],
+                     self.collect_by_lanes())
+
+  def test_busiest_feeds_are_collected_at_each_run(self):
+    feed = self.feeds["due"]
+    WebFeed.objects.exclude(pk=feed.pk).update(next_poll_at=self.date+timedelta(days=1))
+    period = FEED_POLL_MIN_INTERVAL
+    for run_date in (self.date, self.date+period):
+      with mock.patch("wom_user.tasks.datetime") as mock_datetime:
+        mock_datetime.now.return_value = run_date
+        self.assertEqual([["http://due/rss.xml"], []], self.collect_by_lanes())
+      # the download ends a few seconds after the start of the run
+      busy_dates = [run_date - timedelta(minutes=i+1) for i in range(10)]
+      entries = [PreparedEntry(f"http://due/{i}", d, f"{i}", "", "", set(), "")
+                 for i, d in enumerate(busy_dates)]
+      feed = WebFeed.objects.get(pk=feed.pk)
+      schedule_next_poll(feed, FeedFetchResult(ParsedFeed(entries, None, {}, {}),
+                                               200, feed.xmlURL,
+                                               run_date+timedelta(seconds=5),
+                                               None, None))
+      feed.save()
+      self.assertEqual(run_date+period+timedelta(seconds=5), feed.next_poll_at)
+
+
+class ReferenceUserStatusFanOutTest(TestCase):
+
+  def setUp(self):
+    self.date = datetime.now(timezone.utc)
+    source = Reference.objects.create(url="http://mouf",title="mouf",
+                                      pub_date=self.date)
+    self.feed = WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                                       last_update_check=self.date,
+                                       source=source)
+    self.users = {}
+    for name in ("follower", "collator", "other"):
+      user = User.objects.create_user(username=name,password="p")
+      profile = UserProfile.objects.create(owner=user)
+      if name != "other":
+        profile.web_feeds.add(self.feed)
+        profile.sources.add(source)
+      if name == "collator":
+        profile.collating_feeds.add(WebFeedCollation.objects.create(
+          feed=self.feed, last_completed_collation_date=self.date))
+      self.users[name] = user
+
+  def collect(self, *urls, fingerprint="", feed=None):
+    entries = [PreparedEntry(url, self.date+timedelta(hours=1), url, "", "",
+                             set(), fingerprint)
+               for url in urls]
+    add_new_references_from_prepared_entries(feed or self.feed, entries,
+                                             self.date)
+
+  def test_unread_statuses_created_for_followers_only(self):
+    self.collect("http://mouf/a", "http://mouf/b")
+    rusts = ReferenceUserStatus.objects.filter(owner=self.users["follower"])
+    self.assertEqual({"http://mouf/a", "http://mouf/b"},
+                     set(rusts.values_list("reference__url", flat=True)))
+    for rust in rusts:
+      self.assertEqual(self.feed.source, rust.main_source)
+      self.assertFalse(rust.has_been_read)
+    self.assertFalse(ReferenceUserStatus.objects\
+                     .exclude(owner=self.users["follower"]).exists())
+
+  def test_no_duplicate_unread_status_for_updated_reference(self):
+    self.collect("http://mouf/a")
+    ReferenceUserStatus.objects.update(has_been_read=True)
+    self.feed.last_update_check = self.date
+    self.collect("http://mouf/a", "http://mouf/b", fingerprint="updated")
+    rusts = ReferenceUserStatus.objects.filter(owner=self.users["follower"])
+    self.assertEqual(2, rusts.count())
+    self.assertTrue(rusts.get(reference__url="http://mouf/a").has_been_read)
+    self.assertEqual(0, check_user_unread_feed_items(self.users["follower"]))
+
+  def test_main_source_is_the_oldest_followed_one(self):
+    older_source = Reference.objects.create(url="http://plop",title="plop",
+                                            pub_date=self.date-timedelta(days=1))
+    older_feed = WebFeed.objects.create(xmlURL="http://plop/rss.xml",
+                                        last_update_check=self.date,
+                                        source=older_source)
+    follower = self.users["follower"]
+    follower.userprofile.web_feeds.add(older_feed)
+    follower.userprofile.sources.add(older_source)
+    with mock.patch("wom_user.models.UNREAD_STATUS_FAN_OUT", False):
+      self.collect("http://mouf/a", feed=older_feed)
+    self.collect("http://mouf/a", fingerprint="updated")
+    rust = ReferenceUserStatus.objects.get(owner=follower)
+    self.assertEqual(older_source, rust.main_source)
+    self.assertEqual({rust.reference_id: older_source.pk},
+                     get_main_source_ids(follower, [rust.reference]))
+
+  def test_main_source_falls_back_to_the_unknown_one_on_both_paths(self):
+    follower = User.objects.create_user(username="sourceless",password="p")
+    UserProfile.objects.create(owner=follower).web_feeds.add(self.feed)
+    self.collect("http://mouf/a")
+    rust = ReferenceUserStatus.objects.get(owner=follower)
+    self.assertEqual("<unknown>", rust.main_source.url)
+    rust.delete()
+    check_user_unread_feed_items(follower)
+    self.assertEqual("<unknown>", ReferenceUserStatus.objects\
+                     .get(owner=follower).main_source.url)
+
+  def test_disabled_fan_out(self):
+    with mock.patch("wom_user.models.UNREAD_STATUS_FAN_OUT", False):
+      self.collect("http://mouf/a")
+    self.assertFalse(ReferenceUserStatus.objects.exists())
+
+
+class DeleteObsoleteReferencesTest(TestCase):
+
+  def setUp(self):
+    self.date = datetime.now(timezone.utc)
+    # 2 feeds sharing a relevance duration and a third one with a
+    # longer one
+    self.feeds = []
+    for name, weeks in (("a", 1), ("b", 1), ("c", 4)):
+      source = Reference.objects.create(url=f"http://{name}",title=name,
+                                        pub_date=self.date, pin_count=1)
+      self.feeds.append(WebFeed.objects.create(
+        xmlURL=f"http://{name}/rss.xml", last_update_check=self.date,
+        source=source, item_relevance_duration=timedelta(weeks=weeks)))
+    for feed in self.feeds:
+      for days in (1, 14, 15, 60):
+        r = Reference.objects.create(url=f"{feed.source.url}/{days}",
+                                     title=str(days),
+                                     pub_date=self.date-timedelta(days=days))
+        r.sources.add(feed.source)
+    Reference.objects.filter(url="http://a/15").update(pin_count=1)
+    self.user = User.objects.create_user(username="u",password="p")
+    profile = UserProfile.objects.create(owner=self.user)
+    profile.web_feeds.add(*self.feeds)
+    profile.sources.add(*[f.source for f in self.feeds])
+    check_user_unread_feed_items(self.user)
+
+  def test_delete_obsolete_references_grouped_by_relevance_duration(self):
+    self.assertEqual(2, len(get_obsolete_references_by_relevance_duration(self.date)))
+    self.assertEqual(6, delete_obsolete_unpinned_references_from_feeds())
+    self.assertEqual({"http://a/1", "http://a/15", "http://b/1",
+                      "http://c/1", "http://c/14", "http://c/15"},
+                     set(Reference.objects.filter(sources__isnull=False)\
+                         .values_list("url", flat=True)))
+    self.assertEqual(6, ReferenceUserStatus.objects.filter(owner=self.user).count())
+    self.assertEqual(6, UserProfile.objects.get(owner=self.user).num_unread_references)
+
+  def test_deletion_by_batches_resumes_after_time_budget(self):
+    querysets = lambda: [r for _, r in get_obsolete_references_by_relevance_duration(self.date)]
+    self.assertEqual((2, 6, False),
+                     delete_obsolete_references_by_batches(querysets(), batch_size=2,
+                                                           time_budget=0))
+    self.assertEqual((4, 12, True),
+                     delete_obsolete_references_by_batches(querysets(), batch_size=2))
+    self.assertEqual((0, 0, True),
+                     delete_obsolete_references_by_batches(querysets(), batch_size=2))
+
+
+class DeleteOrphanReferencesTest(TestCase):
+
+  def setUp(self):
+    self.date = datetime.now(timezone.utc)
+    self.user = User.objects.create_user(username="u",password="p")
+    self.profile = UserProfile.objects.create(owner=self.user)
+    self.feeds = {}
+    for name in ("followed", "collated", "unfollowed"):
+      source = Reference.objects.create(url=f"http://{name}",title=name,
+                                        pub_date=self.date)
+      self.feeds[name] = WebFeed.objects.create(
+        xmlURL=f"http://{name}/rss.xml", last_update_check=self.date,
+        source=source)
+      r = Reference.objects.create(url=f"http://{name}/item",title=name,
+                                   pub_date=self.date)
+      r.sources.add(source)
+    self.profile.web_feeds.add(self.feeds["followed"], self.feeds["collated"])
+    self.collation = WebFeedCollation.objects.create(
+      feed=self.feeds["collated"], last_completed_collation_date=self.date)
+    self.profile.collating_feeds.add(self.collation)
+
+  def create_orphan(self, url, pin_count=0):
+    return Reference.objects.create(url=url,title="orphan",pub_date=self.date,
+                                    pin_count=pin_count)
+
+  def test_only_unreachable_references_are_deleted(self):
+    # a source only known by a user
+    source = self.create_orphan("http://user-source")
+    self.profile.sources.add(source)
+    self.create_orphan("http://user-source/item").sources.add(source)
+    # a pinned reference and its source
+    pinned = self.create_orphan("http://pinned", pin_count=1)
+    pinned.sources.add(self.create_orphan("http://pinned-source"))
+    self.create_orphan("http://forgotten")
+    self.assertEqual(2, delete_orphan_references())
+    self.assertFalse(Reference.objects.filter(
+      url__in=["http://unfollowed/item", "http://forgotten"]).exists())
+    self.assertEqual(3, WebFeed.objects.count())
+    self.assertEqual({"http://followed/item", "http://collated/item",
+                      "http://user-source/item",
+                      "http://pinned", "http://pinned-source"},
+                     set(Reference.objects.exclude(url__in=["http://followed",
+                                                            "http://collated",
+                                                            "http://unfollowed",
+                                                            "http://user-source"])\
+                         .values_list("url", flat=True)))
+    self.assertEqual(0, delete_orphan_references())
+
+  def test_unfollowed_feed_items_are_deleted_with_their_statuses(self):
+    check_user_unread_feed_items(self.user)
+    self.assertTrue(ReferenceUserStatus.objects.filter(
+      reference__url="http://followed/item").exists())
+    self.profile.web_feeds.remove(self.feeds["followed"])
+    delete_orphan_references()
+    self.assertFalse(Reference.objects.filter(url="http://followed/item").exists())
+    self.assertFalse(ReferenceUserStatus.objects.exists())
+    self.assertEqual(0, UserProfile.objects.get(owner=self.user).num_unread_references)
+
+  def test_unfollowed_collated_feed_items_are_deleted(self):
+    self.profile.web_feeds.remove(self.feeds["collated"])
+    self.assertEqual(2, delete_orphan_references())
+    self.assertFalse(Reference.objects.filter(
+      url__in=["http://unfollowed/item", "http://collated/item"]).exists())
+
+
+class SharedCollationsTest(TestCase):
+
+  def setUp(self):
+    date = datetime.now(timezone.utc)
+    source = Reference.objects.create(url="http://mouf",title="mouf",
+                                      pub_date=date)
+    self.feed = WebFeed.objects.create(xmlURL="http://mouf/rss.xml",
+                                       last_update_check=date,
+                                       source=source)
+    for i in range(3):
+      r = Reference.objects.create(url=f"http://mouf/{i}",title=f"item {i}",
+                                   pub_date=date-(i+1)*WEB_FEED_COLLATION_TIMEOUT)
+      r.sources.add(source)
+    self.users = []
+    for name in ("a", "b"):
+      user = User.objects.create_user(username=name,password="p")
+      profile = UserProfile.objects.create(owner=user)
+      profile.web_feeds.add(self.feed)
+      profile.sources.add(source)
+      profile.collating_feeds.add(WebFeedCollation.objects.create(
+        feed=self.feed,
+        last_completed_collation_date=date-5*WEB_FEED_COLLATION_TIMEOUT))
+      self.users.append(user)
+
+  def test_collating_users_share_the_collated_references(self):
+    with mock.patch("wom_user.tasks.SHARED_COLLATIONS", True):
+      counts = [check_user_unread_feed_items(u) for u in self.users]
+      self.assertEqual([0, 0], [check_user_unread_feed_items(u) for u in self.users])
+    self.assertEqual([3, 3], counts)
+    collated_urls = [set(ReferenceUserStatus.objects.filter(owner=u)\
+                         .values_list("reference__url", flat=True))
+                     for u in self.users]
+    self.assertEqual(collated_urls[0], collated_urls[1])
+    for url in collated_urls[0]:
+      self.assertTrue(url.startswith("wom-user:/collation/shared/"))
+    self.assertEqual(3, Reference.objects.filter(
+      url__startswith="wom-user:/collation/").count())
+
+  def test_unfollowed_feeds_are_not_collated(self):
+    self.users[0].userprofile.web_feeds.remove(self.feed)
+    with mock.patch("wom_user.tasks.SHARED_COLLATIONS", True):
+      self.assertEqual(0, check_user_unread_feed_items(self.users[0]))
+    self.assertFalse(Reference.objects.filter(
+      url__startswith="wom-user:/collation/").exists())
+
+
 class UserRiverViewTest(TestCase):
 
     def setUp(self):
@@ -571,6 +887,28 @@ class ReferenceUserStatusModelTest(TestCase):
     self.assertFalse(Reference.objects.filter(title="other").exists())
     self.assertFalse(ReferenceUserStatus.objects.filter(main_source=src).exists())
 
+  def test_clean_corrupted_rusts_deletes_orphans_only(self):
+    src = Reference.objects.create(url="http://source",title="source",
+                                   pub_date=self.date)
+    refs = [Reference.objects.create(url=f"http://mouf/{i}",title=f"{i}",
+                                     pub_date=self.date)
+            for i in range(3)]
+    for ref in refs:
+      ReferenceUserStatus.objects.create(reference=ref,
+                                         owner=self.user,
+                                         reference_pub_date=self.date,
+                                         main_source=src)
+    # Simulate the corruption by deleting rows behind the ORM's back
+    # (foreign key checks being deferred until the end of the test).
+    with connection.cursor() as cursor:
+      cursor.execute("DELETE FROM wom_pebbles_reference WHERE id = %s",
+                     [refs[0].pk])
+    self.assertEqual(1, clean_corrupted_rusts())
+    self.assertEqual({refs[1].pk, refs[2].pk},
+                     set(ReferenceUserStatus.objects\
+                         .values_list("reference_id", flat=True)))
+    self.assertEqual(0, clean_corrupted_rusts(self.user))
+
 
 class UserSourceItemViewTest(TestCase):
   """Test the single source view."""
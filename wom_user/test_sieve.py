@@ -19,15 +19,24 @@
 #
 
 import json
+import mock
 
 from datetime import datetime, timedelta, timezone
 
 from django.urls import reverse
 
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 
 from wom_user.models import UserProfile
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import recount_unread_counts
+from wom_user.models import update_unread_counts
+from wom_user.models import UnreadCount
+from wom_user.models import mark_as_read
+from wom_user.models import ReadWatermark
+from wom_user.models import fan_out_reference_user_statuses
 
 from wom_pebbles.models import Reference
 
@@ -40,10 +49,18 @@ from wom_user.views import MAX_ITEMS_PER_PAGE
 from wom_user.settings import (
     WEB_FEED_COLLATION_TIMEOUT,
     WEB_FEED_COLLATION_MIN_NUM_REF_TARGET,
-    WEB_FEED_COLLATION_MAX_NUM_REF_TARGET
+    WEB_FEED_COLLATION_MAX_NUM_REF_TARGET,
+    UNREAD_STATUS_MAX_AGE,
     )
 
-from wom_user.tasks import check_user_unread_feed_items
+from wom_user.tasks import (
+    check_user_unread_feed_items,
+    check_all_users_unread_feed_items,
+    is_unread_status_stale,
+    compact_read_reference_user_statuses,
+    generate_reference_user_status,
+    get_unknown_reference,
+    )
 
 from django.contrib.auth.models import User
 
@@ -138,6 +155,143 @@ class UserSieveViewTest(TestCase):
       total_items = (len(user1_feeds) * self.num_items_per_source)
       expected_count = ( total_items / WEB_FEED_COLLATION_MAX_NUM_REF_TARGET)
       self.assertEqual(expected_count // 10, count // 10)
+
+    def test_check_user_unread_feed_items_picks_main_source_among_user_sources(self):
+      r = Reference.objects.create(url="http://r/shared",title="shared",
+                                   pub_date=datetime.now(timezone.utc))
+      r.sources.add(self.s2,self.s3)
+      check_user_unread_feed_items(self.user1)
+      rust = ReferenceUserStatus.objects.get(owner=self.user1,reference=r)
+      self.assertEqual(self.s3,rust.main_source)
+      self.assertEqual(r.pub_date,rust.reference_pub_date)
+
+    def test_check_user_unread_feed_items_query_count_does_not_depend_on_feeds(self):
+      date = datetime.now(timezone.utc)
+      def create_user_following(name, num_feeds):
+        user = User.objects.create_user(username=name,password="p")
+        profile = UserProfile.objects.create(owner=user)
+        for i in range(num_feeds):
+          src = Reference.objects.create(url=f"http://{name}{i}",title=name,
+                                         pub_date=date)
+          feed = WebFeed.objects.create(xmlURL=f"http://{name}{i}/rss.xml",
+                                        last_update_check=date,
+                                        source=src)
+          profile.web_feeds.add(feed)
+          profile.sources.add(src)
+          r = Reference.objects.create(url=f"http://{name}{i}/item",title=name,
+                                       pub_date=date)
+          r.sources.add(src)
+        return user
+      def count_queries(user):
+        with CaptureQueriesContext(connection) as queries:
+          count = check_user_unread_feed_items(user)
+        return count, len(queries.captured_queries)
+      one_feed_count, one_feed_queries = count_queries(create_user_following("one", 1))
+      many_feeds_count, many_feeds_queries = count_queries(create_user_following("many", 10))
+      self.assertEqual((1, 10), (one_feed_count, many_feeds_count))
+      self.assertEqual(one_feed_queries, many_feeds_queries)
+
+    def test_generate_reference_user_status_resolves_main_sources_in_one_query(self):
+      references = list(self.s1.productions.all()) + list(self.s3.productions.all())
+      orphan = Reference.objects.create(url="http://r/orphan",title="orphan",
+                                        pub_date=datetime.now(timezone.utc))
+      get_unknown_reference()
+      with CaptureQueriesContext(connection) as queries:
+        rusts = generate_reference_user_status(self.user1, references)
+      self.assertEqual(1, len(queries.captured_queries))
+      self.assertEqual({self.s1.pk, self.s3.pk},
+                       {r.main_source_id for r in rusts})
+      with mock.patch("wom_user.models._unknown_reference", None):
+        rust, = generate_reference_user_status(self.user1, [orphan])
+      self.assertEqual(Reference.objects.get(url="<unknown>").pk,
+                       rust.main_source_id)
+
+    def test_unknown_reference_is_memoized_once_committed(self):
+      with mock.patch("wom_user.models._unknown_reference", None):
+        with self.captureOnCommitCallbacks(execute=True):
+          unknown = get_unknown_reference()
+        with CaptureQueriesContext(connection) as queries:
+          self.assertEqual(unknown, get_unknown_reference())
+        self.assertEqual(0, len(queries.captured_queries))
+
+    def test_compaction_of_read_statuses_keeps_them_read(self):
+      check_user_unread_feed_items(self.user1)
+      check_user_unread_feed_items(self.user2)
+      rusts = ReferenceUserStatus.objects.filter(owner=self.user1)\
+                                         .order_by("reference_pub_date", "id")
+      horizon = rusts[10].reference_pub_date
+      # 10 items read, one of them being saved
+      mark_as_read(ReferenceUserStatus.objects.filter(pk__in=[r.pk for r in rusts[:10]]))
+      ReferenceUserStatus.objects.filter(pk=rusts[0].pk).update(has_been_saved=True)
+      num_user2_rusts = ReferenceUserStatus.objects.filter(owner=self.user2).count()
+      self.assertEqual(9, compact_read_reference_user_statuses(horizon, batch_size=4))
+      self.assertEqual(2*self.num_items_per_source-9,
+                       ReferenceUserStatus.objects.filter(owner=self.user1).count())
+      self.assertEqual(num_user2_rusts,
+                       ReferenceUserStatus.objects.filter(owner=self.user2).count())
+      self.assertEqual({self.s1.pk, self.s3.pk},
+                       set(ReadWatermark.objects.filter(owner=self.user1)\
+                           .values_list("source_id", flat=True)))
+      # compacted items don't come back as unread
+      self.assertEqual(0, check_user_unread_feed_items(self.user1))
+      self.assertEqual(0, compact_read_reference_user_statuses(horizon))
+
+    def test_fan_out_skips_references_below_read_watermark(self):
+      date = datetime.now(timezone.utc)
+      ReadWatermark.objects.create(owner=self.user1, source=self.s1,
+                                   read_until=date)
+      old_ref = Reference.objects.create(url="http://r1/old",title="old",
+                                         pub_date=date-timedelta(days=1))
+      new_ref = Reference.objects.create(url="http://r1/new",title="new",
+                                         pub_date=date+timedelta(days=1))
+      for r in (old_ref, new_ref):
+        r.sources.add(self.s1)
+      fan_out_reference_user_statuses(WebFeed, WebFeed.objects.get(xmlURL="http://mouf/rss.xml"),
+                                      [old_ref, new_ref])
+      self.assertEqual(["http://r1/new"],
+                       list(ReferenceUserStatus.objects.filter(owner=self.user1)\
+                            .values_list("reference__url", flat=True)))
+
+    def _add_new_reference_to_s1(self):
+      r = Reference.objects.create(url="http://r1/new",title="s1new",
+                                   pub_date=datetime.now(timezone.utc))
+      r.sources.add(self.s1)
+
+    def _get_num_unread_in_sieve(self):
+      self.client.login(username="uA",password="pA")
+      resp = self.client.get(reverse("user_river_sieve",
+                                     kwargs={"owner_name":"uA"}))
+      return resp.context["num_unread_references"]
+
+    def test_sieve_does_not_check_unread_items_when_fresh(self):
+      check_user_unread_feed_items(self.user1)
+      self._add_new_reference_to_s1()
+      self.assertEqual(2*self.num_items_per_source,
+                       self._get_num_unread_in_sieve())
+
+    def test_sieve_checks_unread_items_when_stale(self):
+      check_user_unread_feed_items(self.user1)
+      self._add_new_reference_to_s1()
+      UserProfile.objects.filter(owner=self.user1).update(
+        unread_status_checked_at=datetime.now(timezone.utc)-2*UNREAD_STATUS_MAX_AGE)
+      self.assertEqual(2*self.num_items_per_source+1,
+                       self._get_num_unread_in_sieve())
+
+    def test_following_a_feed_makes_unread_status_stale(self):
+      check_user_unread_feed_items(self.user1)
+      now = datetime.now(timezone.utc)
+      self.assertFalse(is_unread_status_stale(self.user1, now))
+      f2 = WebFeed.objects.get(xmlURL="http://bla/rss.xml")
+      self.user1.userprofile.web_feeds.add(f2)
+      self.assertTrue(is_unread_status_stale(self.user1, now))
+
+    def test_check_all_users_unread_feed_items(self):
+      check_all_users_unread_feed_items()
+      now = datetime.now(timezone.utc)
+      for user in (self.user1, self.user2):
+        self.assertEqual(2*self.num_items_per_source,
+                         ReferenceUserStatus.objects.filter(owner=user).count())
+        self.assertFalse(is_unread_status_stale(user, now))
       
     def test_get_html_for_owner_returns_max_items_ordered_oldest_first(self):
         """
@@ -190,6 +344,80 @@ class UserSieveViewTest(TestCase):
             + reverse("user_river_sieve",
                           kwargs={"owner_name":"uA"}))
 
+    def _get_unread_counts(self):
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        resp = self.client.get(reverse("user_river_sieve",
+                                       kwargs={"owner_name":"uA"}),
+                               {"format": "json"})
+        self.assertEqual(200,resp.status_code)
+        return json.loads(resp.content)
+
+    def test_get_json_unread_counts(self):
+        counts = self._get_unread_counts()
+        self.assertEqual(2*self.num_items_per_source,
+                         counts["num_unread_references"])
+        self.assertEqual({"http://mouf": self.num_items_per_source,
+                          "http://greuh": self.num_items_per_source},
+                         counts["sources"])
+
+    def test_unread_counts_follow_read_and_drop_actions(self):
+        self._get_unread_counts()
+        self.client.post(reverse("user_river_sieve",
+                                 kwargs={"owner_name":"uA"}),
+                         json.dumps({"action":"read","references":["http://r1"]}),
+                         content_type="application/json")
+        counts = self._get_unread_counts()
+        self.assertEqual(2*self.num_items_per_source-1,
+                         counts["num_unread_references"])
+        self.assertEqual(self.num_items_per_source-1,
+                         counts["sources"]["http://mouf"])
+        self.client.post(reverse("user_river_sieve",
+                                 kwargs={"owner_name":"uA"}),
+                         json.dumps({"action":"drop"}),
+                         content_type="application/json")
+        self.assertEqual({"num_unread_references": 0, "sources": {}},
+                         self._get_unread_counts())
+
+    def test_unread_counts_are_recounted_after_references_deletion(self):
+        check_user_unread_feed_items(self.user1)
+        Reference.objects.filter(url__startswith="http://r3").delete()
+        recount_unread_counts()
+        self.assertEqual({"num_unread_references": self.num_items_per_source,
+                          "sources": {"http://mouf": self.num_items_per_source}},
+                         self._get_unread_counts())
+
+    def test_unread_counts_created_concurrently_are_updated(self):
+        UnreadCount.objects.filter(owner=self.user1, source=self.s1).delete()
+        bulk_create = UnreadCount.objects.bulk_create
+        def racing_bulk_create(counts, **kwargs):
+            # another update creates the same count first
+            UnreadCount.objects.create(owner=self.user1, source=self.s1,
+                                       count=2)
+            return bulk_create(counts, **kwargs)
+        with mock.patch.object(UnreadCount.objects, "bulk_create",
+                               side_effect=racing_bulk_create):
+            update_unread_counts({(self.user1.pk, self.s1.pk): 3})
+        self.assertEqual(5, UnreadCount.objects.get(owner=self.user1,
+                                                    source=self.s1).count)
+
+    def test_unread_counts_created_during_a_recount_are_recounted(self):
+        check_user_unread_feed_items(self.user1)
+        UnreadCount.objects.filter(owner=self.user1, source=self.s1).delete()
+        bulk_create = UnreadCount.objects.bulk_create
+        def racing_bulk_create(counts, **kwargs):
+            # an update creates one of the counts meanwhile
+            UnreadCount.objects.create(owner=self.user1, source=self.s1,
+                                       count=100)
+            return bulk_create(counts, **kwargs)
+        with mock.patch.object(UnreadCount.objects, "bulk_create",
+                               side_effect=racing_bulk_create):
+            recount_unread_counts(self.user1)
+        self.assertEqual(self.num_items_per_source,
+                         UnreadCount.objects.get(owner=self.user1,
+                                                 source=self.s1).count)
+        self.assertEqual(2*self.num_items_per_source,
+                         UserProfile.objects.get(owner=self.user1).num_unread_references)
+
     def test_post_json_pick_item_out_of_sieve(self):
         """
         Make sure posting an item as read will remove it from the sieve.
@@ -291,6 +519,58 @@ class UserSieveViewTest(TestCase):
                                 content_type="application/json")
         self.assertEqual(400,resp.status_code)
 
+    def _post_sieve_action(self, action_dict):
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        return self.client.post(reverse("user_river_sieve",
+                                        kwargs={"owner_name":"uA"}),
+                                json.dumps(action_dict),
+                                content_type="application/json")
+
+    def test_post_json_read_until_date(self):
+        check_user_unread_feed_items(self.user1)
+        rusts = ReferenceUserStatus.objects.filter(owner=self.user1)\
+                                           .order_by("reference_pub_date", "id")
+        watermark = rusts[3]
+        resp = self._post_sieve_action({"action": "read_until",
+                                        "date": watermark.reference_pub_date.isoformat()})
+        self.assertEqual(200,resp.status_code)
+        # both sources have an item at each date
+        self.assertEqual(4,json.loads(resp.content)["count"])
+        self.assertEqual(2*self.num_items_per_source-4,
+                         self._get_unread_counts()["num_unread_references"])
+
+    def test_post_json_read_until_date_and_id(self):
+        check_user_unread_feed_items(self.user1)
+        rusts = list(ReferenceUserStatus.objects.filter(owner=self.user1)\
+                     .order_by("reference_pub_date", "id"))
+        watermark = rusts[2]
+        resp = self._post_sieve_action({"action": "read_until",
+                                        "date": watermark.reference_pub_date.isoformat(),
+                                        "id": watermark.id})
+        self.assertEqual(200,resp.status_code)
+        self.assertEqual(3,json.loads(resp.content)["count"])
+        self.assertEqual([r.id for r in rusts[3:]],
+                         list(ReferenceUserStatus.objects\
+                              .filter(owner=self.user1, has_been_read=False)\
+                              .order_by("reference_pub_date", "id")\
+                              .values_list("id", flat=True)))
+
+    def test_post_json_read_until_without_date_returns_error(self):
+        resp = self._post_sieve_action({"action": "read_until", "date": "yesterday"})
+        self.assertEqual(400,resp.status_code)
+
+    def test_post_json_drop_runs_a_constant_number_of_queries(self):
+        check_user_unread_feed_items(self.user1)
+        self.assertTrue(self.client.login(username="uA",password="pA"))
+        with CaptureQueriesContext(connection) as queries:
+          resp = self.client.post(reverse("user_river_sieve",
+                                          kwargs={"owner_name":"uA"}),
+                                  json.dumps({"action": "drop"}),
+                                  content_type="application/json")
+        self.assertEqual(2*self.num_items_per_source,
+                         json.loads(resp.content)["count"])
+        self.assertGreater(15, len(queries.captured_queries))
+
     def test_post_json_for_non_owner_logged_user_is_forbidden(self):
         """
         Make sure when the json is malformed an error that is not a server error is returned.
@@ -26,6 +26,8 @@ from .test_userprofile import *
 from .test_collection import *
 from .test_river import *
 from .test_sieve import *
+from .test_pagination import *
+from .test_db_indexes import *
 from .test_tributary_mastodon import *
 
 
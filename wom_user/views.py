@@ -23,12 +23,12 @@ import json
 import logging
 logger = logging.getLogger(__name__)
 
-from datetime import datetime
+from datetime import datetime, timezone
 from urllib.parse import quote_plus, unquote_plus
 
 from django.conf import settings
 from django.urls import reverse
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.core.paginator import Paginator
 
 from wom_pebbles.models import (
     Reference,
@@ -52,6 +52,8 @@ from django.http import HttpResponseNotFound
 from django.http import QueryDict
 
 from django.shortcuts import render
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
 from django.forms.utils import ErrorList
 from django.db import transaction
 
@@ -62,6 +64,8 @@ from django.contrib.auth.models import User
 from django.contrib.auth import logout
 
 from wom_river.models import WebFeed
+from wom_river.metrics import format_prometheus_metrics
+from wom_river.settings import METRICS_RETENTION
 from wom_tributary.models import GeneratedFeed, MastodonTimeline
 
 
@@ -71,7 +75,11 @@ from wom_tributary.tasks import (
     )
 
 from wom_user.models import UserBookmark
+from wom_user.models import UserProfile
 from wom_user.models import ReferenceUserStatus
+from wom_user.models import UnreadCount
+from wom_user.models import mark_as_read
+from wom_user.models import recount_unread_counts
 
 from wom_user.forms import OPMLFileUploadForm
 from wom_user.forms import NSBookmarkFileUploadForm
@@ -85,10 +93,15 @@ from wom_user.forms import UserMastodonFeedAdditionForm
 
 from wom_user.tasks import import_user_feedsources_from_opml
 from wom_user.tasks import import_user_bookmarks_from_ns_list
-from wom_user.tasks import check_user_unread_feed_items
+from wom_user.tasks import check_user_unread_feed_items_if_stale
+from wom_user.tasks import check_all_users_unread_feed_items
 from wom_user.tasks import delete_obsolete_unpinned_references_regularly
+from wom_user.tasks import delete_orphan_references_regularly
+from wom_user.tasks import delete_corrupted_rusts_regularly
+from wom_user.tasks import compact_read_rusts_regularly
 
 
+from wom_user.pagination import KeysetPaginator
 from wom_user.settings import MAX_ITEMS_PER_PAGE
 from wom_user.settings import HUMANS_TEAM
 from wom_user.settings import HUMANS_THANKS
@@ -202,6 +215,7 @@ def request_for_update(request):
   delete_obsolete_unpinned_references_regularly()
   collect_news_from_followed_feeds()
   collect_news_from_mastodon_feeds(1)
+  check_all_users_unread_feed_items()
   if settings.DEMO:
     # keep only a short number of refs (the most recent)
     # to avoid bloating the demo
@@ -210,18 +224,33 @@ def request_for_update(request):
                       .filter(pin_count=0)\
                       .order_by("-pub_date")[MAX_ITEMS_PER_PAGE:]):
         ref.delete()
+      recount_unread_counts()
   return HttpResponseRedirect(reverse("home"))
 
 
 def request_for_cleanup(request):
   """Trigger a cleanup of all references that have never been saved
-  (past an arbitrary delay).
+  (past an arbitrary delay) or that no user can reach anymore, and of
+  the corrupted unread statuses, and compact the old read statuses.
   """
   delete_obsolete_unpinned_references_regularly()
+  delete_orphan_references_regularly()
+  delete_corrupted_rusts_regularly()
+  compact_read_rusts_regularly()
   return HttpResponseRedirect(reverse("home"))
 
 
 
+def get_feed_collection_metrics(request):
+  """Expose the metrics about the collection of news from the feeds in
+  Prometheus' text format."""
+  if request.method != 'GET':
+    return HttpResponseNotAllowed(['GET'])
+  since = datetime.now(timezone.utc) - METRICS_RETENTION
+  return HttpResponse(format_prometheus_metrics(since),
+                      content_type='text/plain; version=0.0.4')
+
+
 def get_robots_txt(request):
   """Generate a set of robots.txt rules."""
   return HttpResponse("""
@@ -553,22 +582,18 @@ def get_user_collection(request,owner_name):
                                   .select_related("reference").all()
   if request.user!=request.owner_user:
     bookmarks = bookmarks.filter(is_public=True)
-  bookmarks = bookmarks.order_by('-saved_date')
   expectedFormat = request.GET.get("format","html").lower()
   if expectedFormat=="ns-bmk-list":
+    bookmarks = bookmarks.order_by('-saved_date')
     paginator = Paginator(bookmarks, bookmarks.count())
-  else:
-    paginator = Paginator(bookmarks, MAX_ITEMS_PER_PAGE)
-  page = request.GET.get('page')
-  try:
-    bookmarks = paginator.page(page)
-  except (PageNotAnInteger,EmptyPage):
-    # If page is not an integer or out of range, deliver first page.
     bookmarks = paginator.page(1)
+  else:
+    paginator = KeysetPaginator(bookmarks, "saved_date", MAX_ITEMS_PER_PAGE)
+    bookmarks = paginator.get_page(request.GET)
   d = add_base_template_context_data(
     {
       'user_bookmarks': bookmarks,
-      'num_bookmarks': bookmarks.count,
+      'num_bookmarks': len(bookmarks),
       'collection_url' : request.build_absolute_uri(request.path).rstrip("/"),
       'collection_add_bookmarklet': generate_collection_add_bookmarklet(
         request.build_absolute_uri("/"),request.user.username),
@@ -639,20 +664,14 @@ def user_collection_item(request, owner_name, reference_url_code):
 
 @check_and_set_owner
 def user_river_view(request,owner_name):
-  check_user_unread_feed_items(request.owner_user)
+  check_user_unread_feed_items_if_stale(request.owner_user)
   river_items = ReferenceUserStatus.objects\
                                    .filter(owner=request.owner_user)\
-                                   .order_by('-reference_pub_date')\
                                    .select_related("reference")
-  paginator = Paginator(river_items, MAX_ITEMS_PER_PAGE)
-  page = request.GET.get('page')
+  paginator = KeysetPaginator(river_items, "reference_pub_date", MAX_ITEMS_PER_PAGE)
   some_feeds_in_permanent_failure = request.owner_user.userprofile.web_feeds\
     .filter(permanent_failure_detected=True).exists()
-  try:
-    news_items = paginator.page(page)
-  except (PageNotAnInteger,EmptyPage):
-    # If page is not an integer or out of range, deliver first page.
-    news_items = paginator.page(1)
+  news_items = paginator.get_page(request.GET)
   d = add_base_template_context_data({
     'news_items': news_items,
     'source_add_bookmarklet': generate_source_add_bookmarklet(request.build_absolute_uri("/"),request.user.username),
@@ -665,12 +684,26 @@ def generate_user_sieve(request,owner_name):
   """
   Generate the HTML page on which a given user will be able to see and
   use its sieve to read and sort out the latests news.
+
+  With a 'format=json' parameter, only the number of unread items (in
+  total and per source) is returned, for clients to check cheaply if
+  there is anything new.
   """
-  check_user_unread_feed_items(request.owner_user)
+  check_user_unread_feed_items_if_stale(request.owner_user)
+  num_unread = UserProfile.objects.filter(owner=request.owner_user)\
+                                  .values_list("num_unread_references", flat=True)\
+                                  .get()
+  expectedFormat = request.GET.get("format","html")
+  if expectedFormat.lower()=="json":
+    unread_counts = UnreadCount.objects.filter(owner=request.owner_user,
+                                               count__gt=0)\
+                                       .values_list("source__url", "count")
+    response_dict = {"num_unread_references": num_unread,
+                     "sources": dict(unread_counts)}
+    return HttpResponse(json.dumps(response_dict), content_type='application/json')
   unread_references = ReferenceUserStatus.objects.filter(owner=request.owner_user,
                                                          has_been_read=False)
-  num_unread = unread_references.count()
-  oldest_unread_references = unread_references.order_by('reference_pub_date')\
+  oldest_unread_references = unread_references.order_by('reference_pub_date', 'id')\
                              [:MAX_ITEMS_PER_PAGE]\
                                .select_related("reference","main_source")
   some_feeds_in_permanent_failure = request.owner_user.userprofile.web_feeds\
@@ -701,6 +734,15 @@ def apply_to_user_sieve(request,owner_name):
   or to mark all items as read:
 
     { "action" = "drop" }
+
+  or to mark as read all items up to a given publication date (the
+  optional id of the last ReferenceUserStatus to mark as read allowing
+  to tell apart items published at the same date)::
+
+    { "action" = "read_until",
+      "date" = "2013-11-17T19:08:15+00:00",
+      "id" = 1234,
+    }
   """
   if settings.READ_ONLY:
     return HttpResponseForbidden("Changing the sieve's state is not possible in READ_ONLY mode.")
@@ -709,22 +751,29 @@ def apply_to_user_sieve(request,owner_name):
   except:
     action_dict = {}
   action_name = action_dict.get("action")
-  if action_name not in ("read", "drop"):
-    return HttpResponseBadRequest("Only a JSON formatted 'read' and 'drop' actions are supported.")
-  modified_rust = []
-  rust_iterator = ReferenceUserStatus.objects\
-                                      .filter(has_been_read=False,
-                                              owner=request.owner_user)
+  if action_name not in ("read", "drop", "read_until"):
+    return HttpResponseBadRequest("Only a JSON formatted 'read', 'drop' and 'read_until' actions are supported.")
+  rusts = ReferenceUserStatus.objects.filter(owner=request.owner_user)
   if action_name == "read":
     target_urls = action_dict.get("references",[])
-    rust_iterator = rust_iterator.filter(reference__url__in=target_urls)
-  for rust in rust_iterator:
-    rust.has_been_read = True
-    modified_rust.append(rust)
-  with transaction.atomic():
-    for r in modified_rust:
-      r.save()
-  count = len(modified_rust)
+    rusts = rusts.filter(reference__url__in=target_urls)
+  elif action_name == "read_until":
+    try:
+      until_date = parse_datetime(action_dict.get("date") or "")
+      until_id = action_dict.get("id")
+      until_id = None if until_id is None else int(until_id)
+    except (TypeError, ValueError):
+      until_date = None
+    if until_date is None:
+      return HttpResponseBadRequest("A 'read_until' action needs a valid ISO 8601 'date' (and an optional integer 'id').")
+    if until_date.tzinfo is None:
+      until_date = until_date.replace(tzinfo=timezone.utc)
+    if until_id is None:
+      rusts = rusts.filter(reference_pub_date__lte=until_date)
+    else:
+      rusts = rusts.filter(Q(reference_pub_date__lt=until_date)
+                           | Q(reference_pub_date=until_date, id__lte=until_id))
+  count = mark_as_read(rusts)
   response_dict = {"action": action_name, "status": "success", "count": count}
   return HttpResponse(json.dumps(response_dict), content_type='application/json')
 
@@ -756,9 +805,12 @@ def user_river_sources(request,owner_name):
       other_sources = owner_profile.public_sources.all()
     other_sources = other_sources.exclude(webfeed__userprofile=owner_profile)\
                                  .order_by("title")
+    unread_counts = dict(UnreadCount.objects.filter(owner=request.owner_user)\
+                         .values_list("source_id", "count"))
     def add_tag_to_feed(feed):
       tag_names = get_item_tag_names(request.owner_user,feed)
       feed.main_tag_name = tag_names[0] if tag_names else ""
+      feed.num_unread = unread_counts.get(feed.source_id, 0)
       return feed
     web_feeds = [add_tag_to_feed(f) for f in web_feeds.iterator()]
     web_feeds.sort(key=lambda f:f.main_tag_name)